@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+asyncio ingestion of payloads that arrive over the network.
+
+Payloads are trimmed as they are submitted and queued. A single batching task takes them off the queue and writes
+them with bulk_create on a small pool of threads (the Neo4j driver is blocking), each thread with its own neomodel
+connection. At most max_in_flight transactions run at any time:
+
+* While a transaction slot is free, whatever is queued is written straight away, so a small burst is not delayed
+  waiting for a batch to fill up.
+* While all slots are busy, payloads keep accumulating and are written as full batches once a slot frees up.
+* When the queue is full, submit() waits, which slows down the producer (and, for the TCP server below, stops reading
+  from the socket) until the database catches up.
+
+Usage: python async_ingestion.py [--port 7688] [--max-in-flight N] [--batch-size N]
+       (then send one payload per line, e.g. `nc localhost 7688 < payloads.txt`)
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import asyncio
+import argparse
+import concurrent.futures
+from trimming import DEFAULT_BYTE_LIMIT
+from ingestion import Record, IngestionReport, trim_payload, load_model, connect_from_environment, start_metrics, \
+    byte_limit_argument, resolve_byte_limit
+from profiling import add_profiling_arguments, profiling_settings, start_profiling, stop_profiling
+from bulk_writer import DEFAULT_BATCH_SIZE, bulk_create
+
+# Number of transactions that may run concurrently by default.
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# Marks the end of the submitted payloads in the queue.
+_CLOSE = object()
+
+
+class AsyncIngestion(object):
+    """
+        Writes submitted payloads with a bounded number of concurrent batched transactions.
+    """
+    def __init__(self, model, property_name="payload", byte_limit=DEFAULT_BYTE_LIMIT, batch_size=DEFAULT_BATCH_SIZE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_queued=None, merge_on=None):
+        """
+            Initialises the writer. It does not accept payloads until start() has been awaited.
+
+        :param model: The neomodel.StructuredNode class to create
+        :param property_name: The name of the property that receives the payload
+        :param byte_limit: An integer representing the byte length limit to trim payloads to
+        :param batch_size: The maximum number of rows per transaction
+        :param max_in_flight: The maximum number of concurrent transactions
+        :param max_queued: The maximum number of payloads waiting for a transaction (defaults to one batch per slot)
+        :param merge_on: The name of a uniquely indexed property to MERGE on
+        """
+        self.model = model
+        self.property_name = property_name
+        self.byte_limit = byte_limit
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued or batch_size * max_in_flight
+        self.merge_on = merge_on
+        self.report = IngestionReport()
+        self._queue = None
+        self._slots = None
+        self._executor = None
+        self._batcher = None
+        self._in_flight = set()
+
+    async def start(self):
+        """
+            Starts the batching task and the transaction threads.
+        """
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self._batcher = asyncio.ensure_future(self._run_batcher())
+
+    async def submit(self, payload, source="async", offset=0):
+        """
+            Trims and queues a payload, waiting while the queue is full.
+
+        :param payload: A str or a bytes-like object holding UTF-8
+        :param source: Where the payload came from, for error reports
+        :param offset: The position of the payload within source, for error reports
+        :return: An asyncio.Future that resolves to None once the payload is written or raises the error that
+                 prevented it from being written. It does not have to be awaited.
+        """
+        trimmed_payload, was_trimmed = trim_payload(payload, self.byte_limit)
+        self.report.read += 1
+        if was_trimmed:
+            self.report.trimmed += 1
+        outcome = asyncio.get_event_loop().create_future()
+        await self._queue.put((Record(source, offset, offset, trimmed_payload), outcome))
+        return outcome
+
+    async def write(self, payload, source="async", offset=0):
+        """
+            Trims and writes a payload, returning once it has been written.
+
+        :param payload: A str or a bytes-like object holding UTF-8
+        :raises: The error that prevented the payload from being written
+        """
+        await (await self.submit(payload, source, offset))
+
+    async def close(self):
+        """
+            Writes everything that has been submitted and stops the writer.
+
+        :return: The IngestionReport of the run
+        """
+        await self._queue.put(_CLOSE)
+        await self._batcher
+        if self._in_flight:
+            await asyncio.wait(self._in_flight)
+        self._executor.shutdown()
+        return self.report
+
+    async def _run_batcher(self):
+        """
+            Takes payloads off the queue and starts a transaction for them whenever a slot is free.
+        """
+        closing = False
+        while not closing:
+            an_item = await self._queue.get()
+            if an_item is _CLOSE:
+                break
+            batch = [an_item]
+            await self._slots.acquire()
+            # Everything that arrived while waiting for the slot goes into the same transaction.
+            while len(batch) < self.batch_size:
+                try:
+                    an_item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if an_item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(an_item)
+            a_task = asyncio.ensure_future(self._write_batch(batch))
+            self._in_flight.add(a_task)
+            a_task.add_done_callback(self._in_flight.discard)
+
+    async def _write_batch(self, batch):
+        """
+            Writes a batch on a transaction thread and resolves the outcome of each of its payloads.
+
+        :param batch: A list of (Record, asyncio.Future) tuples
+        """
+        try:
+            rows = [{self.property_name: a_record.payload} for a_record, _ in batch]
+            try:
+                result = await asyncio.get_event_loop().run_in_executor(
+                    self._executor, bulk_create, self.model, rows, len(rows), self.merge_on)
+            except Exception as e:
+                # Not a property of any particular row (e.g. the server is unavailable), so the whole batch fails.
+                for a_record, an_outcome in batch:
+                    self.report.add_error(a_record, e)
+                    self._resolve(an_outcome, e)
+                return
+            failed = {}
+            for a_failure in result.failures:
+                failed[a_failure.index] = a_failure.error
+                self.report.add_error(batch[a_failure.index][0], a_failure.error)
+            self.report.written += result.written
+            self.report.matched += result.matched
+            for index, (_, an_outcome) in enumerate(batch):
+                self._resolve(an_outcome, failed.get(index))
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _resolve(outcome, error):
+        """
+            Resolves the outcome of a payload, unless the caller has already given up on it.
+        """
+        if outcome.cancelled():
+            return
+        if error is None:
+            outcome.set_result(None)
+        else:
+            outcome.set_exception(error)
+            # Callers are free not to await the outcome, which is not worth a "never retrieved" warning.
+            outcome.add_done_callback(lambda a_future: a_future.exception())
+
+
+async def serve(ingestion, host, port):
+    """
+        Accepts TCP connections and ingests one payload per line from each.
+
+    :param ingestion: A started AsyncIngestion
+    :param host: The address to listen on
+    :param port: The port to listen on
+    :return: The asyncio server
+    """
+    async def handle_connection(reader, writer):
+        peer = "{}:{}".format(*writer.get_extra_info("peername")[:2])
+        offset = 0
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            payload = line.rstrip(b"\r\n")
+            if payload:
+                await ingestion.submit(payload, peer, offset)
+            offset += len(line)
+        writer.close()
+
+    # Lines are read whole, so the stream limit has to allow for the longest payload.
+    return await asyncio.start_server(handle_connection, host, port, limit=64 * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingests newline-delimited payloads received over TCP.")
+    parser.add_argument("--listen", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=7688, help="The port to listen on")
+    parser.add_argument("--byte-limit", type=byte_limit_argument, default=DEFAULT_BYTE_LIMIT,
+                        help="Byte limit of the payload, or auto for the limit calibrated for the server")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Maximum nodes per transaction")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help="Maximum number of concurrent transactions")
+    parser.add_argument("--model", default="main_fix.SomeEntity", help="The node class to create (module.Class)")
+    parser.add_argument("--property", dest="property_name", default="payload", help="The property of the payload")
+    parser.add_argument("--metrics", default=None,
+                        help="File to write metrics to, as JSON if it ends in .json and as Prometheus text otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="Seconds between rewrites of the metrics file (0 writes it once, at shutdown)")
+    parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    args = add_profiling_arguments(parser).parse_args()
+
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+
+    metrics_writer, profiler = None, None
+    try:
+        metrics_writer = start_metrics(args)
+        profiler = start_profiling(profiling_settings(args))
+
+        model = load_model(args.model)
+        byte_limit = resolve_byte_limit(args.byte_limit, model, args.property_name)
+        ingestion = AsyncIngestion(model, args.property_name, byte_limit, args.batch_size, args.max_in_flight)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(ingestion.start())
+        server = loop.run_until_complete(serve(ingestion, args.listen, args.port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        report = loop.run_until_complete(ingestion.close())
+    finally:
+        stop_profiling(profiler)
+        if metrics_writer is not None:
+            metrics_writer.stop()
+    report.write(sys.stderr)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Columnar trimming of many UTF-8 payloads at once.
+
+Payloads are held Arrow-style, as one concatenated UTF-8 buffer plus an offsets array of n+1 integers, where row i
+occupies buffer[offsets[i]:offsets[i+1]]. Trimming a row never moves its start, only its end, so the result of a
+batch trim is a new array of end offsets computed with NumPy over the whole batch, without creating a Python string
+per row.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import numpy
+from trimming import UTF8_MAX_BYTES_PER_CHAR
+
+
+def pack_strings(strings):
+    """
+        Encodes a sequence of unicode strings into a single UTF-8 buffer and its offsets array.
+
+    :param strings: An iterable of unicode strings
+    :return: A tuple (buffer, offsets) of bytes and an int64 numpy array of len(strings)+1 elements
+    """
+    encoded_strings = [a_string.encode("utf-8") for a_string in strings]
+    offsets = numpy.zeros(len(encoded_strings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(an_encoded_string) for an_encoded_string in encoded_strings], out=offsets[1:])
+    return b"".join(encoded_strings), offsets
+
+
+def trim_ends(data, starts, ends, byte_limit):
+    """
+        Trims rows of a UTF-8 byte array, given by their start and end positions, to byte_limit bytes at valid
+        character boundaries.
+
+        NOTE: A row is cut at start + byte_limit. If the byte at that position is a continuation byte (10xxxxxx) the
+              cut moves back, one byte at a time, for all rows at once. A UTF-8 character is at most 4 bytes long,
+              so at most 3 such steps are ever required.
+
+    :param data: A uint8 numpy array holding the rows
+    :param starts: An int64 numpy array of n row start positions into data
+    :param ends: An int64 numpy array of n row end positions into data (rows do not have to be contiguous)
+    :param byte_limit: An integer representing the byte length limit to trim each row to
+    :return: An int64 numpy array of n trimmed end positions
+    """
+    if byte_limit <= 0:
+        return starts.copy()
+
+    ends = ends.copy()
+    long_rows = numpy.flatnonzero(ends - starts > byte_limit)
+    if not len(long_rows):
+        return ends
+
+    long_starts = starts[long_rows]
+    cuts = long_starts + byte_limit
+    for _ in range(UTF8_MAX_BYTES_PER_CHAR - 1):
+        inside_character = ((data[cuts] & 0xC0) == 0x80) & (cuts > long_starts)
+        if not inside_character.any():
+            break
+        cuts -= inside_character
+    ends[long_rows] = cuts
+    return ends
+
+
+def trim_offsets(buffer, offsets, byte_limit):
+    """
+        Trims every row of a concatenated UTF-8 buffer to byte_limit bytes at valid character boundaries.
+
+    :param buffer: A bytes-like object (bytes, bytearray, memoryview, mmap) holding the concatenated UTF-8 rows
+    :param offsets: An integer array of n+1 row offsets into buffer
+    :param byte_limit: An integer representing the byte length limit to trim each row to
+    :return: An int64 numpy array of n end offsets. Row i trimmed is buffer[offsets[i]:ends[i]]
+    """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    return trim_ends(numpy.frombuffer(buffer, dtype=numpy.uint8), offsets[:-1], offsets[1:], byte_limit)
+
+
+def compact(buffer, offsets, ends):
+    """
+        Gathers trimmed rows into a new contiguous buffer and offsets array, dropping the trimmed-off bytes.
+
+    :param buffer: A bytes-like object holding the concatenated UTF-8 rows
+    :param offsets: An integer array of n+1 row offsets into buffer
+    :param ends: An integer array of n trimmed end offsets as returned by trim_offsets
+    :return: A tuple (buffer, offsets) of bytes and an int64 numpy array of n+1 elements
+    """
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    starts = numpy.asarray(offsets, dtype=numpy.int64)[:-1]
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    lengths = ends - starts
+    new_offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=new_offsets[1:])
+    # Index of every kept byte: its row's start plus its position within the row.
+    row_of_byte = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    byte_index = starts[row_of_byte] + numpy.arange(new_offsets[-1]) - new_offsets[:-1][row_of_byte]
+    return data[byte_index].tobytes(), new_offsets
+
+
+def iter_trimmed(buffer, offsets, ends):
+    """
+        Yields the trimmed rows as unicode strings, decoding each one only when it is requested.
+
+    :param buffer: A bytes-like object holding the concatenated UTF-8 rows
+    :param offsets: An integer array of n+1 row offsets into buffer
+    :param ends: An integer array of n trimmed end offsets as returned by trim_offsets
+    :return: A generator of unicode strings
+    """
+    view = memoryview(buffer)
+    starts = numpy.asarray(offsets, dtype=numpy.int64)[:-1]
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield str(view[start:end], "utf-8")
+
+
+def trim_strings(strings, byte_limit):
+    """
+        Convenience wrapper that trims a list of unicode strings through the columnar path.
+
+    :param strings: An iterable of unicode strings
+    :param byte_limit: An integer representing the byte length limit to trim each string to
+    :return: A list of trimmed unicode strings, equal to calling trim_string_at_unicode_boundaries on each element
+    """
+    buffer, offsets = pack_strings(strings)
+    return list(iter_trimmed(buffer, offsets, trim_offsets(buffer, offsets, byte_limit)))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the trimming, encoding and node creation paths.
+
+Every benchmark is run for ASCII, Greek, CJK and emoji payloads (1, 2, 3 and 4 bytes per character) of 100 bytes to
+10 MB. Trimming benchmarks run offline. Write benchmarks (--writes) create nodes through ingest() with single saves
+(batch size 0) and batched UNWIND writes, and delete the nodes they created afterwards. With --local they run against
+the in-process stand-in of local_neo4j.py instead of a server, optionally with a simulated round trip latency.
+
+Results are written as JSON: the environment they were obtained in and one entry per benchmark, with its time per
+operation (us_per_op), input throughput (mb_per_s) and, for writes, nodes_per_s. A previous result file can be passed
+to --compare, in which case every benchmark that got slower by more than --threshold is listed and the exit code is 1.
+
+Usage: python benchmark_suite.py [--writes [--local]] [--output results.json] [--compare baseline.json]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import subprocess
+import neomodel
+from trimming import DEFAULT_BYTE_LIMIT, trim_string_at_unicode_boundaries, trim_bytes_at_unicode_boundaries
+from batch_trimming import trim_strings
+from benchmark_trim import time_per_call
+from ingestion import Record, ingest, make_writer, load_model, connect_from_environment
+from local_neo4j import LocalNeo4j
+
+# Payload sizes in bytes.
+DEFAULT_SIZES = [100, 1000, 10 * 1000, 100 * 1000, 1000 * 1000, 10 * 1000 * 1000]
+
+# Batch sizes of the write benchmarks. 0 saves one node at a time.
+DEFAULT_BATCH_SIZES = [0, 1000]
+
+# Rows per call of the batch trimming benchmark.
+TRIM_BATCH_ROWS = 1000
+
+# Upper bound of the payload bytes generated by a single benchmark, which limits the rows or nodes of large payloads.
+MAX_BENCHMARK_BYTES = 256 * 1000 * 1000
+
+
+def _greek_sample():
+    """
+        Returns the Greek Lorem Ipsum of the test cases, or a short Greek phrase if they are not available.
+    """
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "testcase1.txt"), "rt",
+                  encoding="utf-8") as fd:
+            return fd.read()
+    except IOError:
+        return u"Το Lorem Ipsum είναι απλά ένα κείμενο χωρίς νόημα. "
+
+
+SAMPLES = {"ascii": u"The standard english phrase 'Hello World'. ",
+           "greek": _greek_sample(),
+           "cjk": u"标准的英语短语“你好世界”翻译成希腊语。",
+           "emoji": u"😀🎉👍🏽🌍🚀✨🐍"}
+
+
+def make_payload(script, size):
+    """
+        Returns a payload of a script that encodes to at most size bytes (and as close to it as characters allow).
+
+    :param script: A key of SAMPLES
+    :param size: The length of the payload in UTF-8 bytes
+    :return: Unicode string
+    """
+    sample = SAMPLES[script]
+    repeats = size // len(sample.encode("utf-8")) + 1
+    return trim_string_at_unicode_boundaries(sample * repeats, size)
+
+
+def rows_for(size, rows):
+    """
+        Returns how many rows of size bytes a benchmark uses, given that it would like to use rows.
+    """
+    return max(min(rows, MAX_BENCHMARK_BYTES // max(size, 1)), 1)
+
+
+def result_entry(benchmark, script, payload_bytes, seconds_per_op, batch_size=None, nodes_per_op=None):
+    """
+        Returns the result of one benchmark as a dict.
+
+    :param benchmark: The name of the benchmark
+    :param script: The script of the payload
+    :param payload_bytes: The bytes processed by one operation
+    :param seconds_per_op: The time of one operation, in seconds
+    :param batch_size: The batch size of write benchmarks
+    :param nodes_per_op: The nodes created by one operation of write benchmarks
+    :return: dict
+    """
+    entry = {"benchmark": benchmark,
+             "script": script,
+             "bytes": payload_bytes,
+             "us_per_op": seconds_per_op * 1e6,
+             "mb_per_s": payload_bytes / seconds_per_op / 1e6 if seconds_per_op else None}
+    if batch_size is not None:
+        entry["batch_size"] = batch_size
+    if nodes_per_op is not None:
+        entry["nodes_per_s"] = nodes_per_op / seconds_per_op if seconds_per_op else None
+    return entry
+
+
+def trim_benchmarks(scripts, sizes, byte_limit):
+    """
+        Times the encoding and trimming paths for every script and size.
+
+    :return: A generator of result dicts. The bytes of each operation are those of the untrimmed payload.
+    """
+    for a_script in scripts:
+        for a_size in sizes:
+            payload = make_payload(a_script, a_size)
+            encoded_payload = payload.encode("utf-8")
+            payload_bytes = len(encoded_payload)
+            yield result_entry("encode", a_script, payload_bytes,
+                               time_per_call(lambda p, _: p.encode("utf-8"), payload, byte_limit) / 1e6)
+            yield result_entry("trim_string", a_script, payload_bytes,
+                               time_per_call(trim_string_at_unicode_boundaries, payload, byte_limit) / 1e6)
+            yield result_entry("trim_bytes", a_script, payload_bytes,
+                               time_per_call(trim_bytes_at_unicode_boundaries, encoded_payload, byte_limit) / 1e6)
+            rows = rows_for(payload_bytes, TRIM_BATCH_ROWS)
+            batch = [payload] * rows
+            # One operation is one row, so that the figures compare to those of trim_string.
+            yield result_entry("trim_batch", a_script, payload_bytes,
+                               time_per_call(trim_strings, batch, byte_limit) / 1e6 / rows, batch_size=rows)
+
+
+def write_benchmark(model, property_name, script, size, nodes, batch_size, byte_limit):
+    """
+        Times the creation of nodes through ingest() and deletes them again.
+
+        Payloads are made unique by a prefix that includes a random run identifier, so that they do not collide with
+        existing nodes or with each other after trimming.
+
+    :param model: The StructuredNode class to create
+    :param property_name: The uniquely indexed property that receives the payload
+    :param nodes: The number of nodes to create
+    :param batch_size: 0 for one save() per node, otherwise the number of nodes per UNWIND write
+    :return: A result dict. One operation is one node.
+    """
+    payload = make_payload(script, size)
+    run_prefix = u"benchmark-{} ".format(uuid.uuid4().hex)
+    records = (Record("benchmark", a_node, None, u"{}{} {}".format(run_prefix, a_node, payload))
+               for a_node in range(nodes))
+    writer = make_writer(model, property_name, batch_size)
+    started = time.perf_counter()
+    report = ingest(records, writer, byte_limit, 0)
+    elapsed = time.perf_counter() - started
+    neomodel.db.cypher_query("MATCH (n:{}) WHERE n.{} STARTS WITH {{prefix}} DETACH DELETE n".format(
+        model.__label__, property_name), {"prefix": run_prefix})
+    if report.failed:
+        raise RuntimeError("{} of {} benchmark nodes failed: {}".format(report.failed, nodes, report.errors[:1]))
+    return result_entry("write", script, len(payload.encode("utf-8")), elapsed / nodes, batch_size=batch_size,
+                        nodes_per_op=1)
+
+
+def environment():
+    """
+        Returns a description of the environment the benchmarks run in.
+    """
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {"revision": revision,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "neomodel": neomodel.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+
+def result_key(entry):
+    """
+        Returns what identifies a benchmark across result files.
+    """
+    return entry["benchmark"], entry["script"], entry["bytes"], entry.get("batch_size")
+
+
+def compare(baseline, results, threshold):
+    """
+        Lists the benchmarks that got slower than in a baseline.
+
+    :param baseline: A result document, as written by this script
+    :param results: A result document, as written by this script
+    :param threshold: The relative increase of us_per_op that counts as a regression (e.g. 0.1 for 10%)
+    :return: A list of (key, baseline us_per_op, current us_per_op) tuples
+    """
+    baseline_times = {result_key(an_entry): an_entry["us_per_op"] for an_entry in baseline["results"]}
+    regressions = []
+    for an_entry in results["results"]:
+        key = result_key(an_entry)
+        if key in baseline_times and an_entry["us_per_op"] > baseline_times[key] * (1 + threshold):
+            regressions.append((key, baseline_times[key], an_entry["us_per_op"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks trimming and node creation.")
+    parser.add_argument("--scripts", nargs="+", choices=sorted(SAMPLES), default=sorted(SAMPLES),
+                        help="Scripts of the payloads")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Payload sizes in bytes")
+    parser.add_argument("--byte-limit", type=int, default=DEFAULT_BYTE_LIMIT, help="Byte limit payloads are trimmed to")
+    parser.add_argument("--writes", action="store_true", help="Also benchmark node creation (needs a database)")
+    parser.add_argument("--local", action="store_true", help="Write to the in-process stand-in of local_neo4j.py")
+    parser.add_argument("--round-trip-latency", type=float, default=0.0,
+                        help="Seconds of simulated network latency per round trip with --local")
+    parser.add_argument("--nodes", type=int, default=1000, help="Nodes created by every write benchmark")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=DEFAULT_BATCH_SIZES,
+                        help="Batch sizes of the write benchmarks, 0 saves one node at a time")
+    parser.add_argument("--model", default="main_fix.SomeEntity", help="Node class to create, as module.ClassName")
+    parser.add_argument("--property", dest="property_name", default="payload", help="Property that holds the payload")
+    parser.add_argument("--host", default="localhost:7687", help="Neo4j bolt host and port")
+    parser.add_argument("--output", default=None, help="File to write the results to (default: standard output)")
+    parser.add_argument("--compare", default=None, help="Result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown reported as a regression by --compare")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "byte_limit": args.byte_limit, "results": []}
+    for an_entry in trim_benchmarks(args.scripts, args.sizes, args.byte_limit):
+        results["results"].append(an_entry)
+        sys.stderr.write("{benchmark:>12} {script:>6} {bytes:>9} bytes {us_per_op:>12.2f} us/op\n".format(**an_entry))
+
+    if args.writes:
+        local_database = None
+        if args.local:
+            local_database = LocalNeo4j(round_trip_latency=args.round_trip_latency).install()
+        elif not connect_from_environment(args.host):
+            sys.exit(1)
+        model = load_model(args.model)
+        if local_database is not None:
+            neomodel.install_labels(model)
+            results["environment"]["database"] = "local"
+        for a_script in args.scripts:
+            for a_size in args.sizes:
+                for a_batch_size in args.batch_sizes:
+                    an_entry = write_benchmark(model, args.property_name, a_script, a_size,
+                                               rows_for(a_size, args.nodes), a_batch_size, args.byte_limit)
+                    results["results"].append(an_entry)
+                    sys.stderr.write("{benchmark:>12} {script:>6} {bytes:>9} bytes {nodes_per_s:>12.1f} nodes/s "
+                                     "(batch size {batch_size})\n".format(**an_entry))
+        if local_database is not None:
+            results["local_database"] = local_database.stats()
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "wt") as fd:
+            json.dump(results, fd, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "rt") as fd:
+            regressions = compare(json.load(fd), results, args.threshold)
+        for a_key, baseline_time, current_time in regressions:
+            sys.stderr.write("REGRESSION: {} {:.2f} -> {:.2f} us/op\n".format(a_key, baseline_time, current_time))
+        if regressions:
+            sys.exit(1)
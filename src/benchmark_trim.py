@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Demonstrates that the cost of trim_string_at_unicode_boundaries depends on the byte limit and not on the size of the
+payload.
+
+For each payload size, the time per call of the current trimmer is compared against the original implementation
+that encoded the whole payload before checking the limit. The run fails (with exit status 1) if the time per call of
+the current trimmer on the largest payload exceeds MAX_GROWTH times its time on the smallest one, i.e. if trimming
+has become dependent on the size of the payload again.
+
+Usage: python benchmark_trim.py [byte_limit]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import timeit
+from trimming import trim_string_at_unicode_boundaries
+
+# Payload sizes, in bytes, that are timed.
+PAYLOAD_SIZES = [4 * 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+# The largest acceptable ratio of the time per call on the largest payload to that on the smallest one. The payloads
+# differ 2048 times in size, so a trimmer whose cost is proportional to the payload exceeds it by far, while timing
+# noise does not.
+MAX_GROWTH = 4.0
+
+
+def trim_string_full_encode(in_string, byte_limit):
+    """
+        The original trimming function, kept here as the baseline. It encodes the whole payload on every call.
+
+    :param in_string: Unicode input string
+    :param byte_limit: An integer representing the byte length limit to trim the string to
+    :return: A unicode in_string trimmed to the right length
+    """
+    encoded_in_string = bytearray(in_string, "utf-8")
+    if len(encoded_in_string) > byte_limit:
+        i = byte_limit
+        while i > 0 and not ((encoded_in_string[i] & 0xC0) != 0x80):
+            i = i-1
+        encoded_in_string = encoded_in_string[:i].decode("utf-8")
+    return encoded_in_string
+
+
+def time_per_call(trim_function, payload, byte_limit):
+    """
+        Returns the best observed time per call in microseconds.
+
+    :param trim_function: The trimming function to time
+    :param payload: The unicode payload to trim
+    :param byte_limit: An integer representing the byte length limit
+    :return: float
+    """
+    timer = timeit.Timer(lambda: trim_function(payload, byte_limit))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+if __name__ == "__main__":
+    byte_limit = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+
+    # Greek text takes two bytes per character, ASCII takes one.
+    samples = {"greek": u"Χαίρε Κόσμε, ", "ascii": u"Hello World, "}
+
+    sys.stdout.write("{:>8} {:>12} {:>16} {:>16}\n".format("script", "bytes", "trim (us/op)", "full (us/op)"))
+    regressions = []
+    for script_name, sample in samples.items():
+        trim_times = []
+        for payload_bytes in PAYLOAD_SIZES:
+            payload = sample * (payload_bytes // len(sample.encode("utf-8")))
+            assert trim_string_at_unicode_boundaries(payload, byte_limit) == \
+                trim_string_full_encode(payload, byte_limit)
+            trim_times.append(time_per_call(trim_string_at_unicode_boundaries, payload, byte_limit))
+            sys.stdout.write("{:>8} {:>12} {:>16.2f} {:>16.2f}\n".format(
+                script_name,
+                len(payload.encode("utf-8")),
+                trim_times[-1],
+                time_per_call(trim_string_full_encode, payload, byte_limit)))
+        if trim_times[-1] > MAX_GROWTH * trim_times[0]:
+            regressions.append("{}: {:.2f} us/op at {} bytes against {:.2f} us/op at {} bytes".format(
+                script_name, trim_times[-1], PAYLOAD_SIZES[-1], trim_times[0], PAYLOAD_SIZES[0]))
+    if regressions:
+        sys.stderr.write("ERROR: Trimming time grows with the payload size (more than {} times):\n".format(MAX_GROWTH))
+        for a_regression in regressions:
+            sys.stderr.write("    {}\n".format(a_regression))
+        sys.exit(1)
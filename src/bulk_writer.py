@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Batched creation of neomodel nodes through parameterised UNWIND queries.
+
+Instead of one transaction per node (StructuredNode.save()), rows are deflated client-side (which also generates the
+values of UniqueIdProperty and other defaulted properties) and sent in batches of N rows, each batch in a single
+transaction. If a batch fails, it is split in halves and each half is retried, until the rows that actually fail
+(e.g. on the index key size DatabaseError or a unique constraint) are isolated. This costs O(k log N) extra
+transactions for k failing rows instead of re-sending the whole batch one row at a time. Only errors that a row can
+cause split a batch. Transient errors (e.g. deadlocks) retry the whole batch with exponential backoff and anything
+else is raised.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import time
+import collections
+import neo4j
+import neomodel
+from metrics import METRICS
+from row_buffer import RowBuffer
+from lookup_cache import invalidate_rows
+
+# Number of rows sent per transaction by default.
+DEFAULT_BATCH_SIZE = 1000
+
+# The messages of the server errors that report an indexed value that is too long (see README.md).
+KEY_SIZE_MESSAGES = ("maximum supported length of indexed property value",)
+
+# Attempts of a batch that fails with a TransientError (e.g. a deadlock), and the wait before the first retry, which
+# doubles after every attempt.
+TRANSIENT_ATTEMPTS = 5
+TRANSIENT_BACKOFF = 0.1
+
+# A row that could not be created.
+# index: The position of the row in the rows passed to bulk_create
+# row: The row as passed to bulk_create
+# error: The exception raised for this row on its own
+BulkFailure = collections.namedtuple("BulkFailure", ["index", "row", "error"])
+
+
+class BulkResult(object):
+    """
+        The outcome of a bulk_create call.
+
+        written counts the nodes created. With merge_on, rows that matched an existing node are counted by matched.
+    """
+    def __init__(self):
+        self.written = 0
+        self.matched = 0
+        self.transactions = 0
+        self.failures = []
+
+
+def is_row_error(error):
+    """
+        Returns whether an error can be caused by a particular row, in which case a failing batch is split to find it.
+        Anything else (e.g. a syntax error, missing permissions or an unavailable server) is not a property of the
+        rows.
+
+    :param error: An exception raised while writing a batch
+    :return: bool
+    """
+    if isinstance(error, neomodel.ConstraintValidationFailed):
+        return True
+    if isinstance(error, neo4j.exceptions.ConstraintError):
+        return True
+    if isinstance(error, neo4j.exceptions.DatabaseError):
+        return any(a_message in str(error.message) for a_message in KEY_SIZE_MESSAGES)
+    return False
+
+
+def build_bulk_query(model, merge_on=None):
+    """
+        Returns the UNWIND query that creates (or merges) one node of model per row of the {rows} parameter.
+
+    :param model: A neomodel.StructuredNode class
+    :param merge_on: The name of a uniquely indexed property to MERGE on. If None, nodes are always CREATEd.
+    :return: str
+    """
+    labels = ":".join(model.inherited_labels())
+    if merge_on is None:
+        return "UNWIND {{rows}} AS row CREATE (n:{}) SET n = row".format(labels)
+    db_property = _merge_property(model, merge_on)
+    return "UNWIND {{rows}} AS row MERGE (n:{} {{{}: row.{}}}) ON CREATE SET n = row".format(
+        labels, db_property, db_property)
+
+
+def _merge_property(model, merge_on):
+    """
+        Returns the database name of the property to MERGE on, after checking that it is uniquely indexed.
+    """
+    merge_property = model.defined_properties(aliases=False, rels=False)[merge_on]
+    if not merge_property.unique_index:
+        raise ValueError("{}.{} is not uniquely indexed and cannot be used to MERGE on".format(
+            model.__name__, merge_on))
+    return merge_property.db_property or merge_on
+
+
+def build_existing_query(model, merge_on):
+    """
+        Returns the query that counts the nodes that already hold one of the values of the {keys} parameter, through
+        the unique index that rows are merged on.
+
+    :return: A tuple of the query and the database name of the property
+    """
+    db_property = _merge_property(model, merge_on)
+    return "UNWIND {{keys}} AS key MATCH (n:{}) WHERE n.{} = key RETURN count(n)".format(
+        model.__label__, db_property), db_property
+
+
+def _send_batch(query, batch, existing):
+    """
+        Sends a batch in one transaction, retrying it on transient errors.
+
+    :return: The number of rows that created a node
+    """
+    rows = [deflated_row for _, deflated_row in batch]
+    for an_attempt in range(TRANSIENT_ATTEMPTS):
+        try:
+            with neomodel.db.transaction:
+                if existing is None:
+                    neomodel.db.cypher_query(query, {"rows": rows})
+                    return len(rows)
+                existing_query, db_property = existing
+                keys = list({a_row.get(db_property) for a_row in rows if a_row.get(db_property) is not None})
+                results, _ = neomodel.db.cypher_query(existing_query, {"keys": keys})
+                neomodel.db.cypher_query(query, {"rows": rows})
+                return len(keys) - results[0][0]
+        except neo4j.exceptions.TransientError as e:
+            if METRICS.enabled:
+                METRICS.increment("transaction_errors", label=type(e).__name__)
+            if an_attempt == TRANSIENT_ATTEMPTS - 1:
+                raise
+            time.sleep(TRANSIENT_BACKOFF * 2 ** an_attempt)
+
+
+def _write_batch(query, batch, result, row_of, existing=None):
+    """
+        Writes a batch of deflated rows in one transaction, splitting it in halves if a row is at fault.
+
+    :param query: The query returned by build_bulk_query
+    :param batch: A list of (index, deflated_row) tuples
+    :param result: The BulkResult to update
+    :param row_of: A callable that returns the row at an index, for the rows that fail
+    :param existing: The tuple returned by build_existing_query, when rows are merged
+    :raises: Errors that are not caused by a row (see is_row_error), and TransientErrors that persist
+    """
+    if METRICS.enabled:
+        METRICS.increment("transactions")
+        started = time.perf_counter()
+    try:
+        result.transactions += 1
+        created = _send_batch(query, batch, existing)
+        result.written += created
+        result.matched += len(batch) - created
+        if METRICS.enabled:
+            METRICS.observe("transaction", time.perf_counter() - started)
+    except (neo4j.exceptions.CypherError, neomodel.ConstraintValidationFailed) as e:
+        if METRICS.enabled:
+            METRICS.observe("transaction", time.perf_counter() - started)
+            METRICS.increment("transaction_errors", label=type(e).__name__)
+        if not is_row_error(e):
+            raise
+        if len(batch) == 1:
+            index, _ = batch[0]
+            result.failures.append(BulkFailure(index, row_of(index), e))
+            return
+        middle = len(batch) // 2
+        _write_batch(query, batch[:middle], result, row_of, existing)
+        _write_batch(query, batch[middle:], result, row_of, existing)
+
+
+def _write_rows(model, query, rows, first_index, deflate, result, existing=None):
+    """
+        Deflates (if required) and writes the rows of one batch, and drops their values from the LookupCaches of
+        model.
+
+    :param model: A neomodel.StructuredNode class
+    :param query: The query returned by build_bulk_query
+    :param rows: A RowBuffer if deflate is True, otherwise a list of rows
+    :param first_index: The index of the first of rows in the rows passed to bulk_create
+    :param deflate: Whether rows are to be deflated
+    :param result: The BulkResult to update
+    """
+    if deflate:
+        valid_rows, errors = rows.deflate()
+        for a_position, an_error in errors:
+            result.failures.append(BulkFailure(first_index + a_position, rows.row(a_position), an_error))
+
+        def row_of(index):
+            return rows.row(index - first_index)
+    else:
+        valid_rows = list(enumerate(rows))
+
+        def row_of(index):
+            return rows[index - first_index]
+    if valid_rows:
+        _write_batch(query, [(first_index + a_position, a_row) for a_position, a_row in valid_rows], result, row_of,
+                     existing)
+        invalidate_rows(model, (a_row for _, a_row in valid_rows))
+
+
+def bulk_create(model, rows, batch_size=DEFAULT_BATCH_SIZE, merge_on=None, deflate=True):
+    """
+        Creates one node of model per row, batch_size rows per transaction.
+
+        Rows are collected per batch in a RowBuffer, which validates and deflates the whole batch at once, instead of
+        a model instance (or a StructuredNode.deflate call) per row.
+
+        NOTE: When rows within the same run collide on a unique index, the first one is created and the later ones
+              are reported as failures.
+
+    :param model: A neomodel.StructuredNode class
+    :param rows: An iterable of dicts of property values, keyed by property name
+    :param batch_size: The number of rows sent per transaction
+    :param merge_on: The name of a uniquely indexed property to MERGE on instead of always creating new nodes
+    :param deflate: Whether rows are deflated by the model. If False, rows already hold database values, keyed by
+                    database property name (e.g. as read back from the database), and are sent as they are.
+    :return: A BulkResult. The row of a failure is rebuilt from the property values of the model that it holds.
+    :raises: Errors that are not caused by a row, and TransientErrors that persist after TRANSIENT_ATTEMPTS
+    """
+    query = build_bulk_query(model, merge_on)
+    existing = build_existing_query(model, merge_on) if merge_on is not None else None
+    result = BulkResult()
+    batch = RowBuffer(model) if deflate else []
+    first_index = 0
+    for a_row in rows:
+        batch.append(a_row)
+        if len(batch) >= batch_size:
+            _write_rows(model, query, batch, first_index, deflate, result, existing)
+            first_index += len(batch)
+            batch.clear()
+    if len(batch):
+        _write_rows(model, query, batch, first_index, deflate, result, existing)
+    return result
+
+
+class BulkWriter(object):
+    """
+        An ingestion writer that buffers trimmed records and creates their nodes with bulk_create.
+    """
+    def __init__(self, model, property_name="payload", batch_size=DEFAULT_BATCH_SIZE, merge_on=None):
+        """
+            Initialises the writer.
+
+        :param model: The neomodel.StructuredNode class to create
+        :param property_name: The name of the property that receives the payload
+        :param batch_size: The number of rows sent per transaction
+        :param merge_on: The name of a uniquely indexed property to MERGE on
+        """
+        self.model = model
+        self.property_name = property_name
+        self.batch_size = batch_size
+        self.merge_on = merge_on
+        self.pending = []
+        # Called with the lists of records written and failed after every flush (see DeduplicatingWriter)
+        self.on_settled = None
+
+    def write(self, record, report):
+        """
+            Buffers a trimmed record, writing the buffer once it holds batch_size records.
+
+        :param record: A Record with a str payload
+        :param report: The IngestionReport to update
+        """
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush(report)
+
+    def flush(self, report):
+        """
+            Writes all buffered records.
+
+        :param report: The IngestionReport to update
+        """
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        result = bulk_create(self.model, ({self.property_name: a_record.payload} for a_record in records),
+                             self.batch_size, self.merge_on)
+        report.written += result.written
+        report.matched += result.matched
+        for a_failure in result.failures:
+            report.add_error(records[a_failure.index], a_failure.error)
+        if self.on_settled is not None:
+            failed_indexes = {a_failure.index for a_failure in result.failures}
+            self.on_settled([a_record for an_index, a_record in enumerate(records) if an_index not in failed_indexes],
+                            [records[an_index] for an_index in sorted(failed_indexes)])
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Checkpointed, resumable ingestion.
+
+A CheckpointingWriter wraps the writer of an ingestion run and appends a checkpoint to a journal file whenever every
+record handed to it so far has been settled, i.e. committed or reported as failed, which for a BulkWriter happens
+after every batch. A checkpoint holds the number of records settled and the input position just past the last of
+them. A run that is restarted with the same journal and inputs seeks straight to that position.
+
+The journal is a small, append-only text file:
+
+    # neomodlon checkpoint journal 1
+    S <source index> <size> <mtime_ns> <path>
+    C <records> <source index> <end offset>
+
+with an S line for every input file the first time it is checkpointed. Paths are journalled as absolute paths, so
+that a run can be resumed with its inputs given relative to another directory (or as ./data/x instead of data/x).
+Every line is appended with a single write (and fsync'ed), so a crash can at most leave a partial last line, which is
+ignored. A journal no longer matches its inputs if a checkpointed file has changed size or modification time, in
+which case resuming is refused.
+
+NOTE: Records are only ever skipped up to the last checkpoint, so a crash between a commit and its checkpoint re-sends
+      that batch. Unique constraints (or --merge-on) turn such repeats into reported failures instead of duplicates.
+      The memory of a Deduplicator is not part of the journal, unless it spills to a Bloom filter file.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import collections
+
+JOURNAL_HEADER = "# neomodlon checkpoint journal 1\n"
+
+# Records settled between checkpoints. A checkpoint is written at the first point after that where the wrapped writer
+# has nothing buffered.
+DEFAULT_CHECKPOINT_EVERY = 1000
+
+# The last checkpoint of a journal.
+# records: The number of records settled since the journal was started
+# source: The absolute path of the file that holds the last settled record
+# end: The byte offset just past the last settled record within source
+Checkpoint = collections.namedtuple("Checkpoint", ["records", "source", "end"])
+
+
+class JournalMismatch(Exception):
+    """
+        Raised when the inputs of a run are not those that a journal was written for.
+    """
+    pass
+
+
+def _file_identity(path):
+    status = os.stat(path)
+    return status.st_size, status.st_mtime_ns
+
+
+class Journal(object):
+    """
+        An append-only journal of checkpoints.
+    """
+    def __init__(self, path, sync=True):
+        """
+            Opens a journal, creating it if it does not exist, and reads its last checkpoint.
+
+        :param path: The path of the journal file
+        :param sync: Whether every checkpoint is fsync'ed before the run continues
+        """
+        self.path = path
+        self.sync = sync
+        self.sources = {}
+        self.last = None
+        self._identities = {}
+        if os.path.exists(path):
+            self._read()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            self._append(JOURNAL_HEADER)
+
+    def _read(self):
+        with open(self.path, "rt", encoding="utf-8") as fd:
+            content = fd.read()
+        if content and not content.startswith(JOURNAL_HEADER):
+            raise JournalMismatch("{} is not a checkpoint journal".format(self.path))
+        paths = {}
+        # A line without its newline was cut short by a crash and is ignored.
+        for a_line in content.split("\n")[:-1]:
+            if a_line.startswith("S "):
+                _, index, size, mtime_ns, source = a_line.split(" ", 4)
+                source = os.path.abspath(source)
+                paths[int(index)] = source
+                self.sources[source] = int(index)
+                self._identities[source] = (int(size), int(mtime_ns))
+            elif a_line.startswith("C "):
+                _, records, index, end = a_line.split(" ")
+                self.last = Checkpoint(int(records), paths[int(index)], int(end))
+
+    def _append(self, text):
+        os.write(self._fd, text.encode("utf-8"))
+        if self.sync:
+            os.fsync(self._fd)
+
+    def verify(self):
+        """
+            Checks that the files checkpointed so far have not changed since.
+
+        :raises JournalMismatch: If one of them has changed or is missing
+        """
+        for a_source, an_identity in self._identities.items():
+            try:
+                current_identity = _file_identity(a_source)
+            except OSError:
+                raise JournalMismatch("{} of journal {} no longer exists".format(a_source, self.path))
+            if current_identity != an_identity:
+                raise JournalMismatch("{} has changed since journal {} was written, delete the journal to start "
+                                      "over".format(a_source, self.path))
+
+    def checkpoint(self, records, source, end):
+        """
+            Appends a checkpoint.
+
+        :param records: The number of records settled since the journal was started
+        :param source: The path of the file that holds the last settled record
+        :param end: The byte offset just past the last settled record within source
+        """
+        source = os.path.abspath(source)
+        lines = []
+        if source not in self.sources:
+            self.sources[source] = len(self.sources)
+            self._identities[source] = _file_identity(source)
+            lines.append("S {} {} {} {}\n".format(self.sources[source], self._identities[source][0],
+                                                  self._identities[source][1], source))
+        lines.append("C {} {} {}\n".format(records, self.sources[source], end))
+        self._append("".join(lines))
+        self.last = Checkpoint(records, source, end)
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _has_pending(writer):
+    """
+        Returns whether a writer, or a writer that it wraps, holds records that have not been written yet.
+    """
+    while writer is not None:
+        if getattr(writer, "pending", None):
+            return True
+        writer = getattr(writer, "writer", None)
+    return False
+
+
+class CheckpointingWriter(object):
+    """
+        An ingestion writer that passes records on to another writer and checkpoints the records it has settled.
+    """
+    def __init__(self, writer, journal, every=DEFAULT_CHECKPOINT_EVERY):
+        """
+            Initialises the writer.
+
+        :param writer: The writer that receives the records (e.g. BulkWriter)
+        :param journal: The Journal to append checkpoints to
+        :param every: The number of records settled between checkpoints
+        """
+        self.writer = writer
+        self.journal = journal
+        self.every = every
+        self.records = journal.last.records if journal.last is not None else 0
+        self._last_record = None
+        self._checkpointed = self.records
+
+    def _checkpoint(self):
+        if self._last_record is not None and self.records > self._checkpointed:
+            self.journal.checkpoint(self.records, self._last_record.source, self._last_record.end)
+            self._checkpointed = self.records
+
+    def write(self, record, report):
+        """
+            Writes a trimmed record and checkpoints if enough records have been settled.
+
+        :param record: A Record with a str payload
+        :param report: The IngestionReport to update
+        """
+        self.writer.write(record, report)
+        self.records += 1
+        self._last_record = record._replace(payload=None)
+        if self.records - self._checkpointed >= self.every and not _has_pending(self.writer):
+            self._checkpoint()
+
+    def flush(self, report):
+        """
+            Flushes the wrapped writer and checkpoints everything written.
+
+        :param report: The IngestionReport to update
+        """
+        self.writer.flush(report)
+        self._checkpoint()
+
+
+def resume_point(journal):
+    """
+        Returns where the inputs of a journal are to be read from.
+
+    :param journal: A Journal
+    :return: None to read everything, or a (path, offset) tuple as accepted by ingestion.iter_records
+    :raises JournalMismatch: If a checkpointed file has changed
+    """
+    if journal.last is None:
+        return None
+    journal.verify()
+    return journal.last.source, journal.last.end
+
+
+def add_checkpoint_arguments(parser):
+    """
+        Adds the checkpoint options to a command line parser.
+
+    :param parser: An argparse.ArgumentParser
+    :return: parser
+    """
+    parser.add_argument("--checkpoint", default=None,
+                        help="Journal file of checkpoints. An existing journal resumes the run after its last one.")
+    parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                        help="Records settled between checkpoints")
+    parser.add_argument("--checkpoint-no-sync", dest="checkpoint_sync", action="store_false",
+                        help="Do not fsync the journal after every checkpoint")
+    return parser
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+Client-side detection of payloads that would collide on the unique index once trimmed.
+
+Every trimmed payload is reduced to a 16 byte digest. Digests are kept in an exact set until that set reaches its
+memory budget. From then on they are added to a Bloom filter held in a memory mapped file instead, which uses a
+fixed amount of memory however many payloads are seen and persists across runs. A payload found in the exact set is
+a certain duplicate. A payload found in the Bloom filter is a probable one (with the configured false positive rate).
+Either way, it is reported without ever being sent to the database. Only digests of payloads that the database has
+confirmed as written are kept, so payloads that failed, or were still buffered when a run stopped, are sent again
+by the next run.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import sys
+import math
+import mmap
+import struct
+import hashlib
+
+# Approximate memory taken by every digest in the exact set (the bytes object plus its set slot).
+BYTES_PER_EXACT_KEY = sys.getsizeof(bytes(16)) + 2 * struct.calcsize("P") * 2
+
+# Default memory budget of the exact set.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Outcomes of Deduplicator.check_and_reserve
+NEW = 0
+DUPLICATE = 1
+PROBABLE_DUPLICATE = 2
+
+# Header of a Bloom filter file: magic, number of bits, number of hash functions, number of keys added.
+_BLOOM_MAGIC = b"NMLBLOOM"
+_BLOOM_HEADER = struct.Struct("<8sQIQ")
+
+
+class DuplicatePayload(ValueError):
+    """
+        Raised (or reported) for a payload whose trimmed value has already been seen.
+    """
+    pass
+
+
+def key_digest(trimmed_payload):
+    """
+        Returns the 16 byte digest that identifies a trimmed payload.
+
+    :param trimmed_payload: Unicode string
+    :return: bytes
+    """
+    return hashlib.blake2b(trimmed_payload.encode("utf-8"), digest_size=16).digest()
+
+
+class BloomFilter(object):
+    """
+        A Bloom filter whose bits live in a memory mapped file.
+    """
+    def __init__(self, path, expected_items, false_positive_rate):
+        """
+            Opens the filter stored at path, or creates one sized for expected_items at false_positive_rate.
+
+        :param path: Path of the file backing the filter
+        :param expected_items: The number of keys the filter is sized for (ignored if the file exists)
+        :param false_positive_rate: The false positive rate at expected_items keys (ignored if the file exists)
+        """
+        if not os.path.exists(path) or not os.path.getsize(path):
+            bits = max(int(math.ceil(-expected_items * math.log(false_positive_rate) / (math.log(2) ** 2))), 64)
+            hashes = max(int(round(bits / expected_items * math.log(2))), 1)
+            with open(path, "wb") as fd:
+                fd.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, bits, hashes, 0))
+                fd.truncate(_BLOOM_HEADER.size + (bits + 7) // 8)
+        self._fd = open(path, "r+b")
+        self._map = mmap.mmap(self._fd.fileno(), 0)
+        magic, self.bits, self.hashes, self.count = _BLOOM_HEADER.unpack_from(self._map, 0)
+        if magic != _BLOOM_MAGIC:
+            raise ValueError("{} is not a Bloom filter file".format(path))
+
+    def _positions(self, digest):
+        """
+            Returns the bit positions of a digest, by double hashing its two halves.
+        """
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, digest):
+        """
+            Adds a digest to the filter.
+
+        :param digest: A 16 byte digest
+        :return: True if the digest may already have been in the filter, False if it certainly was not
+        """
+        present = True
+        for a_position in self._positions(digest):
+            byte_index = _BLOOM_HEADER.size + (a_position >> 3)
+            bit = 1 << (a_position & 7)
+            current = self._map[byte_index]
+            if not current & bit:
+                present = False
+                self._map[byte_index] = current | bit
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, digest):
+        return all(self._map[_BLOOM_HEADER.size + (p >> 3)] & (1 << (p & 7)) for p in self._positions(digest))
+
+    def close(self):
+        """
+            Writes the header and unmaps the file.
+        """
+        _BLOOM_HEADER.pack_into(self._map, 0, _BLOOM_MAGIC, self.bits, self.hashes, self.count)
+        self._map.flush()
+        self._map.close()
+        self._fd.close()
+
+
+def bloom_capacity(size_bytes, false_positive_rate):
+    """
+        Returns the number of keys that a Bloom filter of size_bytes bytes holds at false_positive_rate.
+    """
+    return max(int(size_bytes * 8 * math.log(2) ** 2 / -math.log(false_positive_rate)), 1)
+
+
+class Deduplicator(object):
+    """
+        Remembers the trimmed payloads seen so far, exactly up to a memory budget and approximately beyond it.
+
+        A payload is first reserved, while it is on its way to the database, and only remembered for good once it has
+        been confirmed as written. Payloads that fail, or are never flushed because the run stops, are released and
+        neither spill to the Bloom filter nor persist in its file.
+    """
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, spill_path=None, expected_items=None,
+                 false_positive_rate=1e-4):
+        """
+            Initialises the deduplicator. If spill_path already holds a Bloom filter from a previous run, the payloads
+            of that run are taken into account as well.
+
+        :param memory_budget: Bytes the exact set may use before it spills to the Bloom filter
+        :param spill_path: Path of the Bloom filter file. Without it the exact set keeps growing past the budget.
+        :param expected_items: Total number of payloads the Bloom filter is sized for. Defaults to as many as a filter
+                               of memory_budget bytes holds at false_positive_rate.
+        :param false_positive_rate: Probability that a new payload is reported as a probable duplicate once
+                                    expected_items payloads have been seen
+        """
+        self.max_exact_keys = max(memory_budget // BYTES_PER_EXACT_KEY, 1)
+        self.spill_path = spill_path
+        self.expected_items = expected_items if expected_items is not None else \
+            bloom_capacity(memory_budget, false_positive_rate)
+        self.false_positive_rate = false_positive_rate
+        self.exact_keys = set()
+        self.reserved_keys = set()
+        self.bloom = None
+        if spill_path is not None and os.path.exists(spill_path):
+            self._open_bloom()
+
+    def _open_bloom(self):
+        self.bloom = BloomFilter(self.spill_path, self.expected_items, self.false_positive_rate)
+
+    def spill(self):
+        """
+            Moves the exact set to the Bloom filter.
+        """
+        if self.spill_path is None:
+            return
+        if self.bloom is None:
+            self._open_bloom()
+        for a_digest in self.exact_keys:
+            self.bloom.add(a_digest)
+        self.exact_keys = set()
+
+    def check_and_reserve(self, trimmed_payload):
+        """
+            Tells whether a trimmed payload has been seen before and, if not, reserves it until it is confirmed or
+            released.
+
+        :param trimmed_payload: Unicode string, as it will be stored in the unique index
+        :return: A tuple of NEW, DUPLICATE or PROBABLE_DUPLICATE and the digest of the payload, which confirm() and
+                 release() take
+        """
+        digest = key_digest(trimmed_payload)
+        if digest in self.exact_keys or digest in self.reserved_keys:
+            return DUPLICATE, digest
+        if self.bloom is not None and digest in self.bloom:
+            return PROBABLE_DUPLICATE, digest
+        self.reserved_keys.add(digest)
+        return NEW, digest
+
+    def confirm(self, digest):
+        """
+            Remembers a reserved payload for good, once it has been written.
+
+        :param digest: The digest of the payload, as returned by check_and_reserve()
+        """
+        self.reserved_keys.discard(digest)
+        self.exact_keys.add(digest)
+        if len(self.exact_keys) >= self.max_exact_keys:
+            self.spill()
+
+    def release(self, digest):
+        """
+            Forgets a reserved payload that could not be written.
+
+        :param digest: The digest of the payload, as returned by check_and_reserve()
+        """
+        self.reserved_keys.discard(digest)
+
+    def close(self):
+        """
+            Persists the payloads confirmed as written to the Bloom filter file (if any), so that the next run takes
+            them into account. Payloads still reserved are dropped.
+        """
+        self.reserved_keys = set()
+        if self.spill_path is None:
+            return
+        self.spill()
+        self.bloom.close()
+        self.bloom = None
+
+
+class DeduplicatingWriter(object):
+    """
+        An ingestion writer that reports duplicate trimmed payloads and passes the rest on to another writer.
+    """
+    def __init__(self, writer, deduplicator):
+        """
+            Initialises the writer.
+
+        :param writer: The writer that receives payloads seen for the first time (e.g. BulkWriter). Its on_settled
+                       callback is set to confirm the payloads it writes and release those that fail.
+        :param deduplicator: A Deduplicator
+        """
+        self.writer = writer
+        self.deduplicator = deduplicator
+        # Digests of the records handed to the writer and not yet settled, keyed by id(record). The writer holds on to
+        # every such record until it settles it, so its id cannot be reused in the meantime.
+        self.pending_digests = {}
+        writer.on_settled = self._settled
+
+    def _settled(self, written_records, failed_records):
+        for a_record in written_records:
+            self.deduplicator.confirm(self.pending_digests.pop(id(a_record)))
+        for a_record in failed_records:
+            self.deduplicator.release(self.pending_digests.pop(id(a_record)))
+
+    def write(self, record, report):
+        """
+            Writes a trimmed record unless its payload has been seen before.
+
+        :param record: A Record with a str payload
+        :param report: The IngestionReport to update
+        """
+        outcome, digest = self.deduplicator.check_and_reserve(record.payload)
+        if outcome == DUPLICATE:
+            report.add_error(record, DuplicatePayload("Trimmed payload already ingested"))
+        elif outcome == PROBABLE_DUPLICATE:
+            report.add_error(record, DuplicatePayload("Trimmed payload probably already ingested"))
+        else:
+            self.pending_digests[id(record)] = digest
+            self.writer.write(record, report)
+
+    def flush(self, report):
+        """
+            Flushes the wrapped writer. The deduplicator is left open and has to be closed by its owner.
+
+        :param report: The IngestionReport to update
+        """
+        self.writer.flush(report)
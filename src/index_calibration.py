@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Calibration of the largest indexed string value that a server handles safely.
+
+The server's exceptions report a key size limit of 4095 bytes, but values somewhat shorter than that are accepted and
+then break the index (see main.py), so DEFAULT_BYTE_LIMIT is a guess with some margin. This script measures the
+actual limit instead. Every probe creates an index (or unique constraint) on a label of its own, waits for it to come
+online, writes two values of a given UTF-8 length, looks both up through the index (with a USING INDEX hint, so that
+a label scan cannot pass for a working index) and finally drops the index and the nodes. The largest length that
+passes is found by binary search, in O(log(high - low)) probes.
+
+The result is cached per server version (as reported by CALL dbms.components()) and kind of index, so that
+`--byte-limit auto` of the ingestion scripts can use it without probing the server again.
+
+NOTE: Probes that fail may leave the server's index machinery in a state that only dropping the index resolves. Run
+      the calibration against a throwaway database or the local stand-in, e.g.
+      python local_neo4j.py --key-value-size-cap 4047 index_calibration.py
+
+Usage: python index_calibration.py [--host host:port] [--kind index|constraint] [--character c] [--force]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import uuid
+import argparse
+import datetime
+import neo4j
+import neomodel
+from trimming import CALIBRATION_CACHE_PATH
+from ingestion import connect_from_environment, server_version
+from schema_sync import SchemaItem, schema_statement, read_cache, write_cache
+
+# The property that probes are written to.
+PROBE_PROPERTY = "key"
+
+# The range of lengths (in bytes) searched by default.
+DEFAULT_LOW = 1
+DEFAULT_HIGH = 32766
+
+
+class CalibrationError(Exception):
+    """
+        Raised when not even the shortest length of a search passes.
+    """
+    pass
+
+
+def probe_values(byte_length, character="a", count=2):
+    """
+        Returns distinct strings whose UTF-8 encoding is exactly byte_length bytes long.
+
+    :param byte_length: The length of every value in bytes
+    :param character: The character the values are made of. Whatever does not divide by its UTF-8 length is padded
+                      with ASCII.
+    :param count: The number of values (at most 10)
+    :return: A list of str
+    """
+    width = len(character.encode("utf-8"))
+    values = []
+    for a_number in range(count):
+        prefix = str(a_number)
+        remainder = byte_length - len(prefix)
+        values.append(prefix + character * (remainder // width) + "a" * (remainder % width))
+    return values
+
+
+def _drop_statement(item):
+    if item.kind == "index":
+        return "DROP INDEX ON :{}({})".format(item.label, item.property_name)
+    return "DROP CONSTRAINT ON (n:{}) ASSERT n.{} IS UNIQUE".format(item.label, item.property_name)
+
+
+def probe(byte_length, kind="constraint", character="a"):
+    """
+        Checks whether values of a given length can be written to, and read back through, a new index.
+
+    :param byte_length: The length of the values in bytes
+    :param kind: "index" or "constraint"
+    :param character: The character the values are made of
+    :return: True if both values were written and found, False if the server failed on either
+    """
+    item = SchemaItem(kind, "NeomodlonCalibration{}".format(uuid.uuid4().hex), PROBE_PROPERTY)
+    neomodel.db.cypher_query(schema_statement(item))
+    try:
+        neomodel.db.cypher_query("CALL db.awaitIndexes()")
+        values = probe_values(byte_length, character)
+        neomodel.db.cypher_query("UNWIND {{rows}} AS row CREATE (n:{}) SET n = row".format(item.label),
+                                 {"rows": [{PROBE_PROPERTY: a_value} for a_value in values]})
+        for a_value in values:
+            results, _ = neomodel.db.cypher_query("MATCH (n:{0}) USING INDEX n:{0}({1}) WHERE n.{1} = {{value}} "
+                                                  "RETURN id(n)".format(item.label, PROBE_PROPERTY),
+                                                  {"value": a_value})
+            if len(results) != 1:
+                return False
+        return True
+    except neo4j.exceptions.CypherError:
+        return False
+    finally:
+        # The index goes first, a damaged one may fail the deletion of its nodes.
+        try:
+            neomodel.db.cypher_query(_drop_statement(item))
+        except neo4j.exceptions.CypherError as e:
+            sys.stderr.write("WARNING: Could not drop the {} on :{}({}): {}\n".format(item.kind, item.label,
+                                                                                     item.property_name, e))
+        try:
+            neomodel.db.cypher_query("MATCH (n:{}) DETACH DELETE n".format(item.label))
+        except neo4j.exceptions.CypherError as e:
+            sys.stderr.write("WARNING: Could not delete the :{} nodes of the probe: {}\n".format(item.label, e))
+
+
+def calibrate(kind="constraint", character="a", low=DEFAULT_LOW, high=DEFAULT_HIGH, progress=None):
+    """
+        Finds the largest length that passes probe(), assuming that every shorter length passes too.
+
+    :param kind: "index" or "constraint"
+    :param character: The character the values are made of
+    :param low: The shortest length searched, which has to pass
+    :param high: The longest length searched
+    :param progress: An optional callable receiving (byte_length, passed) after every probe
+    :return: A tuple of the largest passing length and the number of probes
+    :raises CalibrationError: If low does not pass
+    """
+    probes = 0
+
+    def passes(byte_length):
+        nonlocal probes
+        probes += 1
+        passed = probe(byte_length, kind, character)
+        if progress is not None:
+            progress(byte_length, passed)
+        return passed
+
+    if not passes(low):
+        raise CalibrationError("Values of {} bytes already fail on a {}".format(low, kind))
+    # Invariant: good passes, bad does not (high + 1 is assumed not to).
+    good, bad = low, high + 1
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if passes(middle):
+            good = middle
+        else:
+            bad = middle
+    return good, probes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the largest safe indexed string length of a server.")
+    parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    parser.add_argument("--kind", choices=["index", "constraint"], default="constraint",
+                        help="The kind of index to calibrate (unique_index properties are backed by constraints)")
+    parser.add_argument("--character", default="a", help="The character that probe values are made of")
+    parser.add_argument("--low", type=int, default=DEFAULT_LOW, help="The shortest length searched, in bytes")
+    parser.add_argument("--high", type=int, default=DEFAULT_HIGH, help="The longest length searched, in bytes")
+    parser.add_argument("--cache", default=CALIBRATION_CACHE_PATH, help="File of the calibrated limits")
+    parser.add_argument("--force", action="store_true", help="Probe the server even if it has been calibrated")
+    args = parser.parse_args()
+    if len(args.character) != 1:
+        parser.error("--character expects a single character")
+
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+
+    version = server_version()
+    cache = read_cache(args.cache)
+    entry = cache.get(version, {}).get(args.kind)
+    if entry is not None and not args.force:
+        sys.stdout.write("{} byte limit of {}: {} (calibrated on {}).\n".format(
+            args.kind.capitalize(), version, entry["byte_limit"], entry["calibrated"]))
+        sys.exit(0)
+
+    def write_progress(byte_length, passed):
+        sys.stdout.write(" {} {} bytes\n".format("+" if passed else "!", byte_length))
+
+    try:
+        byte_limit, probes = calibrate(args.kind, args.character, args.low, args.high, write_progress)
+    except CalibrationError as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        sys.exit(1)
+    cache.setdefault(version, {})[args.kind] = {"byte_limit": byte_limit, "character": args.character,
+                                                "probes": probes,
+                                                "calibrated": datetime.datetime.now().isoformat(timespec="seconds")}
+    write_cache(args.cache, cache)
+    sys.stdout.write("{} byte limit of {}: {} ({} probes).\n".format(args.kind.capitalize(), version, byte_limit,
+                                                                     probes))
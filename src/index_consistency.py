@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+"""
+Checks that the indexes of a node class agree with its nodes, in parallel chunks of node ids.
+
+An index can disagree with the nodes it covers without anything failing at the time, e.g. after a node was given a
+value close to the key size limit (see main.py) or after `MATCH (a) DETACH DELETE a` (see main_file_based_fix.py),
+and the disagreement then only shows up as a failure of some later write. This script finds such states up front.
+
+The id space of the label is split into chunks that are checked by a pool of worker processes. A chunk is read a
+page of ids at a time (by id, so no chunk scans the whole label) and the values of every page are then looked up
+through each index (with a USING INDEX hint, so that a lookup never falls back to a label scan). Every page is a
+pair of short auto-commit reads, so millions of nodes are checked without one large transaction.
+
+Walking the nodes only reaches the entries of values that some node holds. The entries left behind by deleted nodes
+(e.g. by a `MATCH (a) DETACH DELETE a` that emptied the label) are reached through --keys instead, which looks the
+values of the ingestion input, trimmed as the ingestion scripts trim them, up through the index of --keys-property.
+
+The findings are:
+
+* missing: A node is not returned by a lookup of its own value through the index
+* stale: A lookup returns a node that does not hold the value looked up
+* duplicate: A lookup through a unique index returns more than one node
+* lookup_error: A lookup fails on the server. The keys responsible are isolated by splitting the lookup in halves.
+* near_limit: A string value is longer than --near-limit bytes (by default the byte limit that payloads are trimmed
+  to), so it was not written through trimming and is close to the key size limit
+
+Keys of --keys that no node holds are counted as absent, which is not a mismatch.
+
+Usage: python index_consistency.py [--model module.Class] [--property name ...] [--workers N] [--json]
+                                   [--keys path ... [--keys-format lines|jsonl|files] [--field name]
+                                    [--keys-property name] [--byte-limit N|auto]]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import json
+import argparse
+import itertools
+import collections
+import multiprocessing
+import neo4j
+import neomodel
+from trimming import DEFAULT_BYTE_LIMIT
+from ingestion import load_model, connect_from_environment, iter_records, trim_records, byte_limit_argument, \
+    resolve_byte_limit
+
+# Node ids per task of the worker pool.
+DEFAULT_CHUNK_SIZE = 100000
+
+# Node ids read (and values looked up) per query.
+DEFAULT_PAGE_SIZE = 1000
+
+# Keys of --keys per task of the worker pool.
+DEFAULT_KEYS_PER_TASK = 10000
+
+# Number of findings that are retained verbatim by a ConsistencyResult. All findings are still counted.
+MAX_REPORTED_FINDINGS = 100
+
+# Kinds of findings that mean that an index disagrees with the nodes.
+MISMATCHES = ("missing", "stale", "duplicate", "lookup_error")
+
+# A single finding.
+# kind: "missing", "stale", "duplicate", "lookup_error" or "near_limit"
+# node_id: The id of the node concerned (None for a key of --keys whose lookup fails)
+# property_name: The indexed property
+# value_bytes: The length of the value in UTF-8 bytes (None for values that are not strings)
+# detail: A short explanation
+Finding = collections.namedtuple("Finding", ["kind", "node_id", "property_name", "value_bytes", "detail"])
+
+# An indexed property.
+# name: The name of the property
+# db_property: The name of the property in the database
+# unique: Whether the index is a unique constraint
+IndexedProperty = collections.namedtuple("IndexedProperty", ["name", "db_property", "unique"])
+
+
+class ConsistencyResult(object):
+    """
+        Counts the nodes checked and the findings of one or more chunks.
+    """
+    def __init__(self):
+        self.nodes = 0
+        self.keys = 0
+        self.absent = 0
+        self.lookups = 0
+        self.unchecked = 0
+        self.counts = collections.Counter()
+        self.findings = []
+
+    def add(self, finding):
+        self.counts[finding.kind] += 1
+        if len(self.findings) < MAX_REPORTED_FINDINGS:
+            self.findings.append(finding)
+
+    def merge(self, other):
+        """
+            Adds the counts and (up to MAX_REPORTED_FINDINGS) findings of another result to this one.
+        """
+        self.nodes += other.nodes
+        self.keys += other.keys
+        self.absent += other.absent
+        self.lookups += other.lookups
+        self.unchecked += other.unchecked
+        self.counts.update(other.counts)
+        self.findings.extend(other.findings[:MAX_REPORTED_FINDINGS - len(self.findings)])
+
+    @property
+    def mismatches(self):
+        return sum(self.counts[a_kind] for a_kind in MISMATCHES)
+
+    def as_dict(self):
+        return {"nodes": self.nodes,
+                "keys": self.keys,
+                "absent": self.absent,
+                "lookups": self.lookups,
+                "unchecked": self.unchecked,
+                "counts": dict(self.counts),
+                "findings": [a_finding._asdict() for a_finding in self.findings]}
+
+    def write(self, stream):
+        """
+            Writes a human readable summary.
+
+        :param stream: A text stream
+        """
+        stream.write("Checked {} nodes and {} keys with {} lookups, {} mismatches.\n".format(
+            self.nodes, self.keys, self.lookups, self.mismatches))
+        for a_kind in MISMATCHES + ("near_limit",):
+            if self.counts[a_kind]:
+                stream.write("  {}: {}\n".format(a_kind, self.counts[a_kind]))
+        if self.absent:
+            stream.write("  keys that no node holds: {}\n".format(self.absent))
+        if self.unchecked:
+            stream.write("  not looked up after the index failed on every key: {}\n".format(self.unchecked))
+        for a_finding in self.findings:
+            stream.write("  {} node {} {} ({} bytes): {}\n".format(a_finding.kind, a_finding.node_id,
+                                                                a_finding.property_name, a_finding.value_bytes,
+                                                                a_finding.detail))
+
+
+def indexed_properties(model, names=None):
+    """
+        Returns the indexed and uniquely indexed properties of a node class.
+
+    :param model: A neomodel.StructuredNode class
+    :param names: Only return these properties (default: all indexed ones)
+    :return: A list of IndexedProperty
+    """
+    found = []
+    for a_name, a_property in model.defined_properties(aliases=False, rels=False).items():
+        if (a_property.index or a_property.unique_index) and (names is None or a_name in names):
+            found.append(IndexedProperty(a_name, a_property.db_property or a_name, a_property.unique_index))
+    return found
+
+
+def _value_bytes(value):
+    return len(value.encode("utf-8")) if isinstance(value, str) else None
+
+
+def _lookup(label, db_property, keys):
+    """
+        Looks keys up through an index, splitting the lookup in halves on failure.
+
+    :return: A tuple of the (key, node id, value) rows found, the (key, exception) pairs of the keys whose lookup
+             failed on its own, and the number of queries sent
+    """
+    query = "UNWIND {{keys}} AS key MATCH (n:{0}) USING INDEX n:{0}({1}) WHERE n.{1} = key " \
+            "RETURN key, id(n), n.{1}".format(label, db_property)
+    try:
+        results, _ = neomodel.db.cypher_query(query, {"keys": keys})
+        return results, [], 1
+    except neo4j.exceptions.CypherError as e:
+        if len(keys) == 1:
+            return [], [(keys[0], e)], 1
+        middle = len(keys) // 2
+        first_rows, first_errors, first_queries = _lookup(label, db_property, keys[:middle])
+        second_rows, second_errors, second_queries = _lookup(label, db_property, keys[middle:])
+        return first_rows + second_rows, first_errors + second_errors, 1 + first_queries + second_queries
+
+
+def _check_found(result, a_property, rows):
+    """
+        Records the stale and duplicate nodes among the rows returned by _lookup.
+
+    :return: A dict of the ids of the nodes found per key
+    """
+    found = collections.defaultdict(set)
+    for a_key, a_node_id, a_value in rows:
+        found[a_key].add(a_node_id)
+        if a_value != a_key:
+            result.add(Finding("stale", a_node_id, a_property.name, _value_bytes(a_key),
+                               "returned for a value that it does not hold"))
+    if a_property.unique:
+        for a_key, node_ids in found.items():
+            if len(node_ids) > 1:
+                result.add(Finding("duplicate", min(node_ids), a_property.name, _value_bytes(a_key),
+                                   "nodes {} share a uniquely indexed value".format(sorted(node_ids))))
+    return found
+
+
+def check_chunk(task):
+    """
+        Checks the nodes whose ids fall within one chunk. Runs in a worker process.
+
+    :param task: A tuple (label, properties, start, end, page_size, near_limit), covering the ids in [start, end)
+    :return: A ConsistencyResult
+    """
+    label, properties, start, end, page_size, near_limit = task
+    result = ConsistencyResult()
+    node_query = "UNWIND {{ids}} AS node_id MATCH (n:{}) WHERE id(n) = node_id RETURN id(n), {}".format(
+        label, ", ".join("n.{}".format(a_property.db_property) for a_property in properties))
+    unreadable = set()
+    for page_start in range(start, end, page_size):
+        nodes, _ = neomodel.db.cypher_query(node_query, {"ids": list(range(page_start, min(page_start + page_size,
+                                                                                           end)))})
+        result.nodes += len(nodes)
+        for a_column, a_property in enumerate(properties, 1):
+            holders = collections.defaultdict(list)
+            for a_node in nodes:
+                value = a_node[a_column]
+                if value is None:
+                    continue
+                holders[value].append(a_node[0])
+                value_bytes = _value_bytes(value)
+                if value_bytes is not None and value_bytes > near_limit:
+                    result.add(Finding("near_limit", a_node[0], a_property.name, value_bytes,
+                                       "longer than {} bytes".format(near_limit)))
+            if not holders:
+                continue
+            if a_property.name in unreadable:
+                result.unchecked += sum(len(node_ids) for node_ids in holders.values())
+                continue
+
+            keys = list(holders)
+            rows, errors, queries = _lookup(label, a_property.db_property, keys)
+            result.lookups += queries
+            found = _check_found(result, a_property, rows)
+            failed_keys = set()
+            for a_key, an_error in errors:
+                failed_keys.add(a_key)
+                result.add(Finding("lookup_error", holders[a_key][0], a_property.name, _value_bytes(a_key),
+                                   "{}: {}".format(type(an_error).__name__, an_error)))
+            for a_key, node_ids in holders.items():
+                if a_key in failed_keys:
+                    continue
+                for a_node_id in node_ids:
+                    if a_node_id not in found[a_key]:
+                        result.add(Finding("missing", a_node_id, a_property.name, _value_bytes(a_key),
+                                           "not found through the index"))
+            # An index that fails on every key is not worth splitting lookups for again.
+            if len(keys) > 1 and len(failed_keys) == len(keys):
+                unreadable.add(a_property.name)
+    return result
+
+
+def check_keys(task):
+    """
+        Looks a list of values up through an index, whether or not any node holds them. Runs in a worker process.
+
+    :param task: A tuple (label, a_property, keys, page_size)
+    :return: A ConsistencyResult
+    """
+    label, a_property, keys, page_size = task
+    result = ConsistencyResult()
+    for page_start in range(0, len(keys), page_size):
+        page = keys[page_start:page_start + page_size]
+        result.keys += len(page)
+        rows, errors, queries = _lookup(label, a_property.db_property, page)
+        result.lookups += queries
+        found = _check_found(result, a_property, rows)
+        for a_key, an_error in errors:
+            result.add(Finding("lookup_error", None, a_property.name, _value_bytes(a_key),
+                               "{}: {}".format(type(an_error).__name__, an_error)))
+        result.absent += len(page) - len(errors) - len(found)
+        # An index that fails on every key is not worth splitting lookups for again.
+        if len(page) > 1 and len(errors) == len(page):
+            result.unchecked += len(keys) - page_start - len(page)
+            break
+    return result
+
+
+def _run_task(task):
+    """
+        Runs a task of check_chunk or check_keys.
+
+    :param task: A tuple of the function and its task
+    """
+    function, arguments = task
+    return function(arguments)
+
+
+def iter_keys(records, byte_limit):
+    """
+        Yields the payloads of records as the ingestion scripts write them, trimmed to byte_limit.
+
+    :param records: An iterable of Records (see ingestion.iter_records)
+    :param byte_limit: An integer representing the byte length limit
+    :return: A generator of str
+    """
+    for record, _ in trim_records(records, byte_limit):
+        if isinstance(record.payload, str):
+            yield record.payload
+
+
+def make_key_tasks(label, a_property, keys, keys_per_task=DEFAULT_KEYS_PER_TASK, page_size=DEFAULT_PAGE_SIZE):
+    """
+        Splits keys into check_keys tasks, without the keys repeated within a task.
+
+    :return: A generator of task tuples for check_keys
+    """
+    keys = iter(keys)
+    while True:
+        some_keys = list(dict.fromkeys(itertools.islice(keys, keys_per_task)))
+        if not some_keys:
+            return
+        yield label, a_property, some_keys, page_size
+
+
+def highest_id(label):
+    """
+        Returns the highest node id of a label, or None if it has no nodes.
+    """
+    results, _ = neomodel.db.cypher_query("MATCH (n:{}) RETURN id(n) ORDER BY id(n) DESC LIMIT 1".format(label))
+    return results[0][0] if results else None
+
+
+def make_tasks(label, properties, last_id, chunk_size=DEFAULT_CHUNK_SIZE, page_size=DEFAULT_PAGE_SIZE,
+               near_limit=DEFAULT_BYTE_LIMIT):
+    """
+        Splits the ids up to last_id into check tasks.
+
+    :return: A generator of task tuples for check_chunk
+    """
+    for start in range(0, last_id + 1, chunk_size):
+        yield label, properties, start, min(start + chunk_size, last_id + 1), page_size, near_limit
+
+
+def check(model, names=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, page_size=DEFAULT_PAGE_SIZE,
+          near_limit=DEFAULT_BYTE_LIMIT, host="localhost:7687", progress=None, keys=None, keys_property="payload"):
+    """
+        Checks the indexes of a node class in parallel.
+
+    :param model: A neomodel.StructuredNode class
+    :param names: Only check these properties (default: all indexed ones)
+    :param workers: The number of worker processes (defaults to the number of CPUs, 0 checks in this process)
+    :param chunk_size: Node ids per task
+    :param page_size: Node ids read per query
+    :param near_limit: String values longer than this many bytes are reported as near the key size limit
+    :param host: The host:port of the Neo4j server that the workers connect to
+    :param progress: An optional callable that receives the ConsistencyResult so far after every chunk
+    :param keys: An optional iterable of values (e.g. returned by iter_keys) to look up through the index of
+                 keys_property, whether or not any node holds them
+    :param keys_property: The indexed property that keys are values of
+    :return: A ConsistencyResult
+    """
+    result = ConsistencyResult()
+    properties = indexed_properties(model, names)
+    last_id = highest_id(model.__label__)
+    tasks = iter(())
+    if properties and last_id is not None:
+        tasks = ((check_chunk, a_task) for a_task in make_tasks(model.__label__, properties, last_id, chunk_size,
+                                                                 page_size, near_limit))
+    if keys is not None:
+        keys_properties = indexed_properties(model, [keys_property])
+        if not keys_properties:
+            raise ValueError("{}.{} is not indexed".format(model.__name__, keys_property))
+        tasks = itertools.chain(tasks, ((check_keys, a_task) for a_task in make_key_tasks(
+            model.__label__, keys_properties[0], keys, page_size=page_size)))
+    if workers == 0:
+        chunk_results = map(_run_task, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, connect_from_environment, (host,))
+        chunk_results = pool.imap_unordered(_run_task, tasks)
+    try:
+        for a_result in chunk_results:
+            result.merge(a_result)
+            if progress is not None:
+                progress(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that the indexes of a node class agree with its nodes.")
+    parser.add_argument("--model", default="main_fix.SomeEntity", help="The node class to check (module.Class)")
+    parser.add_argument("--property", dest="properties", action="append", default=None,
+                        help="An indexed property to check (repeatable, default: all of them)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes (0 checks in this process)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Node ids per task")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="Node ids read per query")
+    parser.add_argument("--near-limit", type=int, default=DEFAULT_BYTE_LIMIT,
+                        help="Report string values longer than this many bytes")
+    parser.add_argument("--keys", action="append", default=None,
+                        help="A file or directory of the ingestion input, whose values are looked up through the index "
+                             "(repeatable)")
+    parser.add_argument("--keys-format", choices=["lines", "jsonl", "files"], default="lines",
+                        help="One payload per line, one JSON object per line or one payload per file")
+    parser.add_argument("--field", default="payload", help="The payload field of JSONL keys")
+    parser.add_argument("--keys-property", default="payload", help="The indexed property that --keys are values of")
+    parser.add_argument("--byte-limit", type=byte_limit_argument, default=DEFAULT_BYTE_LIMIT,
+                        help="Byte limit that --keys are trimmed to, or auto for the limit calibrated for the server")
+    parser.add_argument("--json", action="store_true", help="Write the result as JSON")
+    parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    args = parser.parse_args()
+
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+
+    def write_progress(result):
+        sys.stderr.write("\rChecked {} nodes and {} keys, {} mismatches.".format(result.nodes, result.keys,
+                                                                                result.mismatches))
+
+    model = load_model(args.model)
+    unknown = set(args.properties or ()) - {a_property.name for a_property in indexed_properties(model)}
+    if unknown:
+        parser.error("not indexed properties of {}: {}".format(model.__name__, ", ".join(sorted(unknown))))
+    keys = None
+    if args.keys is not None:
+        if args.keys_property not in {a_property.name for a_property in indexed_properties(model)}:
+            parser.error("--keys-property {} is not an indexed property of {}".format(args.keys_property,
+                                                                                    model.__name__))
+        keys = iter_keys(iter_records(args.keys, args.keys_format, args.field),
+                         resolve_byte_limit(args.byte_limit, model, args.keys_property))
+    result = check(model, args.properties, args.workers, args.chunk_size, args.page_size, args.near_limit, args.host,
+                   write_progress, keys, args.keys_property)
+    sys.stderr.write("\n")
+    if args.json:
+        json.dump(result.as_dict(), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        result.write(sys.stdout)
+    sys.exit(1 if result.mismatches else 0)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+A string property that can be (uniquely) indexed no matter how long its value is.
+
+The full text of an IndexSafeStringProperty is stored unindexed. Its index (or unique index) is placed on a companion
+property that holds a fixed-length digest of the text (optionally preceded by a trimmed prefix of the text). Index
+keys are then always 32 bytes long, which keeps index pages dense and removes the key size failure mode described in
+README.md altogether.
+
+Example:
+
+    class SomeEntity(IndexSafeNode):
+        serial_num = neomodel.UniqueIdProperty()
+        payload = IndexSafeStringProperty(unique_index=True)
+
+stores the text in `payload` and its digest in a uniquely indexed `payload_key`. Lookups such as
+`SomeEntity.nodes.get(payload=some_text)` are rewritten to `payload_key=digest_key(some_text)` and go through the index.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import hashlib
+import neomodel
+from neomodel.core import NodeMeta
+from neomodel.match import NodeSet
+from neomodel.util import classproperty
+from trimming import trim_string_at_unicode_boundaries
+
+# Size of the digest in bytes. Its hexadecimal form, which is what gets indexed, is twice as long.
+DIGEST_SIZE = 16
+
+# Separates the trimmed prefix from the digest in keys that carry a prefix.
+KEY_SEPARATOR = u"#"
+
+
+def digest_key(value, prefix_bytes=0):
+    """
+        Returns the index key of a string value.
+
+    :param value: Unicode string
+    :param prefix_bytes: If greater than zero, the key starts with the value trimmed to this many bytes
+    :return: A unicode string of 2 * DIGEST_SIZE hexadecimal characters, optionally preceded by a prefix and a separator
+    """
+    if value is None:
+        return None
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=DIGEST_SIZE).hexdigest()
+    if prefix_bytes > 0:
+        return trim_string_at_unicode_boundaries(value, prefix_bytes) + KEY_SEPARATOR + digest
+    return digest
+
+
+class IndexSafeStringProperty(neomodel.StringProperty):
+    """
+        A string property whose index or unique index is placed on a digest of its value rather than on the value.
+    """
+    def __init__(self, unique_index=False, index=False, prefix_bytes=0, key_name=None, **kwargs):
+        """
+            Initialises the property.
+
+        :param unique_index: Whether the digest key is uniquely indexed
+        :param index: Whether the digest key is indexed
+        :param prefix_bytes: Length in bytes of the trimmed prefix of the value that precedes the digest in the key
+        :param key_name: The name of the digest key property. Defaults to the name of this property with "_key" appended.
+        """
+        if unique_index and index:
+            raise ValueError("The arguments `unique_index` and `index` are mutually exclusive.")
+        # A unique key cannot be computed from a missing value.
+        if unique_index and kwargs.get("default") is None:
+            kwargs["required"] = True
+        super(IndexSafeStringProperty, self).__init__(**kwargs)
+        self.key_unique_index = unique_index
+        self.key_index = index
+        self.prefix_bytes = prefix_bytes
+        self.key_name = key_name
+
+
+class DigestKeyProperty(neomodel.StringProperty):
+    """
+        The indexed companion of an IndexSafeStringProperty. Its value is always derived from the source property.
+    """
+    def __init__(self, source, prefix_bytes=0, **kwargs):
+        """
+            Initialises the property.
+
+        :param source: The name of the IndexSafeStringProperty this key is derived from
+        :param prefix_bytes: Length in bytes of the trimmed prefix of the value that precedes the digest
+        """
+        super(DigestKeyProperty, self).__init__(**kwargs)
+        self.source = source
+        self.prefix_bytes = prefix_bytes
+
+    def key_of(self, value):
+        """
+            Returns the key of a value of the source property.
+
+        :param value: Unicode string or None
+        :return: Unicode string or None
+        """
+        return digest_key(value, self.prefix_bytes)
+
+
+class IndexSafeNodeMeta(NodeMeta):
+    """
+        Adds a DigestKeyProperty for every IndexSafeStringProperty declared on a node class.
+    """
+    def __new__(mcs, name, bases, namespace):
+        for key, value in list(namespace.items()):
+            if isinstance(value, IndexSafeStringProperty):
+                key_name = value.key_name or key + "_key"
+                value.key_name = key_name
+                if key_name in namespace:
+                    raise ValueError("{}.{} conflicts with the digest key of {}.{}".format(name, key_name, name, key))
+                namespace[key_name] = DigestKeyProperty(key, value.prefix_bytes,
+                                                        unique_index=value.key_unique_index, index=value.key_index)
+        return super(IndexSafeNodeMeta, mcs).__new__(mcs, name, bases, namespace)
+
+
+class IndexSafeNodeSet(NodeSet):
+    """
+        A NodeSet that looks up IndexSafeStringProperty values through their digest keys.
+
+        NOTE: Only equality (`name=`, `name__exact=`) and `name__in=` keyword filters are rewritten. Other operators
+              (e.g. `name__contains=`) and Q objects are evaluated against the unindexed full text.
+    """
+    def _rewrite(self, kwargs):
+        """
+            Replaces equality filters on IndexSafeStringProperties by equality filters on their keys.
+        """
+        rewritten = {}
+        for key, value in kwargs.items():
+            name, _, operator = key.partition("__")
+            a_property = getattr(self.source_class, name, None)
+            if isinstance(a_property, IndexSafeStringProperty) and operator in ("", "exact"):
+                rewritten[a_property.key_name] = digest_key(value, a_property.prefix_bytes)
+            elif isinstance(a_property, IndexSafeStringProperty) and operator == "in":
+                rewritten[a_property.key_name + "__in"] = [digest_key(v, a_property.prefix_bytes) for v in value]
+            else:
+                rewritten[key] = value
+        return rewritten
+
+    def filter(self, *args, **kwargs):
+        return super(IndexSafeNodeSet, self).filter(*args, **self._rewrite(kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return super(IndexSafeNodeSet, self).exclude(*args, **self._rewrite(kwargs))
+
+
+class IndexSafeNode(neomodel.StructuredNode, metaclass=IndexSafeNodeMeta):
+    """
+        Base class for nodes with IndexSafeStringProperties. Keeps their digest keys in step with their values.
+    """
+    __abstract_node__ = True
+
+    @classproperty
+    def nodes(cls):
+        """
+            Returns an IndexSafeNodeSet of all nodes of the class' label.
+
+        :return: IndexSafeNodeSet
+        """
+        return IndexSafeNodeSet(cls)
+
+    @classmethod
+    def digest_keys(cls):
+        """
+            Returns the (name, DigestKeyProperty) pairs of the class.
+
+        :return: list
+        """
+        return [(name, a_property) for name, a_property in cls.defined_properties(aliases=False, rels=False).items()
+                if isinstance(a_property, DigestKeyProperty)]
+
+    @classmethod
+    def derive_row_values(cls, row):
+        """
+            Returns a copy of a row of property values with every digest key derived from its source. RowBuffer calls
+            it for every row appended, so bulk writes derive the keys as well.
+
+        :param row: A dict of property values, keyed by property name
+        :return: dict
+        """
+        row = dict(row)
+        for name, a_key in cls.digest_keys():
+            row[name] = a_key.key_of(row.get(a_key.source))
+        return row
+
+    @classmethod
+    def deflate(cls, properties, obj=None, skip_empty=False):
+        """
+            Deflates properties after deriving every digest key from its source, which covers save(). bulk_create()
+            does not call deflate() for models like this one, but derives the keys through derive_row_values().
+        """
+        return super(IndexSafeNode, cls).deflate(cls.derive_row_values(properties), obj, skip_empty)
+
+    def save(self):
+        """
+            Refreshes the digest keys of the instance and saves it.
+
+        :return: the node instance
+        """
+        for name, a_key in self.digest_keys():
+            setattr(self, name, a_key.key_of(getattr(self, a_key.source)))
+        return super(IndexSafeNode, self).save()
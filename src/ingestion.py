@@ -0,0 +1,648 @@
+#!/usr/bin/env python
+"""
+Streaming ingestion of payloads from line-delimited text files, JSONL files or directories of files.
+
+Records are read lazily (through buffered readers or memory maps), trimmed to the byte limit and handed to a writer
+one at a time, so memory use does not grow with the size of the corpus. An optional read-ahead buffer reads and
+trims records on a background thread while the writer is waiting on the database.
+
+Usage: python ingestion.py [--format lines|jsonl|files] [--mmap] [--read-ahead N] path [path ...]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import os
+import io
+import mmap
+import json
+import time
+import queue
+import argparse
+import importlib
+import threading
+import collections
+import neo4j
+import neomodel
+from trimming import (DEFAULT_BYTE_LIMIT, trim_string_at_unicode_boundaries, trim_bytes_at_unicode_boundaries,
+                      calibrated_byte_limit)
+from bulk_writer import DEFAULT_BATCH_SIZE, BulkWriter
+from dedup import DEFAULT_MEMORY_BUDGET, Deduplicator, DeduplicatingWriter
+from metrics import METRICS, MetricsWriter
+from profiling import add_profiling_arguments, profiling_settings, start_profiling, stop_profiling
+from checkpoint import Journal, CheckpointingWriter, JournalMismatch, add_checkpoint_arguments, resume_point
+
+# Size of the buffer used by the buffered (non mmap) readers.
+DEFAULT_BUFFER_SIZE = io.DEFAULT_BUFFER_SIZE * 128
+
+# Number of trimmed records that may be waiting for the writer.
+DEFAULT_READ_AHEAD = 1024
+
+# Number of error examples that are retained verbatim by an IngestionReport. All errors are still counted.
+MAX_REPORTED_ERRORS = 100
+
+# A single input record.
+# source: The path the record was read from
+# offset: Byte offset of the start of the record within source
+# end: Byte offset just past the record (and its line terminator) within source
+# payload: The payload as str, bytes or memoryview. Memoryviews are only valid until the next record is requested.
+Record = collections.namedtuple("Record", ["source", "offset", "end", "payload"])
+
+
+class IngestionReport(object):
+    """
+        Counts what happened to the records of an ingestion run.
+    """
+    def __init__(self):
+        self.read = 0
+        self.trimmed = 0
+        self.written = 0
+        # Records that were merged into an existing node (see --merge-on) instead of creating one
+        self.matched = 0
+        self.failed = 0
+        self.errors_by_class = collections.Counter()
+        self.errors = []
+
+    def add_error(self, record, error):
+        """
+            Records the failure of a single record.
+
+        :param record: The Record that failed
+        :param error: The exception raised while processing it
+        """
+        self.failed += 1
+        self.errors_by_class[type(error).__name__] += 1
+        if METRICS.enabled:
+            METRICS.count_error(error)
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((record.source, record.offset, "{}: {}".format(type(error).__name__, error)))
+
+    def merge(self, other):
+        """
+            Adds the counts of another report to this one.
+
+        :param other: An IngestionReport
+        :return: self
+        """
+        self.read += other.read
+        self.trimmed += other.trimmed
+        self.written += other.written
+        self.matched += other.matched
+        self.failed += other.failed
+        self.errors_by_class.update(other.errors_by_class)
+        self.errors.extend(other.errors[:MAX_REPORTED_ERRORS - len(self.errors)])
+        return self
+
+    def write(self, stream):
+        """
+            Writes a human readable summary of the report to a stream.
+
+        :param stream: A text stream (e.g. sys.stderr)
+        """
+        stream.write("Read {}, trimmed {}, written {}, matched {}, failed {}.\n".format(
+            self.read, self.trimmed, self.written, self.matched, self.failed))
+        for error_class, count in self.errors_by_class.most_common():
+            stream.write("    {}: {}\n".format(error_class, count))
+        for source, offset, message in self.errors:
+            stream.write("    {}@{}: {}\n".format(source, offset, message))
+
+
+def iter_lines(path, buffer_size=DEFAULT_BUFFER_SIZE, start=0):
+    """
+        Yields one Record per non-empty line of a file, through a buffered reader.
+
+    :param path: Path to a UTF-8 text file with one payload per line
+    :param buffer_size: Size of the read buffer in bytes
+    :param start: Byte offset of the first line to read (the start of a line)
+    :return: A generator of Records with bytes payloads
+    """
+    with open(path, "rb", buffering=buffer_size) as fd:
+        fd.seek(start)
+        offset = start
+        for line in fd:
+            end = offset + len(line)
+            payload = line.rstrip(b"\r\n")
+            if payload:
+                yield Record(path, offset, end, payload)
+            offset = end
+
+
+def iter_mmap_lines(path, start=0):
+    """
+        Yields one Record per non-empty line of a file, as memoryviews over a memory map of the file.
+
+    :param path: Path to a UTF-8 text file with one payload per line
+    :param start: Byte offset of the first line to read (the start of a line)
+    :return: A generator of Records with memoryview payloads
+    """
+    with open(path, "rb") as fd:
+        if not os.fstat(fd.fileno()).st_size:
+            return
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                size = len(mapped)
+                offset = start
+                while offset < size:
+                    newline = mapped.find(b"\n", offset)
+                    end = size if newline == -1 else newline + 1
+                    stop = size if newline == -1 else newline
+                    if stop > offset and view[stop - 1] == 0x0D:
+                        stop -= 1
+                    if stop > offset:
+                        yield Record(path, offset, end, view[offset:stop])
+                    offset = end
+            finally:
+                view.release()
+
+
+def iter_jsonl(path, field="payload", buffer_size=DEFAULT_BUFFER_SIZE, start=0):
+    """
+        Yields one Record per line of a JSONL file, with the payload taken from one field of each object.
+
+    :param path: Path to a UTF-8 JSONL file
+    :param field: The name of the field that holds the payload
+    :param buffer_size: Size of the read buffer in bytes
+    :param start: Byte offset of the first line to read (the start of a line)
+    :return: A generator of Records with str payloads (None if the field is missing). The payload of a line that is
+             not a JSON object, or whose field is not a string, is the exception describing it, so that it is
+             reported as a failed record.
+    """
+    for record in iter_lines(path, buffer_size, start):
+        try:
+            an_object = json.loads(record.payload.decode("utf-8"))
+        except ValueError as e:
+            yield record._replace(payload=ValueError("Malformed JSON: {}".format(e)))
+            continue
+        if not isinstance(an_object, dict):
+            yield record._replace(payload=TypeError("Expected a JSON object, not {}".format(type(an_object).__name__)))
+            continue
+        payload = an_object.get(field)
+        if payload is not None and not isinstance(payload, str):
+            payload = TypeError("Field {} holds {}, not a string".format(field, type(payload).__name__))
+        yield record._replace(payload=payload)
+
+
+def iter_file(path, start=0):
+    """
+        Yields a single Record holding the whole content of a file, as a memoryview over a memory map of the file.
+
+    :param path: Path to a UTF-8 file that holds one payload
+    :param start: 0, or the size of the file to skip it
+    :return: A generator of one Record
+    """
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if not size or start >= size:
+            return
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield Record(path, 0, size, view)
+            finally:
+                view.release()
+
+
+def iter_paths(paths):
+    """
+        Expands a list of files and directories to a sorted list of files.
+
+    :param paths: A list of paths to files or directories
+    :return: A generator of file paths
+    """
+    for a_path in paths:
+        if os.path.isdir(a_path):
+            for root, dirs, files in os.walk(a_path):
+                dirs.sort()
+                for a_file in sorted(files):
+                    yield os.path.join(root, a_file)
+        else:
+            yield a_path
+
+
+def iter_records(paths, input_format="lines", field="payload", use_mmap=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                 start=None):
+    """
+        Yields the records of a list of files and directories.
+
+    :param paths: A list of paths to files or directories
+    :param input_format: "lines" (one payload per line), "jsonl" (one object per line) or "files" (one payload per file)
+    :param field: The payload field of "jsonl" input
+    :param use_mmap: Whether "lines" input is memory mapped instead of read through a buffer
+    :param buffer_size: Size of the read buffer in bytes
+    :param start: An optional (path, offset) tuple. The files before path are skipped and path is read from offset on.
+                  Paths are compared as absolute paths.
+    :return: A generator of Records
+    """
+    start_path, start_offset = start if start is not None else (None, 0)
+    if start_path is not None:
+        start_path = os.path.abspath(start_path)
+    for a_path in iter_paths(paths):
+        if start_path is not None:
+            if os.path.abspath(a_path) != start_path:
+                continue
+            start_path = None
+        if input_format == "files":
+            records = iter_file(a_path, start_offset)
+        elif input_format == "jsonl":
+            records = iter_jsonl(a_path, field, buffer_size, start_offset)
+        elif use_mmap:
+            records = iter_mmap_lines(a_path, start_offset)
+        else:
+            records = iter_lines(a_path, buffer_size, start_offset)
+        start_offset = 0
+        yield from records
+    if start_path is not None:
+        raise ValueError("{} to resume from is not among the inputs".format(start_path))
+
+
+def trim_payload(payload, byte_limit):
+    """
+        Trims a str or UTF-8 buffer payload to byte_limit bytes and returns it as str.
+
+    :param payload: A str or a bytes-like object holding UTF-8
+    :param byte_limit: An integer representing the byte length limit to trim the payload to
+    :return: A tuple of the trimmed unicode payload and whether trimming took place
+    """
+    if METRICS.enabled:
+        return _measured_trim_payload(payload, byte_limit)
+    if isinstance(payload, str):
+        trimmed_payload = trim_string_at_unicode_boundaries(payload, byte_limit)
+        return trimmed_payload, len(trimmed_payload) != len(payload)
+    view = trim_bytes_at_unicode_boundaries(payload, byte_limit)
+    was_trimmed = len(view) != len(payload)
+    return str(view, "utf-8"), was_trimmed
+
+
+def _measured_trim_payload(payload, byte_limit):
+    """
+        trim_payload() that also records its latency and the payload bytes before and after trimming in METRICS.
+    """
+    started = time.perf_counter()
+    if isinstance(payload, str):
+        trimmed_payload = trim_string_at_unicode_boundaries(payload, byte_limit)
+        elapsed = time.perf_counter() - started
+        was_trimmed = len(trimmed_payload) != len(payload)
+        # Encoding is only needed for the byte counts, so it is not part of the trim latency.
+        bytes_before = len(payload.encode("utf-8"))
+        bytes_after = len(trimmed_payload.encode("utf-8")) if was_trimmed else bytes_before
+    else:
+        view = trim_bytes_at_unicode_boundaries(payload, byte_limit)
+        trimmed_payload = str(view, "utf-8")
+        elapsed = time.perf_counter() - started
+        was_trimmed = len(view) != len(payload)
+        bytes_before, bytes_after = len(payload), len(view)
+    METRICS.observe("trim", elapsed)
+    METRICS.count_payload(bytes_before, bytes_after)
+    return trimmed_payload, was_trimmed
+
+
+def trim_records(records, byte_limit):
+    """
+        Replaces the payload of each record by its trimmed unicode form.
+
+    :param records: An iterable of Records
+    :param byte_limit: An integer representing the byte length limit to trim payloads to
+    :return: A generator of (Record, was_trimmed) tuples. Records whose payload is missing keep a None payload and
+             records whose payload could not be read keep the exception.
+    """
+    for record in records:
+        if record.payload is None or isinstance(record.payload, Exception):
+            trimmed_record, was_trimmed = record, False
+        else:
+            payload, was_trimmed = trim_payload(record.payload, byte_limit)
+            trimmed_record = record._replace(payload=payload)
+        # Drop the reference to a (possibly memory mapped) payload before the reader is resumed.
+        del record
+        yield trimmed_record, was_trimmed
+
+
+def read_ahead(iterable, size):
+    """
+        Consumes an iterable on a background thread, keeping up to size items ready for the caller.
+
+    :param iterable: Any iterable. It is consumed on a different thread.
+    :param size: The maximum number of items held in the buffer. 0 disables the read-ahead.
+    :return: A generator of the items of iterable, in order
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for an_item in iterable:
+                while not stop.is_set():
+                    try:
+                        buffer.put((an_item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            buffer.put((done, None))
+        except Exception as e:
+            buffer.put((done, e))
+
+    producer = threading.Thread(target=produce, name="ingestion-read-ahead", daemon=True)
+    producer.start()
+    try:
+        while True:
+            an_item, error = buffer.get()
+            if an_item is done:
+                if error is not None:
+                    raise error
+                return
+            yield an_item
+    finally:
+        stop.set()
+
+
+class SaveWriter(object):
+    """
+        Writes every payload as a new node with its own model(...).save(), i.e. one transaction per node.
+    """
+    def __init__(self, model, property_name="payload"):
+        """
+            Initialises the writer.
+
+        :param model: The neomodel.StructuredNode class to create
+        :param property_name: The name of the property that receives the payload
+        """
+        self.model = model
+        self.property_name = property_name
+        # Called with the lists of records written and failed after every record (see DeduplicatingWriter)
+        self.on_settled = None
+
+    def write(self, record, report):
+        """
+            Creates the node for a trimmed record.
+
+        :param record: A Record with a str payload
+        :param report: The IngestionReport to update
+        """
+        if METRICS.enabled:
+            METRICS.increment("transactions")
+            started = time.perf_counter()
+        try:
+            self.model(**{self.property_name: record.payload}).save()
+            report.written += 1
+            if self.on_settled is not None:
+                self.on_settled([record], [])
+        except (neo4j.exceptions.CypherError, neomodel.UniqueProperty) as e:
+            report.add_error(record, e)
+            if METRICS.enabled:
+                METRICS.increment("transaction_errors", label=type(e).__name__)
+            if self.on_settled is not None:
+                self.on_settled([], [record])
+        if METRICS.enabled:
+            METRICS.observe("save", time.perf_counter() - started)
+
+    def flush(self, report):
+        """
+            Nothing is buffered by this writer.
+
+        :param report: The IngestionReport to update
+        """
+        pass
+
+
+def ingest(records, writer, byte_limit=DEFAULT_BYTE_LIMIT, read_ahead_size=DEFAULT_READ_AHEAD, report=None):
+    """
+        Trims every record and hands it to the writer as it arrives.
+
+    :param records: An iterable of Records
+    :param writer: An object with write(record, report) and flush(report) methods (e.g. SaveWriter)
+    :param byte_limit: An integer representing the byte length limit to trim payloads to
+    :param read_ahead_size: Number of trimmed records to prepare on a background thread (0 to disable)
+    :param report: An IngestionReport to update, a new one is created if omitted
+    :return: The IngestionReport
+    """
+    report = report or IngestionReport()
+    for record, was_trimmed in read_ahead(trim_records(records, byte_limit), read_ahead_size):
+        report.read += 1
+        if record.payload is None:
+            report.add_error(record, KeyError("Record has no payload"))
+            continue
+        if isinstance(record.payload, Exception):
+            report.add_error(record, record.payload)
+            continue
+        if was_trimmed:
+            report.trimmed += 1
+        writer.write(record, report)
+    writer.flush(report)
+    return report
+
+
+def make_writer(model, property_name="payload", batch_size=DEFAULT_BATCH_SIZE, merge_on=None, deduplicator=None):
+    """
+        Returns the writer for a model.
+
+    :param model: The neomodel.StructuredNode class to create
+    :param property_name: The name of the property that receives the payload
+    :param batch_size: The number of nodes created per transaction. 0 saves every node on its own.
+    :param merge_on: The name of a uniquely indexed property to MERGE on
+    :param deduplicator: An optional Deduplicator that filters out payloads already seen
+    :return: A writer
+    """
+    if batch_size > 0:
+        writer = BulkWriter(model, property_name, batch_size, merge_on)
+    else:
+        writer = SaveWriter(model, property_name)
+    if deduplicator is not None:
+        writer = DeduplicatingWriter(writer, deduplicator)
+    return writer
+
+
+def make_deduplicator(args):
+    """
+        Returns the Deduplicator requested on the command line, or None.
+
+    :param args: The arguments parsed by build_argument_parser()
+    :return: A Deduplicator or None
+    """
+    if not args.dedup:
+        return None
+    return Deduplicator(args.dedup_memory * 1024 * 1024, args.dedup_path, args.dedup_expected)
+
+
+def load_model(model_path):
+    """
+        Imports a neomodel.StructuredNode class given as "module.ClassName".
+
+    :param model_path: A dotted path to the class
+    :return: The class
+    """
+    module_name, class_name = model_path.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def connect_from_environment(host="localhost:7687"):
+    """
+        Sets the neomodel connection from the NEO4J_USERNAME and NEO4J_PASSWORD environment variables.
+
+    :param host: The host:port of the Neo4j server
+    :return: True if the connection was set, False otherwise (an error has already been written to stderr)
+    """
+    try:
+        username = os.environ["NEO4J_USERNAME"]
+        password = os.environ["NEO4J_PASSWORD"]
+    except KeyError:
+        sys.stderr.write("ERROR: Please make sure that the NEO4J_USERNAME and NEO4J_PASSWORD environment variables"
+                         " have been properly set for this session by using `export NEO4J_USERNAME=something`"
+                         " and `export NEO4J_PASSWORD=something_else`.\n")
+        return False
+
+    # neomodel keeps one connection per thread. Setting the default URL lets threads other than this one connect on
+    # first use.
+    neomodel.config.DATABASE_URL = "bolt://{}:{}@{}".format(username, password, host)
+    try:
+        neomodel.db.set_connection(neomodel.config.DATABASE_URL)
+    except neo4j.exceptions.ServiceUnavailable:
+        sys.stderr.write("ERROR: Please make sure that your Neo4j server is up and running.\n")
+        return False
+    return True
+
+
+def server_version():
+    """
+        Returns the name, version and edition of every component of the connected server, as one string.
+    """
+    results, _ = neomodel.db.cypher_query("CALL dbms.components()")
+    return "; ".join("{} {} {}".format(a_name, ", ".join(versions), edition) for a_name, versions, edition in results)
+
+
+def byte_limit_argument(value):
+    """
+        Parses a --byte-limit option, which is either a number of bytes or "auto".
+    """
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number of bytes or auto, got {!r}".format(value))
+
+
+def resolve_byte_limit(byte_limit, model, property_name):
+    """
+        Returns the byte limit to trim payloads to. "auto" stands for the limit that index_calibration.py has measured
+        for the connected server and the kind of index on the payload property, which is looked up without probing.
+
+    :param byte_limit: An integer or "auto"
+    :param model: The neomodel.StructuredNode class of the payloads
+    :param property_name: The property of the payload
+    :return: An integer. DEFAULT_BYTE_LIMIT if "auto" finds no calibration (a warning is written to stderr).
+    """
+    if byte_limit != "auto":
+        return byte_limit
+    payload_property = model.defined_properties(aliases=False, rels=False)[property_name]
+    kind = "constraint" if payload_property.unique_index else "index"
+    version = server_version()
+    calibrated_limit = calibrated_byte_limit(version, kind)
+    if calibrated_limit is None:
+        sys.stderr.write("WARNING: No calibrated {} byte limit for {}, using {}. Run index_calibration.py to "
+                         "calibrate it.\n".format(kind, version, DEFAULT_BYTE_LIMIT))
+        return DEFAULT_BYTE_LIMIT
+    return calibrated_limit
+
+
+def build_argument_parser():
+    """
+        Returns the command line parser of the ingestion entry point.
+
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Streams payloads from files into Neo4j.")
+    parser.add_argument("paths", nargs="+", help="Files or directories to ingest")
+    parser.add_argument("--format", dest="input_format", choices=["lines", "jsonl", "files"], default="lines",
+                        help="One payload per line, one JSON object per line or one payload per file")
+    parser.add_argument("--field", default="payload", help="The payload field of JSONL input")
+    parser.add_argument("--mmap", dest="use_mmap", action="store_true", help="Memory map line-delimited input")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE, help="Read buffer size in bytes")
+    parser.add_argument("--read-ahead", type=int, default=DEFAULT_READ_AHEAD,
+                        help="Number of trimmed records to prepare ahead of the writer (0 to disable)")
+    parser.add_argument("--byte-limit", type=byte_limit_argument, default=DEFAULT_BYTE_LIMIT,
+                        help="Byte limit of the payload, or auto for the limit calibrated for the server")
+    parser.add_argument("--model", default="main_fix.SomeEntity", help="The node class to create (module.Class)")
+    parser.add_argument("--property", dest="property_name", default="payload", help="The property of the payload")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Nodes created per transaction (0 saves every node on its own)")
+    parser.add_argument("--merge-on", default=None, help="A uniquely indexed property to MERGE on instead of CREATE")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Report payloads that collide after trimming instead of sending them")
+    parser.add_argument("--dedup-memory", type=int, default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        help="Megabytes of exact duplicate detection before spilling to the Bloom filter")
+    parser.add_argument("--dedup-path", default=None,
+                        help="Bloom filter file, kept across runs (without it detection stays exact and unbounded)")
+    parser.add_argument("--dedup-expected", type=int, default=None,
+                        help="Number of payloads the Bloom filter is sized for (default: as many as fit in "
+                             "--dedup-memory megabytes)")
+    parser.add_argument("--metrics", default=None,
+                        help="File to write metrics to, as JSON if it ends in .json and as Prometheus text otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="Seconds between rewrites of the metrics file (0 writes it once, at the end)")
+    parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    return add_profiling_arguments(parser)
+
+
+def start_metrics(args):
+    """
+        Enables METRICS and starts writing them if the command line asks for it.
+
+    :param args: The arguments parsed by build_argument_parser()
+    :return: A started MetricsWriter, or None
+    """
+    if args.metrics is None:
+        return None
+    METRICS.enable()
+    return MetricsWriter(args.metrics, args.metrics_interval).start()
+
+
+if __name__ == "__main__":
+    args = add_checkpoint_arguments(build_argument_parser()).parse_args()
+
+    journal, start = None, None
+    if args.checkpoint is not None:
+        journal = Journal(args.checkpoint, args.checkpoint_sync)
+        try:
+            start = resume_point(journal)
+        except JournalMismatch as e:
+            sys.stderr.write("ERROR: {}\n".format(e))
+            sys.exit(1)
+        if start is not None:
+            sys.stderr.write("Resuming after {} records, at {}@{}.\n".format(journal.last.records, *start))
+
+    if not connect_from_environment(args.host):
+        if journal is not None:
+            journal.close()
+        sys.exit(1)
+
+    metrics_writer, profiler, deduplicator = None, None, None
+    try:
+        metrics_writer = start_metrics(args)
+        profiler = start_profiling(profiling_settings(args))
+        model = load_model(args.model)
+        byte_limit = resolve_byte_limit(args.byte_limit, model, args.property_name)
+        deduplicator = make_deduplicator(args)
+        writer = make_writer(model, args.property_name, args.batch_size, args.merge_on, deduplicator)
+        if journal is not None:
+            writer = CheckpointingWriter(writer, journal, args.checkpoint_every)
+        records = iter_records(args.paths, args.input_format, args.field, args.use_mmap, args.buffer_size, start)
+        report = ingest(records, writer, byte_limit, args.read_ahead)
+    finally:
+        # Also on errors, so that the payloads already written stay deduplicated and checkpointed.
+        if deduplicator is not None:
+            deduplicator.close()
+        if journal is not None:
+            journal.close()
+        stop_profiling(profiler)
+        if metrics_writer is not None:
+            metrics_writer.stop()
+    report.write(sys.stderr)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+A client-side cache of lookups by uniquely indexed property (e.g. SomeEntity by payload or serial_num).
+
+Every lookup through the model's NodeSet sends the (possibly 4000 byte long) value over Bolt and seeks the index. A
+LookupCache keeps the nodes found, and the values found missing, under a 16 byte digest of the trimmed value, with
+least recently used eviction beyond max_size entries and a time to live after which an entry is looked up again. A
+node found by one of its unique properties is cached under all of them.
+
+Saving or deleting a node in the same process invalidates its entries in every cache of its class, through the
+post_save, pre_delete and post_delete hooks of neomodel (which are installed on the class by the first cache), and
+so does bulk_create. Changes made by other processes only become visible when an entry expires, so the TTL bounds
+how stale a lookup can be.
+
+Example:
+
+    cache = LookupCache(SomeEntity, max_size=100000, ttl=60)
+    a_node = cache.get(payload=some_text)
+    cache.stats()
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import time
+import weakref
+import threading
+import collections
+from trimming import DEFAULT_BYTE_LIMIT, trim_string_at_unicode_boundaries
+from dedup import key_digest
+from metrics import METRICS
+
+# Number of entries kept by default.
+DEFAULT_MAX_SIZE = 100000
+
+# Seconds an entry is valid for by default.
+DEFAULT_TTL = 60.0
+
+# Every cache that has not been garbage collected, for invalidation.
+_CACHES = weakref.WeakSet()
+
+
+def _install_hooks(model):
+    """
+        Adds hooks to a node class that invalidate the entries of a node when it is saved or deleted, keeping any
+        hooks that the class already defines.
+    """
+    if model.__dict__.get("_lookup_cache_hooks"):
+        return
+    for a_hook_name in ("post_save", "pre_delete", "post_delete"):
+        previous_hook = getattr(model, a_hook_name, None)
+
+        def hook(self, previous_hook=previous_hook):
+            invalidate_node(self)
+            if previous_hook is not None:
+                previous_hook(self)
+        setattr(model, a_hook_name, hook)
+    model._lookup_cache_hooks = True
+
+
+def _caches_of(model):
+    return [a_cache for a_cache in list(_CACHES) if issubclass(model, a_cache.model)]
+
+
+def invalidate_node(node):
+    """
+        Drops the entries of a node from every cache of its class.
+
+    :param node: A neomodel.StructuredNode instance
+    """
+    for a_cache in _caches_of(type(node)):
+        a_cache.invalidate(node)
+
+
+def invalidate_rows(model, rows):
+    """
+        Drops the entries of the values of rows written directly (e.g. by bulk_create) from every cache of model.
+
+    :param model: A neomodel.StructuredNode class
+    :param rows: An iterable of dicts of database values, keyed by database property name
+    """
+    caches = _caches_of(model)
+    if not caches:
+        return
+    rows = list(rows)
+    for a_cache in caches:
+        a_cache.invalidate_rows(rows)
+
+
+class LookupCache(object):
+    """
+        A size-bounded LRU cache with a TTL in front of the lookups of a node class by its uniquely indexed properties.
+    """
+    def __init__(self, model, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, byte_limit=DEFAULT_BYTE_LIMIT,
+                 cache_missing=True, clock=time.monotonic):
+        """
+            Initialises an empty cache.
+
+        :param model: A neomodel.StructuredNode class
+        :param max_size: The number of entries kept, beyond which the least recently used one is evicted
+        :param ttl: Seconds after which an entry is looked up again (None for never)
+        :param byte_limit: String values are trimmed to this many bytes before they are looked up, as they were when
+                           they were stored (None to look them up as they are)
+        :param cache_missing: Whether values that were not found are cached as well
+        :param clock: The function returning the current time in seconds
+        """
+        self.model = model
+        self.max_size = max_size
+        self.ttl = ttl
+        self.byte_limit = byte_limit
+        self.cache_missing = cache_missing
+        self.clock = clock
+        # name -> db_property of the uniquely indexed properties
+        self.key_properties = {a_name: a_property.db_property or a_name
+                               for a_name, a_property in model.defined_properties(aliases=False, rels=False).items()
+                               if a_property.unique_index}
+        # key -> (expiry time, node or None)
+        self._entries = collections.OrderedDict()
+        # node id -> the keys it is cached under
+        self._keys_of_node = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _install_hooks(model)
+        _CACHES.add(self)
+
+    def _trim(self, value):
+        if isinstance(value, str) and self.byte_limit is not None:
+            return trim_string_at_unicode_boundaries(value, self.byte_limit)
+        return value
+
+    @staticmethod
+    def _key(name, trimmed_value):
+        if isinstance(trimmed_value, str):
+            return name, key_digest(trimmed_value)
+        return name, trimmed_value
+
+    def _node_keys(self, values):
+        """
+            Returns the keys of the uniquely indexed values among values (a dict keyed by property name).
+        """
+        return [self._key(a_name, self._trim(values[a_name])) for a_name in self.key_properties
+                if values.get(a_name) is not None]
+
+    def get(self, **kwargs):
+        """
+            Looks up a node by a single uniquely indexed property, e.g. get(payload=some_text).
+
+        :return: The node, or None if there is none
+        """
+        if len(kwargs) != 1:
+            raise TypeError("LookupCache.get() expects exactly one property")
+        (name, value), = kwargs.items()
+        if name not in self.key_properties:
+            raise ValueError("{}.{} is not uniquely indexed".format(self.model.__name__, name))
+        value = self._trim(value)
+        key = self._key(name, value)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl is None or entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    if METRICS.enabled:
+                        METRICS.increment("lookups", label="hit")
+                    return entry[1]
+                self._remove(key)
+                self.expired += 1
+            self.misses += 1
+        if METRICS.enabled:
+            METRICS.increment("lookups", label="miss")
+
+        node = self.model.nodes.get_or_none(**{name: value})
+        if node is not None:
+            self._put(self._node_keys(node.__properties__), node, now)
+        elif self.cache_missing:
+            self._put([key], None, now)
+        return node
+
+    def _put(self, keys, node, now):
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            for a_key in keys:
+                self._remove(a_key)
+                self._entries[a_key] = (expires, node)
+            if node is not None:
+                self._keys_of_node.setdefault(node.id, set()).update(keys)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        """
+            Drops an entry, if it exists. Called with the lock held.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            keys = self._keys_of_node.get(entry[1].id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_of_node[entry[1].id]
+        return entry is not None
+
+    def _invalidate_keys(self, keys):
+        with self._lock:
+            for a_key in keys:
+                if self._remove(a_key):
+                    self.invalidations += 1
+
+    def invalidate(self, node):
+        """
+            Drops the entries of a node, under both the values it was cached with and its current ones.
+
+        :param node: A node of the class of the cache
+        """
+        keys = set(self._node_keys(node.__properties__))
+        node_id = getattr(node, "id", None)
+        if node_id is not None:
+            with self._lock:
+                keys.update(self._keys_of_node.get(node_id, ()))
+        self._invalidate_keys(keys)
+
+    def invalidate_rows(self, rows):
+        """
+            Drops the entries of the values of rows.
+
+        :param rows: A list of dicts of database values, keyed by database property name
+        """
+        keys = []
+        for a_row in rows:
+            keys.extend(self._node_keys({a_name: a_row.get(db_property)
+                                         for a_name, db_property in self.key_properties.items()}))
+        self._invalidate_keys(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_of_node.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+            Returns the statistics of the cache as a JSON serialisable dict.
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -12,26 +12,7 @@ import sys
 import os
 import neo4j
 import neomodel
-
-
-def trim_string_at_unicode_boundaries(in_string, byte_limit):
-    """
-        Trims a unicode string to a specific limit of bytes and returns the unicode representation.
-        NOTE: The function assumes that the default encoding is utf-8
-        NOTE: In writing this function I have consulted
-              https://stackoverflow.com/questions/13727977/truncating-string-to-byte-length-in-python/13738452#13738452
-
-    :param in_string: Unicode input string
-    :param byte_limit: An integer representing the byte length limit to trim the string to
-    :return: A unicode in_string trimmed to the right length
-    """
-    encoded_in_string = bytearray(in_string, "utf-8")
-    if len(encoded_in_string) > byte_limit:
-        i = byte_limit
-        while i > 0 and not ((encoded_in_string[i] & 0xC0) != 0x80):
-            i = i-1
-        encoded_in_string = encoded_in_string[:i].decode("utf-8")
-    return encoded_in_string
+from trimming import trim_bytes_at_unicode_boundaries
 
 
 class SomeEntity(neomodel.StructuredNode):
@@ -71,10 +52,12 @@ if __name__ == "__main__":
     non_problematic_payload = u"The standard english phrase 'Hello World' translates to 'Χαίρε Κόσμε', in Greek \
 but sounds odd, just like any other word-to-word translation does."
 
-    with open("testcase1.txt", "rt", encoding="utf-8") as fd:
+    # The test cases are already stored as UTF-8, so they are read as raw bytes and trimmed without first being
+    # decoded to str and encoded back again. Only the trimmed part is decoded, when it is handed to neomodel.
+    with open("testcase1.txt", "rb") as fd:
         problematic_payload_1 = fd.read()
 
-    with open("testcase2.txt", "rt", encoding="utf-8") as fd:
+    with open("testcase2.txt", "rb") as fd:
         problematic_payload_2 = fd.read()
 
     # SCENARIO 1
@@ -92,7 +75,7 @@ but sounds odd, just like any other word-to-word translation does."
     # NOTE: Please note, the payload here is `problematic_payload_1` with length 3933 and byte length 4059. 4059 is
     # smaller than 4095 which is supposed to be the maximum index key length.
     try:
-        SomeEntity(payload=trim_string_at_unicode_boundaries(problematic_payload_1,4000)).save()
+        SomeEntity(payload=str(trim_bytes_at_unicode_boundaries(problematic_payload_1, 4000), "utf-8")).save()
     except neo4j.exceptions.DatabaseError as e:
         sys.stderr.write(e.message)
     #
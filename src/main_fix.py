@@ -9,26 +9,7 @@ import sys
 import os
 import neo4j
 import neomodel
-
-
-def trim_string_at_unicode_boundaries(in_string, byte_limit):
-    """
-        Trims a unicode string to a specific limit of bytes and returns the unicode representation.
-        NOTE: The function assumes that the default encoding is utf-8
-        NOTE: In writing this function I have consulted
-              https://stackoverflow.com/questions/13727977/truncating-string-to-byte-length-in-python/13738452#13738452
-
-    :param in_string: Unicode input string
-    :param byte_limit: An integer representing the byte length limit to trim the string to
-    :return: A unicode in_string trimmed to the right length
-    """
-    encoded_in_string = bytearray(in_string, "utf-8")
-    if len(encoded_in_string) > byte_limit:
-        i = byte_limit
-        while i > 0 and not ((encoded_in_string[i] & 0xC0) != 0x80):
-            i = i-1
-        encoded_in_string = encoded_in_string[:i].decode("utf-8")
-    return encoded_in_string
+from trimming import trim_string_at_unicode_boundaries
 
 
 class SomeEntity(neomodel.StructuredNode):
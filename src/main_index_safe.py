@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Very brief demonstration of storing long strings in a uniquely indexed attribute without trimming them.
+
+The same inputs as in main_file_based.py are used, but the payload is an IndexSafeStringProperty. The full text is
+stored unindexed and only a fixed length digest of it is placed in the unique index.
+
+The nodes are labelled IndexSafeEntity, so that the unique constraint on the payload of the SomeEntity nodes of the
+other scripts does not apply to them. Install the schema of this module first:
+
+    python schema_sync.py main_index_safe.py
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import neo4j
+import neomodel
+from ingestion import connect_from_environment
+from bulk_writer import bulk_create
+from index_safe_property import IndexSafeNode, IndexSafeStringProperty
+
+
+class SomeEntity(IndexSafeNode):
+    """
+        The entity of the other scripts, with an index-safe payload.
+    """
+    __label__ = "IndexSafeEntity"
+
+    serial_num = neomodel.UniqueIdProperty()
+    payload = IndexSafeStringProperty(unique_index=True)
+
+
+if __name__ == "__main__":
+    if not connect_from_environment():
+        sys.exit(1)
+
+    non_problematic_payload = u"The standard english phrase 'Hello World' translates to 'Χαίρε Κόσμε', in Greek \
+but sounds odd, just like any other word-to-word translation does."
+
+    with open("testcase1.txt", "rt", encoding="utf-8") as fd:
+        problematic_payload_1 = fd.read()
+
+    with open("testcase2.txt", "rt", encoding="utf-8") as fd:
+        problematic_payload_2 = fd.read()
+
+    # All three nodes are created with NO ERRORS. The index only ever sees 32 byte keys, so neither the length of
+    # the payloads nor the fact that payload 1 is a prefix of payload 2 matters.
+    for a_payload in [non_problematic_payload, problematic_payload_1, problematic_payload_2]:
+        try:
+            SomeEntity(payload=a_payload).save()
+        except (neo4j.exceptions.CypherError, neomodel.UniqueProperty) as e:
+            sys.stderr.write("ERROR: {}\n".format(e))
+
+    # Lookups by payload go through the unique index on the digest.
+    for a_payload in [problematic_payload_1, problematic_payload_2]:
+        a_node = SomeEntity.nodes.get(payload=a_payload)
+        sys.stdout.write("Found {} with a payload of {} bytes\n".format(a_node.serial_num,
+                                                                       len(a_node.payload.encode("utf-8"))))
+
+    # Creating a node with the same payload again is rejected by the unique index.
+    try:
+        SomeEntity(payload=problematic_payload_1).save()
+    except neomodel.UniqueProperty:
+        sys.stdout.write("Duplicate payload rejected by the unique index.\n")
+
+    # Bulk writes derive the digest keys as well: every row of a batch is written.
+    bulk_payloads = ["{}\n{}".format(a_payload, an_index) for an_index in range(3)
+                     for a_payload in [problematic_payload_1, problematic_payload_2]]
+    result = bulk_create(SomeEntity, ({"payload": a_payload} for a_payload in bulk_payloads))
+    sys.stdout.write("Bulk created {} of {} nodes.\n".format(result.written, len(bulk_payloads)))
+    if result.written != len(bulk_payloads):
+        for a_failure in result.failures:
+            sys.stderr.write("ERROR: Row {}: {}\n".format(a_failure.index, a_failure.error))
+        sys.exit(1)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Instrumentation of the ingestion hot path.
+
+A single Metrics registry per process, METRICS, counts payloads, their UTF-8 bytes before and after trimming, trims,
+collisions, transactions, failed transactions and records by exception class and the hits and misses of
+LookupCaches, and keeps a latency histogram per stage (trim, save, transaction). It is disabled by default.
+Instrumented code checks METRICS.enabled before doing any measuring, which is all that a disabled registry costs.
+
+NOTE: Measuring the bytes of a str payload before trimming requires encoding it completely, which is exactly the cost
+      that trimming avoids. This only happens while metrics are enabled.
+
+A registry can be written as Prometheus text (for example for the node exporter's textfile collector) or as a JSON
+snapshot, once or periodically with MetricsWriter.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import json
+import time
+import bisect
+import threading
+import collections
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = [float("{}e{}".format(m, e)) for e in range(-6, 1) for m in (1, 2.5, 5)] + [10.0]
+
+# Prefix of the Prometheus metric names.
+PROMETHEUS_PREFIX = "neomodlon"
+
+# Counters: name -> (label name or None, help text)
+COUNTERS = collections.OrderedDict([
+    ("payloads", (None, "Payloads trimmed")),
+    ("payloads_trimmed", (None, "Payloads longer than the byte limit")),
+    ("payload_bytes", ("stage", "UTF-8 bytes of payloads before and after trimming")),
+    ("collisions", (None, "Payloads rejected as duplicates, by the deduplicator or by a unique constraint")),
+    ("transactions", (None, "Write transactions attempted")),
+    ("transaction_errors", ("class", "Write transactions that failed, by exception class")),
+    ("errors", ("class", "Records that failed, by exception class")),
+    ("lookups", ("result", "Lookups through a LookupCache, by result (hit or miss)"))])
+
+# Error classes that mean that a payload collided with another one.
+COLLISION_ERRORS = {"DuplicatePayload", "UniqueProperty", "ConstraintError", "ConstraintValidationFailed"}
+
+
+class Histogram(object):
+    """
+        Counts observations into fixed buckets, like a Prometheus histogram.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+            Returns the upper bound of the bucket that holds the q-th quantile (None for an empty histogram).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return float("inf")
+
+
+class Metrics(object):
+    """
+        A registry of counters and per stage latency histograms.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """
+            Starts collecting, from zero.
+        """
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = {a_name: collections.Counter() for a_name in COUNTERS}
+            self.histograms = {}
+
+    def increment(self, name, value=1, label=None):
+        """
+            Adds to a counter.
+
+        :param name: A key of COUNTERS
+        :param value: The amount to add
+        :param label: The value of the counter's label, if it has one
+        """
+        with self._lock:
+            self.counters[name][label] += value
+
+    def observe(self, stage, seconds):
+        """
+            Records the duration of one execution of a stage.
+        """
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count_payload(self, bytes_before, bytes_after):
+        """
+            Records the trimming of one payload.
+        """
+        with self._lock:
+            self.counters["payloads"][None] += 1
+            self.counters["payload_bytes"]["before_trim"] += bytes_before
+            self.counters["payload_bytes"]["after_trim"] += bytes_after
+            if bytes_after != bytes_before:
+                self.counters["payloads_trimmed"][None] += 1
+
+    def count_error(self, error):
+        """
+            Records the failure of one record, counting collisions separately as well.
+        """
+        error_class = type(error).__name__
+        with self._lock:
+            self.counters["errors"][error_class] += 1
+            if error_class in COLLISION_ERRORS:
+                self.counters["collisions"][None] += 1
+
+    def take(self):
+        """
+            Moves the counts so far to a new registry and continues from zero, e.g. to send them to another process.
+
+        :return: A Metrics object
+        """
+        taken = Metrics()
+        with self._lock:
+            taken.counters, taken.histograms = self.counters, self.histograms
+            self.counters = {a_name: collections.Counter() for a_name in COUNTERS}
+            self.histograms = {}
+        return taken
+
+    def merge(self, other):
+        """
+            Adds the counts of another registry (e.g. that of a worker process) to this one.
+
+        :param other: A Metrics object
+        :return: self
+        """
+        with self._lock:
+            for a_name, a_counter in other.counters.items():
+                self.counters[a_name].update(a_counter)
+            for a_stage, a_histogram in other.histograms.items():
+                self.histograms.setdefault(a_stage, Histogram()).merge(a_histogram)
+        return self
+
+    def snapshot(self):
+        """
+            Returns the current values as a JSON serialisable dict.
+
+        :return: dict
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            counters = {}
+            for a_name, (label_name, _) in COUNTERS.items():
+                a_counter = self.counters[a_name]
+                counters[a_name] = dict(a_counter) if label_name else a_counter[None]
+            histograms = {a_stage: {"count": a_histogram.count,
+                                    "sum_seconds": a_histogram.sum,
+                                    "mean_seconds": a_histogram.sum / a_histogram.count if a_histogram.count else None,
+                                    "p50_seconds": a_histogram.quantile(0.5),
+                                    "p99_seconds": a_histogram.quantile(0.99),
+                                    "buckets": dict(zip([str(b) for b in a_histogram.buckets] + ["+Inf"],
+                                                        a_histogram.counts))}
+                          for a_stage, a_histogram in self.histograms.items()}
+        return {"timestamp": time.time(),
+                "elapsed_seconds": elapsed,
+                "counters": counters,
+                "transactions_per_second": counters["transactions"] / elapsed if elapsed > 0 else None,
+                "stage_seconds": histograms}
+
+    def prometheus_text(self):
+        """
+            Returns the current values in the Prometheus text exposition format.
+
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            for a_name, (label_name, help_text) in COUNTERS.items():
+                metric_name = "{}_{}_total".format(PROMETHEUS_PREFIX, a_name)
+                lines.append("# HELP {} {}".format(metric_name, help_text))
+                lines.append("# TYPE {} counter".format(metric_name))
+                a_counter = self.counters[a_name]
+                if label_name is None:
+                    lines.append("{} {}".format(metric_name, a_counter[None]))
+                for a_label, a_value in sorted(a_counter.items(), key=lambda item: str(item[0])):
+                    if label_name is not None:
+                        lines.append('{}{{{}="{}"}} {}'.format(metric_name, label_name, a_label, a_value))
+
+            metric_name = "{}_stage_seconds".format(PROMETHEUS_PREFIX)
+            lines.append("# HELP {} Latency of the ingestion stages".format(metric_name))
+            lines.append("# TYPE {} histogram".format(metric_name))
+            for a_stage, a_histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for upper_bound, count in zip(a_histogram.buckets + ["+Inf"], a_histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric_name, a_stage, upper_bound,
+                                                                             cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(metric_name, a_stage, a_histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(metric_name, a_stage, a_histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+            Writes the current values to a file, as JSON if its name ends in ".json" and as Prometheus text otherwise.
+            The file is replaced atomically, so that readers never see a partial file.
+
+        :param path: The path of the file
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), indent=2) + "\n"
+        else:
+            content = self.prometheus_text()
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, "wt") as fd:
+            fd.write(content)
+        os.replace(temporary_path, path)
+
+
+# The registry of this process.
+METRICS = Metrics()
+
+
+class MetricsWriter(object):
+    """
+        Writes a registry to a file every interval seconds on a background thread, and once more when stopped.
+    """
+    def __init__(self, path, interval=0, metrics=METRICS):
+        """
+            Initialises the writer.
+
+        :param path: The path of the file (see Metrics.write)
+        :param interval: Seconds between writes, 0 to only write when stopped
+        :param metrics: The registry to write
+        """
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.metrics.write(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Parallel ingestion across a pool of worker processes, each with its own connection to the database.
+
+The parent process only reads records and routes them to workers. Every worker trims, validates and writes its own
+records through its own driver session and sends back partial IngestionReports that are merged into one. Payloads
+are neither encoded nor trimmed by the parent: str and bytes payloads are sent whole and memory mapped ones (--mmap,
+--format files) as the byte range of their file, which the worker maps itself.
+
+Records are routed by a hash of the bytes that determine their trimmed value. Records that would collide on the
+unique index after trimming therefore always reach the same worker, in input order, and the first of them is the one
+that gets created. The outcome of a run does not depend on how the workers happen to be scheduled.
+
+Usage: python parallel_ingestion.py --workers N [ingestion.py options] path [path ...]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import mmap
+import zlib
+import queue
+import collections
+import multiprocessing
+from trimming import UTF8_MAX_BYTES_PER_CHAR
+from ingestion import IngestionReport, iter_records, ingest, load_model, make_writer, connect_from_environment, \
+    build_argument_parser, start_metrics, resolve_byte_limit
+from dedup import Deduplicator
+from metrics import METRICS
+from profiling import profiling_settings, start_profiling, stop_profiling
+
+# Number of chunks of records that may be queued for each worker.
+WORKER_QUEUE_SIZE = 4
+
+# Seconds to wait on a full worker queue before checking that the worker is still alive.
+QUEUE_TIMEOUT = 1.0
+
+
+# A payload that is read by the worker itself, from bytes [start, stop) of the file of its record.
+PayloadRange = collections.namedtuple("PayloadRange", ["start", "stop"])
+
+
+def shard_of(payload, byte_limit, workers):
+    """
+        Returns the worker that a payload is routed to.
+
+        NOTE: Two payloads that trim to the same value share their first byte_limit - 3 bytes (trimming never removes
+              more than 3 bytes below the limit, and payloads shorter than that are not trimmed at all), so hashing
+              those bytes sends them to the same worker. A str payload is hashed by its first (byte_limit - 3) // 4
+              characters instead, which lie within those bytes, so that it does not have to be encoded.
+
+    :param payload: A str, a bytes-like object holding UTF-8, None or the exception of a payload that could not be read
+    :param byte_limit: An integer representing the byte length limit
+    :param workers: The number of workers
+    :return: An integer in [0, workers)
+    """
+    shared_bytes = max(byte_limit - (UTF8_MAX_BYTES_PER_CHAR - 1), 0)
+    if payload is None or isinstance(payload, Exception):
+        return 0
+    if isinstance(payload, str):
+        return hash(payload[:shared_bytes // UTF8_MAX_BYTES_PER_CHAR]) % workers
+    with memoryview(payload) as view:
+        return zlib.crc32(view[:shared_bytes]) % workers
+
+
+def payload_range(record):
+    """
+        Returns the PayloadRange of a record whose payload is a memoryview over its (memory mapped) file.
+    """
+    return PayloadRange(record.offset, record.offset + len(record.payload))
+
+
+class MappedFiles(object):
+    """
+        Memory maps the input files of a worker, one at a time, to read the payloads sent as PayloadRanges.
+    """
+    def __init__(self):
+        self.path = None
+        self._fd = None
+        self._mapped = None
+        self._view = None
+
+    def payload(self, path, payload_range):
+        """
+            Returns a memoryview over bytes [start, stop) of a file.
+        """
+        if path != self.path:
+            self.close()
+            self._fd = open(path, "rb")
+            self._mapped = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mapped)
+            self.path = path
+        return self._view[payload_range.start:payload_range.stop]
+
+    def resolve(self, records):
+        """
+            Replaces the PayloadRanges among the payloads of records by the bytes they refer to.
+
+        :param records: An iterable of Records
+        :return: A generator of Records
+        """
+        for record in records:
+            if isinstance(record.payload, PayloadRange):
+                record = record._replace(payload=self.payload(record.source, record.payload))
+            yield record
+            # Drop the reference to the memory mapped payload before the next one is read.
+            del record
+
+    def close(self):
+        """
+            Unmaps the current file. Views still held by the caller keep the map open until they are released.
+        """
+        if self._view is not None:
+            self._view.release()
+            try:
+                self._mapped.close()
+            except BufferError:
+                pass
+            self._fd.close()
+        self.path = self._fd = self._mapped = self._view = None
+
+
+def _worker(worker_index, inbox, outbox, model_path, property_name, byte_limit, batch_size, merge_on, host,
+            dedup_settings, collect_metrics=False, profile_settings=None):
+    """
+        Trims and writes the chunks of records sent to one worker, until it receives None.
+
+    :param worker_index: The index of this worker
+    :param inbox: The multiprocessing.Queue of chunks (lists of Records) for this worker. Payloads are whole, or
+                  PayloadRanges of the files of their records.
+    :param outbox: The multiprocessing.Queue shared by all workers for (worker_index, IngestionReport, Metrics)
+                   messages. The Metrics are None unless collect_metrics is set.
+    :param dedup_settings: None, or the (memory_budget, spill_path, expected_items) of this worker's Deduplicator
+    :param collect_metrics: Whether to enable METRICS in this worker and send them along with every report
+    :param profile_settings: None, or the Profiler arguments of this worker (see profiling.profiling_settings)
+    """
+    if not connect_from_environment(host):
+        sys.exit(1)
+
+    profiler = start_profiling(profile_settings)
+
+    if collect_metrics:
+        METRICS.enable()
+
+    deduplicator = Deduplicator(*dedup_settings) if dedup_settings is not None else None
+    mapped_files = MappedFiles()
+    try:
+        writer = make_writer(load_model(model_path), property_name, batch_size, merge_on, deduplicator)
+        while True:
+            chunk = inbox.get()
+            if chunk is None:
+                break
+            partial_report = ingest(mapped_files.resolve(chunk), writer, byte_limit, 0)
+            del chunk
+            outbox.put((worker_index, partial_report, METRICS.take() if collect_metrics else None))
+    finally:
+        mapped_files.close()
+        if deduplicator is not None:
+            deduplicator.close()
+        stop_profiling(profiler)
+    outbox.put((worker_index, None, None))
+
+
+class ParallelIngestion(object):
+    """
+        Distributes records to a pool of worker processes and merges their reports.
+    """
+    def __init__(self, workers, model_path, property_name="payload", byte_limit=4000, batch_size=1000,
+                 merge_on=None, host="localhost:7687", progress=None, dedup_settings=None, collect_metrics=None,
+                 profile_args=None):
+        """
+            Initialises the pool. Workers are started by run().
+
+        :param workers: The number of worker processes
+        :param model_path: The node class to create, as "module.ClassName" (it is imported by every worker)
+        :param progress: An optional callable that receives the merged IngestionReport every time a chunk completes
+        :param dedup_settings: None, or the (memory_budget, spill_path, expected_items) of a Deduplicator per worker.
+                               Duplicates always meet in the same worker, so per worker detection catches all of
+                               them. The spill_path of each worker gets the worker index appended, so detection
+                               across runs requires the same number of workers and, for str (jsonl) payloads, which
+                               are routed by hash(), a fixed PYTHONHASHSEED.
+        :param collect_metrics: Whether workers collect metrics, which are merged into the METRICS of this process.
+                                Defaults to whether METRICS is enabled.
+        :param profile_args: None, or parsed arguments with the profiling options of profiling.add_profiling_arguments.
+                             Every worker writes its own reports, with the worker index appended to the path prefix.
+        """
+        self.workers = workers
+        self.byte_limit = byte_limit
+        self.chunk_size = max(batch_size, 1)
+        self.progress = progress
+        self.report = IngestionReport()
+        self._outbox = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+        if collect_metrics is None:
+            collect_metrics = METRICS.enabled
+        self._processes = [
+            multiprocessing.Process(target=_worker, name="ingestion-worker-{}".format(worker_index),
+                                    args=(worker_index, self._inboxes[worker_index], self._outbox, model_path,
+                                          property_name, byte_limit, batch_size, merge_on, host,
+                                          self._worker_dedup_settings(dedup_settings, worker_index), collect_metrics,
+                                          profiling_settings(profile_args, "worker{}".format(worker_index))
+                                          if profile_args is not None else None))
+            for worker_index in range(workers)]
+        self._finished = 0
+
+    @staticmethod
+    def _worker_dedup_settings(dedup_settings, worker_index):
+        """
+            Returns the Deduplicator settings of one worker.
+        """
+        if dedup_settings is None:
+            return None
+        memory_budget, spill_path, expected_items = dedup_settings
+        return memory_budget, "{}.{}".format(spill_path, worker_index) if spill_path else None, expected_items
+
+    def _collect(self, block=False):
+        """
+            Merges every report that the workers have sent so far.
+
+        :param block: Whether to wait for at least one message
+        """
+        while True:
+            try:
+                worker_index, partial_report, partial_metrics = self._outbox.get(
+                    block=block, timeout=QUEUE_TIMEOUT if block else None)
+            except queue.Empty:
+                return
+            block = False
+            if partial_metrics is not None:
+                METRICS.merge(partial_metrics)
+            if partial_report is None:
+                self._finished += 1
+                continue
+            self.report.merge(partial_report)
+            if self.progress is not None:
+                self.progress(self.report)
+
+    def _send(self, worker_index, chunk):
+        """
+            Queues a chunk for a worker, merging reports while waiting and failing if the worker has exited.
+        """
+        while True:
+            try:
+                self._inboxes[worker_index].put(chunk, timeout=QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                self._collect()
+                if not self._processes[worker_index].is_alive():
+                    raise RuntimeError("Ingestion worker {} exited with code {}".format(
+                        worker_index, self._processes[worker_index].exitcode))
+
+    def run(self, records):
+        """
+            Routes every record to its worker and waits for all of them to finish.
+
+        :param records: An iterable of Records
+        :return: The merged IngestionReport
+        """
+        for a_process in self._processes:
+            a_process.start()
+        try:
+            chunks = [[] for _ in range(self.workers)]
+            for record in records:
+                worker_index = shard_of(record.payload, self.byte_limit, self.workers)
+                if isinstance(record.payload, memoryview):
+                    chunks[worker_index].append(record._replace(payload=payload_range(record)))
+                else:
+                    chunks[worker_index].append(record)
+                # Drop the reference to a (possibly memory mapped) payload before the reader is resumed.
+                del record
+                if len(chunks[worker_index]) >= self.chunk_size:
+                    self._send(worker_index, chunks[worker_index])
+                    chunks[worker_index] = []
+            for worker_index, a_chunk in enumerate(chunks):
+                if a_chunk:
+                    self._send(worker_index, a_chunk)
+            for worker_index in range(self.workers):
+                self._send(worker_index, None)
+            while self._finished < self.workers:
+                self._collect(block=True)
+                if self._finished < self.workers and not any(p.is_alive() for p in self._processes):
+                    raise RuntimeError("Ingestion workers exited before reporting")
+        finally:
+            for a_process in self._processes:
+                a_process.join(timeout=QUEUE_TIMEOUT)
+                if a_process.is_alive():
+                    a_process.terminate()
+        return self.report
+
+
+if __name__ == "__main__":
+    parser = build_argument_parser()
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of worker processes")
+    args = parser.parse_args()
+
+    # Fail early instead of in every worker.
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+    byte_limit = resolve_byte_limit(args.byte_limit, load_model(args.model), args.property_name)
+
+    def write_progress(report):
+        sys.stderr.write("\rRead {}, written {}, failed {}.".format(report.read, report.written, report.failed))
+
+    metrics_writer, profiler = None, None
+    try:
+        metrics_writer = start_metrics(args)
+        profiler = start_profiling(profiling_settings(args))
+        dedup_settings = None
+        if args.dedup:
+            dedup_settings = (args.dedup_memory * 1024 * 1024 // args.workers, args.dedup_path, args.dedup_expected)
+        pool = ParallelIngestion(args.workers, args.model, args.property_name, byte_limit, args.batch_size,
+                                 args.merge_on, args.host, write_progress, dedup_settings, profile_args=args)
+        records = iter_records(args.paths, args.input_format, args.field, args.use_mmap, args.buffer_size)
+        report = pool.run(records)
+    finally:
+        stop_profiling(profiler)
+        if metrics_writer is not None:
+            metrics_writer.stop()
+    sys.stderr.write("\n")
+    report.write(sys.stderr)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Offline pre-flight scan of a corpus, before it is loaded. The database is not contacted.
+
+For every payload the scan works out its byte length, its character length, the script most of its characters belong
+to and what it would look like after trimming. It then reports, per script:
+
+* A histogram of bytes per character
+* How many payloads would be trimmed
+* How many fall in the "danger zone" between the byte limit and the index key limit, where README.md reports that the
+  server accepts a key and then fails later
+
+and, over the whole corpus, how many payloads would collide on the unique index once trimmed that did not collide
+before trimming.
+
+Files are split into chunks of whole lines that are scanned in parallel by a pool of processes. Each chunk is memory
+mapped and all per-byte work (character counting, script detection, trimming) is done by NumPy over the whole chunk.
+Only 8 byte digests of the payloads travel back to the parent process, to count collisions.
+
+Usage: python preflight_scan.py [--format lines|jsonl|files] [--workers N] [--json] path [path ...]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import sys
+import json
+import mmap
+import hashlib
+import argparse
+import multiprocessing
+import numpy
+from trimming import DEFAULT_BYTE_LIMIT
+from batch_trimming import pack_strings, trim_ends
+from ingestion import iter_paths
+
+# The index key size limit reported by the server's exceptions (see README.md).
+INDEX_KEY_LIMIT = 4095
+
+# Size of the chunks that files are split into for scanning.
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Upper bounds of the bytes per character histogram bins. A UTF-8 character takes 1 to 4 bytes.
+RATIO_BINS = numpy.array([1.0, 1.25, 1.5, 1.75, 2.0, 2.25, 2.5, 2.75, 3.0, 3.25, 3.5, 3.75, 4.0])
+
+# Scripts, as told apart by the lead byte of each UTF-8 character.
+SCRIPTS = ["ascii", "latin", "greek", "cyrillic", "middle-eastern", "indic", "symbols", "cjk", "hangul", "other",
+           "supplementary"]
+
+# Script of every possible non-ASCII byte value. Continuation bytes map past the end of SCRIPTS and bytes that are
+# never valid in UTF-8 are counted as "other".
+_CONTINUATION = len(SCRIPTS)
+_LEAD_BYTE_SCRIPT = numpy.full(256, SCRIPTS.index("other"), dtype=numpy.int64)
+_LEAD_BYTE_SCRIPT[0x80:0xC0] = _CONTINUATION
+for _lead_bytes, _script in [(range(0xC2, 0xCE), "latin"),           # U+0080 - U+037F
+                             (range(0xCE, 0xD0), "greek"),           # U+0380 - U+03FF
+                             (range(0xD0, 0xD5), "cyrillic"),        # U+0400 - U+053F
+                             (range(0xD5, 0xE0), "middle-eastern"),  # U+0540 - U+07FF (Armenian, Hebrew, Arabic, ...)
+                             (range(0xE0, 0xE1), "indic"),           # U+0800 - U+0FFF (Indic, Thai, Tibetan, ...)
+                             (range(0xE1, 0xE2), "other"),           # U+1000 - U+1FFF
+                             (range(0xE2, 0xE3), "symbols"),         # U+2000 - U+2FFF (punctuation, symbols)
+                             (range(0xE3, 0xEA), "cjk"),             # U+3000 - U+9FFF
+                             (range(0xEA, 0xEE), "hangul"),          # U+A000 - U+DFFF (Hangul syllables, Yi, ...)
+                             (range(0xEE, 0xF0), "other"),           # U+E000 - U+FFFF (private use, compatibility)
+                             (range(0xF0, 0xF5), "supplementary")]:  # U+10000 and above (emoji, rare CJK, ...)
+    _LEAD_BYTE_SCRIPT[list(_lead_bytes)] = SCRIPTS.index(_script)
+
+
+class ScanResult(object):
+    """
+        The statistics of a scanned corpus, or of a part of it.
+    """
+    def __init__(self):
+        self.payloads = numpy.zeros(len(SCRIPTS), dtype=numpy.int64)
+        self.bytes = numpy.zeros(len(SCRIPTS), dtype=numpy.int64)
+        self.ratio_histogram = numpy.zeros((len(SCRIPTS), len(RATIO_BINS)), dtype=numpy.int64)
+        self.trimmed = numpy.zeros(len(SCRIPTS), dtype=numpy.int64)
+        self.danger_zone = numpy.zeros(len(SCRIPTS), dtype=numpy.int64)
+        self.over_index_limit = numpy.zeros(len(SCRIPTS), dtype=numpy.int64)
+        self.max_bytes = 0
+        # 8 byte digests of the full and of the trimmed payloads, to count collisions.
+        self.full_digests = []
+        self.trimmed_digests = []
+        self.collisions = None
+        self.duplicates = None
+
+    def merge(self, other):
+        """
+            Adds the statistics of another ScanResult to this one.
+
+        :param other: A ScanResult
+        :return: self
+        """
+        self.payloads += other.payloads
+        self.bytes += other.bytes
+        self.ratio_histogram += other.ratio_histogram
+        self.trimmed += other.trimmed
+        self.danger_zone += other.danger_zone
+        self.over_index_limit += other.over_index_limit
+        self.max_bytes = max(self.max_bytes, other.max_bytes)
+        self.full_digests.extend(other.full_digests)
+        self.trimmed_digests.extend(other.trimmed_digests)
+        return self
+
+    def count_collisions(self):
+        """
+            Counts the payloads that repeat an earlier payload, before and after trimming, and drops the digests.
+        """
+        def repeats(digests):
+            all_digests = numpy.concatenate(digests) if digests else numpy.zeros(0, dtype=numpy.uint64)
+            return len(all_digests) - len(numpy.unique(all_digests))
+
+        self.duplicates = repeats(self.full_digests)
+        self.collisions = repeats(self.trimmed_digests) - self.duplicates
+        self.full_digests = []
+        self.trimmed_digests = []
+
+    def as_dict(self):
+        """
+            Returns the statistics as a JSON serialisable dict.
+
+        :return: dict
+        """
+        return {"payloads": int(self.payloads.sum()),
+                "bytes": int(self.bytes.sum()),
+                "max_bytes": int(self.max_bytes),
+                "trimmed": int(self.trimmed.sum()),
+                "danger_zone": int(self.danger_zone.sum()),
+                "over_index_limit": int(self.over_index_limit.sum()),
+                "duplicates_in_input": self.duplicates,
+                "collisions_caused_by_trimming": self.collisions,
+                "ratio_bins": RATIO_BINS.tolist(),
+                "scripts": {a_script: {"payloads": int(self.payloads[i]),
+                                       "bytes": int(self.bytes[i]),
+                                       "ratio_histogram": self.ratio_histogram[i].tolist(),
+                                       "trimmed": int(self.trimmed[i]),
+                                       "danger_zone": int(self.danger_zone[i]),
+                                       "over_index_limit": int(self.over_index_limit[i])}
+                            for i, a_script in enumerate(SCRIPTS) if self.payloads[i]}}
+
+    def write(self, stream, byte_limit, index_limit):
+        """
+            Writes a human readable summary of the statistics to a stream.
+
+        :param stream: A text stream (e.g. sys.stdout)
+        """
+        summary = self.as_dict()
+        stream.write("Payloads: {payloads}, bytes: {bytes}, longest: {max_bytes} bytes.\n".format(**summary))
+        stream.write("Trimmed at {} bytes: {}.\n".format(byte_limit, summary["trimmed"]))
+        stream.write("In the {}-{} byte danger zone: {}.\n".format(byte_limit, index_limit, summary["danger_zone"]))
+        stream.write("Over the {} byte index key limit: {}.\n".format(index_limit, summary["over_index_limit"]))
+        stream.write("Duplicates in the input: {}.\n".format(summary["duplicates_in_input"]))
+        stream.write("Collisions caused by trimming: {}.\n".format(summary["collisions_caused_by_trimming"]))
+        stream.write("\n{:>15} {:>12} {:>10} {:>10}  bytes/char <= {}\n".format(
+            "script", "payloads", "trimmed", "danger", " ".join("{:>6}".format(b) for b in RATIO_BINS)))
+        for a_script, stats in summary["scripts"].items():
+            stream.write("{:>15} {:>12} {:>10} {:>10}                {}\n".format(
+                a_script, stats["payloads"], stats["trimmed"], stats["danger_zone"],
+                " ".join("{:>6}".format(count) for count in stats["ratio_histogram"])))
+
+
+def _digests(view, starts, ends):
+    """
+        Returns the 8 byte digests of rows of a buffer as a uint64 array.
+    """
+    return numpy.frombuffer(b"".join(hashlib.blake2b(view[start:end], digest_size=8).digest()
+                                     for start, end in zip(starts.tolist(), ends.tolist())), dtype=numpy.uint64)
+
+
+def scan_rows(data, starts, ends, byte_limit, index_limit):
+    """
+        Computes the statistics of rows of a UTF-8 byte array.
+
+    :param data: A uint8 numpy array holding the rows
+    :param starts: An int64 numpy array of row start positions into data (rows must not be empty)
+    :param ends: An int64 numpy array of row end positions into data. Bytes between rows must be ASCII.
+    :param byte_limit: An integer representing the byte length limit payloads are trimmed to
+    :param index_limit: The index key size limit of the server
+    :return: A ScanResult
+    """
+    result = ScanResult()
+    if not len(starts):
+        return result
+
+    # Only non-ASCII bytes are looked at individually. Each one is counted against its row and script (or as a
+    # continuation byte) in a single bincount. Bytes between rows are ASCII and never counted.
+    byte_lengths = ends - starts
+    non_ascii = numpy.flatnonzero(data >= 0x80)
+    first_of_row = numpy.append(numpy.searchsorted(non_ascii, starts), len(non_ascii))
+    row_of_byte = numpy.repeat(numpy.arange(len(starts)), numpy.diff(first_of_row))
+    counts = numpy.bincount(row_of_byte * (len(SCRIPTS) + 1) + _LEAD_BYTE_SCRIPT[data[non_ascii]],
+                            minlength=len(starts) * (len(SCRIPTS) + 1)).reshape(len(starts), len(SCRIPTS) + 1)
+    del non_ascii, first_of_row, row_of_byte
+    char_lengths = byte_lengths - counts[:, _CONTINUATION]
+    script_counts = counts[:, :_CONTINUATION]
+    script_counts[:, SCRIPTS.index("ascii")] = char_lengths - script_counts.sum(axis=1)
+    dominant_script = numpy.argmax(script_counts, axis=1)
+
+    # Invalid UTF-8 made of continuation bytes only has no characters; it lands in the last bin.
+    ratio = byte_lengths / numpy.maximum(char_lengths, 1)
+    ratio_bin = numpy.minimum(numpy.searchsorted(RATIO_BINS, ratio), len(RATIO_BINS) - 1)
+    trimmed = byte_lengths > byte_limit
+    danger_zone = trimmed & (byte_lengths <= index_limit)
+
+    result.payloads += numpy.bincount(dominant_script, minlength=len(SCRIPTS))
+    result.bytes += numpy.bincount(dominant_script, weights=byte_lengths, minlength=len(SCRIPTS)).astype(numpy.int64)
+    numpy.add.at(result.ratio_histogram, (dominant_script, ratio_bin), 1)
+    result.trimmed += numpy.bincount(dominant_script[trimmed], minlength=len(SCRIPTS))
+    result.danger_zone += numpy.bincount(dominant_script[danger_zone], minlength=len(SCRIPTS))
+    result.over_index_limit += numpy.bincount(dominant_script[byte_lengths > index_limit], minlength=len(SCRIPTS))
+    result.max_bytes = int(byte_lengths.max())
+
+    # Payloads that are not trimmed have the same digest before and after trimming.
+    with memoryview(data) as view:
+        full_digests = _digests(view, starts, ends)
+        trimmed_digests = full_digests.copy()
+        trimmed_rows = numpy.flatnonzero(trimmed)
+        trimmed_ends = trim_ends(data, starts[trimmed_rows], ends[trimmed_rows], byte_limit)
+        trimmed_digests[trimmed_rows] = _digests(view, starts[trimmed_rows], trimmed_ends)
+    result.full_digests.append(full_digests)
+    result.trimmed_digests.append(trimmed_digests)
+    return result
+
+
+def line_rows(data):
+    """
+        Returns the start and end positions of the non-empty lines of a byte array.
+
+    :param data: A uint8 numpy array
+    :return: A tuple of int64 numpy arrays (starts, ends), ends exclude line terminators
+    """
+    newlines = numpy.flatnonzero(data == 0x0A)
+    starts = numpy.concatenate([[0], newlines + 1]).astype(numpy.int64)
+    ends = numpy.append(newlines, len(data)).astype(numpy.int64)
+    carriage_returns = (ends > starts) & (data[numpy.maximum(ends - 1, 0)] == 0x0D)
+    ends -= carriage_returns
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+
+def scan_chunk(task):
+    """
+        Scans one chunk of a file. Runs in a worker process.
+
+    :param task: A tuple (path, start, end, input_format, field, byte_limit, index_limit). For "lines" and "jsonl"
+                 input, the chunk covers the lines that start within [start, end) of the file.
+    :return: A ScanResult
+    """
+    path, start, end, input_format, field, byte_limit, index_limit = task
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if not size:
+            return ScanResult()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if input_format == "files":
+                data = numpy.frombuffer(mapped, dtype=numpy.uint8)
+                result = scan_rows(data, numpy.array([0]), numpy.array([size]), byte_limit, index_limit)
+                del data
+                return result
+
+            if start > 0:
+                start = mapped.find(b"\n", start - 1) + 1 or size
+            if end < size:
+                end = mapped.find(b"\n", end - 1) + 1 or size
+            else:
+                end = size
+            if start >= end:
+                return ScanResult()
+
+            data = numpy.frombuffer(mapped, dtype=numpy.uint8, count=end - start, offset=start)
+            starts, ends = line_rows(data)
+            if input_format == "jsonl":
+                with memoryview(data) as view:
+                    payloads = [json.loads(str(view[s:e], "utf-8")).get(field)
+                                for s, e in zip(starts.tolist(), ends.tolist())]
+                del data
+                buffer, offsets = pack_strings(a_payload for a_payload in payloads if a_payload)
+                data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+                starts, ends = offsets[:-1], offsets[1:]
+                # Rows are contiguous, there are no gaps to correct for.
+            result = scan_rows(data, starts, ends, byte_limit, index_limit)
+            del data
+            return result
+
+
+def make_tasks(paths, input_format, field, byte_limit, index_limit, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Splits a list of files and directories into scan tasks.
+
+    :return: A generator of task tuples for scan_chunk
+    """
+    for a_path in iter_paths(paths):
+        size = os.path.getsize(a_path)
+        if input_format == "files" or size <= chunk_size:
+            yield a_path, 0, size, input_format, field, byte_limit, index_limit
+            continue
+        for start in range(0, size, chunk_size):
+            yield a_path, start, min(start + chunk_size, size), input_format, field, byte_limit, index_limit
+
+
+def scan(paths, input_format="lines", field="payload", byte_limit=DEFAULT_BYTE_LIMIT, index_limit=INDEX_KEY_LIMIT,
+         workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Scans a corpus in parallel.
+
+    :param paths: A list of paths to files or directories
+    :param input_format: "lines", "jsonl" or "files" (see ingestion.py)
+    :param field: The payload field of "jsonl" input
+    :param byte_limit: An integer representing the byte length limit payloads are trimmed to
+    :param index_limit: The index key size limit of the server
+    :param workers: The number of worker processes (defaults to the number of CPUs)
+    :param chunk_size: Size in bytes of the chunks that files are split into
+    :return: A ScanResult
+    """
+    result = ScanResult()
+    tasks = make_tasks(paths, input_format, field, byte_limit, index_limit, chunk_size)
+    with multiprocessing.Pool(workers) as pool:
+        for a_result in pool.imap_unordered(scan_chunk, tasks):
+            result.merge(a_result)
+    result.count_collisions()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scans a corpus for payloads that are risky to index.")
+    parser.add_argument("paths", nargs="+", help="Files or directories to scan")
+    parser.add_argument("--format", dest="input_format", choices=["lines", "jsonl", "files"], default="lines",
+                        help="One payload per line, one JSON object per line or one payload per file")
+    parser.add_argument("--field", default="payload", help="The payload field of JSONL input")
+    parser.add_argument("--byte-limit", type=int, default=DEFAULT_BYTE_LIMIT, help="Byte limit payloads are trimmed to")
+    parser.add_argument("--index-limit", type=int, default=INDEX_KEY_LIMIT, help="Index key size limit of the server")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                        help="Size of the chunks files are split into, in megabytes")
+    parser.add_argument("--json", action="store_true", help="Write the statistics as JSON")
+    args = parser.parse_args()
+
+    scan_result = scan(args.paths, args.input_format, args.field, args.byte_limit, args.index_limit, args.workers,
+                       args.chunk_size * 1024 * 1024)
+    if args.json:
+        json.dump(scan_result.as_dict(), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        scan_result.write(sys.stdout, args.byte_limit, args.index_limit)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+"""
+Opt-in CPU and allocation profiling of ingestion runs.
+
+A Profiler records one of:
+
+* "sample": The stacks of all threads, every interval seconds, from a background thread. Its overhead does not depend
+            on how many functions are called, so it can stay on for a whole production load.
+* "deterministic": Every function call, through cProfile, in the thread that starts the profiler and in every thread
+                   started after it (e.g. the read-ahead thread that trims). This is exact but slows the run down.
+
+and optionally tracks allocations with tracemalloc.
+
+CPU profiles are written in the collapsed stack format of flamegraph.pl / speedscope ("frame;frame;frame count" per
+line, with counts in samples or microseconds), with a summary that attributes the time to UTF-8 handling, neomodel,
+the driver and everything else. Allocations are written as a report of the top allocating lines and stacks, and as
+collapsed stacks weighed in bytes.
+
+NOTE: cProfile records callers but not whole stacks. The stacks of a deterministic profile are reconstructed by
+      splitting the time of every function between its callers in proportion to the time spent under each of them.
+
+Profiling is enabled on the command line of the ingestion entry points (see add_profiling_arguments) or, without
+changing the command line, through the NEOMODLON_PROFILE, NEOMODLON_PROFILE_ALLOCATIONS, NEOMODLON_PROFILE_OUTPUT and
+NEOMODLON_PROFILE_INTERVAL environment variables.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import linecache
+import tracemalloc
+import collections
+
+# Seconds between the samples of the sampling profiler.
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Frames kept per allocation traceback by tracemalloc.
+ALLOCATION_FRAMES = 32
+
+# Frames shown per stack in the allocation report.
+ALLOCATION_REPORT_FRAMES = 8
+
+# Number of entries of the top lists in the reports.
+DEFAULT_TOP = 25
+
+# Fraction of the total time under which a reconstructed cProfile stack is dropped.
+MIN_STACK_FRACTION = 1e-5
+
+PROFILE_MODES = ["sample", "deterministic"]
+
+# Environment variables that enable profiling without command line options.
+ENVIRONMENT_MODE = "NEOMODLON_PROFILE"
+ENVIRONMENT_ALLOCATIONS = "NEOMODLON_PROFILE_ALLOCATIONS"
+ENVIRONMENT_OUTPUT = "NEOMODLON_PROFILE_OUTPUT"
+ENVIRONMENT_INTERVAL = "NEOMODLON_PROFILE_INTERVAL"
+
+# The categories of the summary, checked in order: (name, top level modules, substrings of the function name).
+# A sample is attributed to the first category that any of its frames, from the innermost outwards, belongs to.
+# Stacks that end in a wait of one thread for another (e.g. the writer for the read-ahead thread) count as "waiting".
+CATEGORIES = [("waiting", ("threading", "queue"), ("acquire", "posix.waitpid")),
+              ("utf-8", ("trimming", "batch_trimming", "codecs", "encodings"), ("encode", "decode", "trim")),
+              ("driver", ("neo4j", "socket", "ssl", "selectors"), ()),
+              ("neomodel", ("neomodel",), ())]
+
+
+def _module_name(module_name, filename):
+    """
+        Returns the name of a module, using the file name of scripts instead of "__main__".
+    """
+    if module_name.startswith("__"):
+        return os.path.splitext(os.path.basename(filename))[0]
+    return module_name
+
+
+def _module_label(module_name, function_name, lineno=None):
+    if lineno is None:
+        return "{}:{}".format(module_name, function_name)
+    return "{}:{}:{}".format(module_name, function_name, lineno)
+
+
+def _module_names_by_file():
+    """
+        Returns the module name of every loaded source file.
+    """
+    names = {}
+    for a_name, a_module in list(sys.modules.items()):
+        a_file = getattr(a_module, "__file__", None)
+        if a_file:
+            names[os.path.abspath(a_file)] = a_name
+    return names
+
+
+def _module_of_file(filename, names):
+    return _module_name(names.get(os.path.abspath(filename), "__main__"), filename)
+
+
+def category(stack):
+    """
+        Returns the summary category of a collapsed stack.
+
+    :param stack: A tuple of frame labels ("module:function[:line]", or the name of a builtin), outermost first
+    :return: A category name of CATEGORIES or "other"
+    """
+    for a_frame in reversed(stack):
+        module_name, _, function_name = a_frame.partition(":")
+        for a_category, modules, function_parts in CATEGORIES:
+            if module_name.split(".")[0] in modules or any(a_part in (function_name or a_frame)
+                                                           for a_part in function_parts):
+                return a_category
+    return "other"
+
+
+def write_folded(stacks, path):
+    """
+        Writes stacks in the collapsed stack format, one "frame;frame;frame count" line per stack.
+
+    :param stacks: A dict of tuples of frame labels to numbers. Numbers are rounded to integers.
+    :param path: The file to write
+    """
+    with open(path, "wt", encoding="utf-8") as fd:
+        for a_stack, a_count in sorted(stacks.items()):
+            a_count = int(round(a_count))
+            if a_count > 0:
+                fd.write("{} {}\n".format(";".join(a_frame.replace(";", ",").replace(" ", "_")
+                                                   for a_frame in a_stack), a_count))
+
+
+def write_summary(stacks, path, unit, top=DEFAULT_TOP):
+    """
+        Writes the share of every category and the frames with the most self time.
+
+    :param stacks: A dict of tuples of frame labels to numbers
+    :param path: The file to write
+    :param unit: What the numbers count (e.g. "samples")
+    :param top: The number of frames listed
+    """
+    total = sum(stacks.values()) or 1
+    by_category = collections.Counter()
+    by_frame = collections.Counter()
+    for a_stack, a_count in stacks.items():
+        by_category[category(a_stack)] += a_count
+        by_frame[a_stack[-1]] += a_count
+    with open(path, "wt", encoding="utf-8") as fd:
+        fd.write("Total: {:.0f} {}\n\nBy category:\n".format(total, unit))
+        for a_category, a_count in by_category.most_common():
+            fd.write("    {:>6.1f}%  {}\n".format(100.0 * a_count / total, a_category))
+        fd.write("\nTop {} frames by self {}:\n".format(top, unit))
+        for a_frame, a_count in by_frame.most_common(top):
+            fd.write("    {:>6.1f}%  {}\n".format(100.0 * a_count / total, a_frame))
+
+
+class StackSampler(object):
+    """
+        Counts the stacks of all threads, sampled from a background thread.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {a_thread.ident: a_thread.name for a_thread in threading.enumerate()}
+            for a_thread, a_frame in sys._current_frames().items():
+                if a_thread == own_thread:
+                    continue
+                stack = []
+                while a_frame is not None:
+                    stack.append(_module_label(_module_name(a_frame.f_globals.get("__name__", "__main__"),
+                                                            a_frame.f_code.co_filename),
+                                               a_frame.f_code.co_name, a_frame.f_lineno))
+                    a_frame = a_frame.f_back
+                stack.append(thread_names.get(a_thread, "thread-{}".format(a_thread)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+
+def profile_stacks(stats, min_fraction=MIN_STACK_FRACTION):
+    """
+        Reconstructs stacks from the caller graph of a cProfile profile.
+
+    :param stats: The stats dict of a pstats.Stats: function -> (cc, nc, tt, ct, callers)
+    :param min_fraction: Fraction of the total time under which a stack is not followed further
+    :return: A Counter of tuples of frame labels to microseconds of self time
+    """
+    names = _module_names_by_file()
+
+    def label(function):
+        filename, lineno, function_name = function
+        if filename == "~":
+            return function_name
+        return _module_label(_module_of_file(filename, names), function_name)
+
+    callees = collections.defaultdict(list)
+    for a_function, (_, _, _, _, callers) in stats.items():
+        for a_caller, an_edge in callers.items():
+            callees[a_caller].append((a_function, an_edge[3]))
+    roots = [a_function for a_function, (_, _, _, _, callers) in stats.items() if not callers]
+    min_time = sum(stats[a_root][3] for a_root in roots) * min_fraction
+
+    stacks = collections.Counter()
+    pending = [((a_root,), stats[a_root][3]) for a_root in roots]
+    while pending:
+        path, time_in_path = pending.pop()
+        _, _, self_time, total_time, _ = stats[path[-1]]
+        fraction = time_in_path / total_time if total_time else 0.0
+        stacks[tuple(label(a_function) for a_function in path)] += self_time * fraction * 1e6
+        for a_callee, edge_time in callees[path[-1]]:
+            callee_time = edge_time * fraction
+            # Recursive calls are already counted in the time of the outer call.
+            if callee_time >= min_time and a_callee not in path:
+                pending.append((path + (a_callee,), callee_time))
+    return stacks
+
+
+class _ThreadProfilers(object):
+    """
+        Runs one cProfile.Profile in the current thread and in every thread started after it.
+    """
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def _thread_hook(self, frame, event, arg):
+        # Called on the first event of a new thread: replaces itself by a profiler for that thread.
+        sys.setprofile(None)
+        self._new_profile()
+
+    def start(self):
+        threading.setprofile(self._thread_hook)
+        self._new_profile()
+        return self
+
+    def stop(self):
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self.profiles)
+        # Disabling only takes effect in the calling thread. The others keep recording until they finish.
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for a_profile in profiles[1:]:
+            stats.add(a_profile)
+        return stats
+
+
+class Profiler(object):
+    """
+        Profiles a run and writes its reports, next to each other, under a common path prefix.
+    """
+    def __init__(self, output_prefix, mode=None, allocations=False, interval=DEFAULT_SAMPLE_INTERVAL,
+                 top=DEFAULT_TOP):
+        """
+            Initialises the profiler.
+
+        :param output_prefix: The path prefix of the report files
+        :param mode: "sample", "deterministic" or None for no CPU profiling
+        :param allocations: Whether to track allocations with tracemalloc
+        :param interval: Seconds between samples in "sample" mode
+        :param top: The number of entries of the top lists in the reports
+        """
+        if mode not in PROFILE_MODES + [None]:
+            raise ValueError("Unknown profiling mode {}, expected one of {}".format(mode, PROFILE_MODES))
+        self.output_prefix = output_prefix
+        self.mode = mode
+        self.allocations = allocations
+        self.interval = interval
+        self.top = top
+        self._sampler = None
+        self._thread_profilers = None
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.allocations:
+            tracemalloc.start(ALLOCATION_FRAMES)
+        if self.mode == "sample":
+            self._sampler = StackSampler(self.interval).start()
+        elif self.mode == "deterministic":
+            self._thread_profilers = _ThreadProfilers().start()
+        return self
+
+    def stop(self):
+        """
+            Stops profiling and writes the reports.
+
+        :return: The list of files written
+        """
+        written = []
+        if self._sampler is not None:
+            self._sampler.stop()
+            written += self._write_cpu(self._sampler.stacks, "samples")
+        if self._thread_profilers is not None:
+            stats = self._thread_profilers.stop()
+            stats.dump_stats(self.output_prefix + ".pstats")
+            written.append(self.output_prefix + ".pstats")
+            written += self._write_cpu(profile_stacks(stats.stats), "microseconds")
+        if self.allocations:
+            snapshot = tracemalloc.take_snapshot()
+            current_size, peak_size = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            written += self._write_allocations(snapshot, current_size, peak_size)
+        return written
+
+    def _write_cpu(self, stacks, unit):
+        folded_path = self.output_prefix + ".cpu.folded"
+        summary_path = self.output_prefix + ".cpu.txt"
+        write_folded(stacks, folded_path)
+        write_summary(stacks, summary_path, unit, self.top)
+        return [folded_path, summary_path]
+
+    def _write_allocations(self, snapshot, current_size, peak_size):
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, linecache.__file__)])
+        names = _module_names_by_file()
+        report_path = self.output_prefix + ".allocations.txt"
+        folded_path = self.output_prefix + ".allocations.folded"
+        with open(report_path, "wt", encoding="utf-8") as fd:
+            fd.write("Allocated at the end of the run: {:.1f} KiB, peak: {:.1f} KiB, run time {:.1f} s\n".format(
+                current_size / 1024, peak_size / 1024, time.perf_counter() - self._started))
+            fd.write("\nTop {} lines by allocated size:\n".format(self.top))
+            for a_statistic in snapshot.statistics("lineno")[:self.top]:
+                a_frame = a_statistic.traceback[0]
+                fd.write("    {:>10.1f} KiB {:>9} blocks  {}:{}\n        {}\n".format(
+                    a_statistic.size / 1024, a_statistic.count, a_frame.filename, a_frame.lineno,
+                    linecache.getline(a_frame.filename, a_frame.lineno).strip()))
+            fd.write("\nTop {} stacks by allocated size:\n".format(self.top))
+            for a_statistic in snapshot.statistics("traceback")[:self.top]:
+                fd.write("    {:>10.1f} KiB {:>9} blocks\n".format(a_statistic.size / 1024, a_statistic.count))
+                for a_line in a_statistic.traceback.format(limit=ALLOCATION_REPORT_FRAMES, most_recent_first=True):
+                    fd.write("        {}\n".format(a_line))
+
+        stacks = collections.Counter()
+        for a_statistic in snapshot.statistics("traceback"):
+            # Since Python 3.7 the frames of a tracemalloc traceback are ordered from the oldest, like a stack.
+            stacks[tuple("{}:{}".format(_module_of_file(a_frame.filename, names), a_frame.lineno)
+                         for a_frame in a_statistic.traceback)] += a_statistic.size
+        write_folded(stacks, folded_path)
+        return [report_path, folded_path]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def add_profiling_arguments(parser):
+    """
+        Adds the profiling options to a command line parser, with defaults taken from the environment. Environment
+        values are validated like the options themselves, with parser.error() on the first invalid one.
+
+    :param parser: An argparse.ArgumentParser
+    :return: parser
+    """
+    mode = os.environ.get(ENVIRONMENT_MODE) or None
+    if mode not in PROFILE_MODES + [None]:
+        parser.error("{}: invalid choice: {!r} (choose from {})".format(
+            ENVIRONMENT_MODE, mode, ", ".join(repr(a_mode) for a_mode in PROFILE_MODES)))
+    allocations = os.environ.get(ENVIRONMENT_ALLOCATIONS, "")
+    if allocations not in ("", "0", "1"):
+        parser.error("{}: invalid value: {!r} (choose from '0', '1')".format(ENVIRONMENT_ALLOCATIONS, allocations))
+    interval = os.environ.get(ENVIRONMENT_INTERVAL)
+    try:
+        interval = float(interval) if interval is not None else DEFAULT_SAMPLE_INTERVAL
+    except ValueError:
+        parser.error("{}: invalid float value: {!r}".format(ENVIRONMENT_INTERVAL, interval))
+    if interval <= 0:
+        parser.error("{}: the interval must be positive, not {!r}".format(ENVIRONMENT_INTERVAL, interval))
+
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=mode,
+                        help="Profile CPU time by sampling stacks or deterministically (env: {})".format(
+                            ENVIRONMENT_MODE))
+    parser.add_argument("--profile-allocations", action="store_true", default=allocations == "1",
+                        help="Track allocations with tracemalloc (env: {}=1)".format(ENVIRONMENT_ALLOCATIONS))
+    parser.add_argument("--profile-output", default=os.environ.get(ENVIRONMENT_OUTPUT, "neomodlon-profile"),
+                        help="Path prefix of the profiling reports (env: {})".format(ENVIRONMENT_OUTPUT))
+    parser.add_argument("--profile-interval", type=float, default=interval,
+                        help="Seconds between samples of --profile sample (env: {})".format(ENVIRONMENT_INTERVAL))
+    return parser
+
+
+def profiling_settings(args, suffix=None):
+    """
+        Returns the Profiler arguments requested on the command line, or None.
+
+    :param args: The arguments parsed by a parser passed to add_profiling_arguments()
+    :param suffix: Appended to the output prefix, e.g. to tell the reports of worker processes apart
+    :return: None, or a tuple (output_prefix, mode, allocations, interval)
+    """
+    if args.profile is None and not args.profile_allocations:
+        return None
+    output_prefix = args.profile_output if suffix is None else "{}.{}".format(args.profile_output, suffix)
+    return output_prefix, args.profile, args.profile_allocations, args.profile_interval
+
+
+def start_profiling(settings):
+    """
+        Starts a Profiler.
+
+    :param settings: None, or a tuple as returned by profiling_settings()
+    :return: A started Profiler, or None
+    """
+    if settings is None:
+        return None
+    return Profiler(*settings).start()
+
+
+def stop_profiling(profiler, stream=sys.stderr):
+    """
+        Stops a Profiler, if there is one, and lists the files it wrote.
+
+    :param profiler: A Profiler or None
+    :param stream: A text stream (e.g. sys.stderr)
+    """
+    if profiler is None:
+        return
+    for a_path in profiler.stop():
+        stream.write("Profile written to {}\n".format(a_path))
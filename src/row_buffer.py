@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+A lightweight, columnar buffer of rows for the bulk write paths.
+
+StructuredNode.deflate(), which bulk_create used to call for every row, looks up the defined properties of the model,
+calls the validating deflate() of every property and generates every UniqueIdProperty value with its own
+uuid.uuid4() call, once per row. A RowBuffer instead holds one plain list per property and validates a whole batch
+one property at a time:
+
+* Values that already have the native type of a plain property (str for a StringProperty without choices or a
+  UniqueIdProperty, int, float and bool for IntegerProperty, FloatProperty and BooleanProperty) are taken as they
+  are, since deflating them would return them unchanged. All other values go through the property's deflate().
+* The UniqueIdProperty values of a batch are generated from a single os.urandom() call.
+* Missing required (or uniquely indexed) values are reported per row with the same RequiredProperty exception.
+
+No model instance is created, unless one is asked for with instance().
+
+Models can derive property values from others (e.g. the digest keys of IndexSafeNode) with a derive_row_values(row)
+classmethod, which is called for every row appended. A model that overrides deflate() without providing that hook is
+deflated one row at a time through its own deflate(), so that whatever it does is not bypassed.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import neomodel
+
+# The type of the values that the deflate() of a property class returns unchanged.
+_NATIVE_TYPES = {neomodel.StringProperty: str,
+                 neomodel.UniqueIdProperty: str,
+                 neomodel.IntegerProperty: int,
+                 neomodel.FloatProperty: float,
+                 neomodel.BooleanProperty: bool}
+
+
+def unique_ids(count):
+    """
+        Generates random identifiers in the format of UniqueIdProperty (uuid.uuid4().hex), from a single read of the
+        system's random number generator.
+
+    :param count: The number of identifiers
+    :return: A list of 32 character hexadecimal strings
+    """
+    data = bytearray(os.urandom(16 * count))
+    # Version 4 and RFC 4122 variant bits, as set by uuid.uuid4().
+    data[6::16] = bytes((a_byte & 0x0F) | 0x40 for a_byte in data[6::16])
+    data[8::16] = bytes((a_byte & 0x3F) | 0x80 for a_byte in data[8::16])
+    hexadecimal = data.hex()
+    return [hexadecimal[an_offset:an_offset + 32] for an_offset in range(0, 32 * count, 32)]
+
+
+def _deflate_owner(model):
+    """
+        Returns the class whose deflate() a model uses.
+    """
+    return next(a_class for a_class in model.__mro__ if "deflate" in a_class.__dict__)
+
+
+def _native_type(a_property):
+    """
+        Returns the type of the values that a property stores without conversion, or None.
+    """
+    if getattr(a_property, "choices", None):
+        return None
+    return _NATIVE_TYPES.get(type(a_property))
+
+
+class RowBuffer(object):
+    """
+        Rows of property values of one model, held as one list per property.
+    """
+    def __init__(self, model):
+        """
+            Initialises an empty buffer.
+
+        :param model: A neomodel.StructuredNode class
+        """
+        self.model = model
+        self.derive_row_values = getattr(model, "derive_row_values", None)
+        deflate_owner = _deflate_owner(model)
+        # Whether deflate() is overridden by something other than the provider of derive_row_values.
+        self.model_deflate = deflate_owner is not neomodel.properties.PropertyManager and \
+            "derive_row_values" not in deflate_owner.__dict__
+        self.properties = list(model.defined_properties(aliases=False, rels=False).items())
+        self.columns = {a_name: [] for a_name, _ in self.properties}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        """
+            Adds a row.
+
+        :param row: A dict of property values, keyed by property name. Other keys are ignored, as by deflate().
+        """
+        if self.derive_row_values is not None:
+            row = self.derive_row_values(row)
+        for a_name, a_column in self.columns.items():
+            a_column.append(row.get(a_name))
+        self.size += 1
+
+    def clear(self):
+        for a_column in self.columns.values():
+            del a_column[:]
+        self.size = 0
+
+    def row(self, index):
+        """
+            Returns a row as a dict of the property values it was given.
+        """
+        return {a_name: a_column[index] for a_name, a_column in self.columns.items() if a_column[index] is not None}
+
+    def instance(self, index):
+        """
+            Returns a (not yet saved) model instance of a row.
+        """
+        return self.model(**self.row(index))
+
+    def deflate(self):
+        """
+            Validates all rows and converts them to database values, as the deflate(row, skip_empty=True) of the model
+            would, one property at a time.
+
+        :return: A tuple of a list of (index, deflated row) tuples of the valid rows, keyed by database property name,
+                 and a list of (index, exception) tuples of the invalid ones
+        """
+        if self.model_deflate:
+            return self._deflate_rows()
+        deflated_rows = [{} for _ in range(self.size)]
+        errors = {}
+        for a_name, a_property in self.properties:
+            db_property = a_property.db_property or a_name
+            values = self.columns[a_name]
+            missing = [an_index for an_index, a_value in enumerate(values) if a_value is None]
+            if missing:
+                values = list(values)
+                if a_property.has_default:
+                    if type(a_property) is neomodel.UniqueIdProperty:
+                        defaults = unique_ids(len(missing))
+                    else:
+                        defaults = [a_property.default_value() for _ in missing]
+                    for an_index, a_default in zip(missing, defaults):
+                        values[an_index] = a_default
+                elif a_property.required or a_property.unique_index:
+                    for an_index in missing:
+                        errors.setdefault(an_index, neomodel.RequiredProperty(a_name, self.model))
+
+            native_type = _native_type(a_property)
+            for an_index, (a_deflated_row, a_value) in enumerate(zip(deflated_rows, values)):
+                if a_value is None:
+                    continue
+                if type(a_value) is not native_type:
+                    try:
+                        a_value = a_property.deflate(a_value)
+                    except neomodel.DeflateError as e:
+                        errors.setdefault(an_index, e)
+                        continue
+                a_deflated_row[db_property] = a_value
+
+        valid_rows = [(an_index, a_deflated_row) for an_index, a_deflated_row in enumerate(deflated_rows)
+                      if an_index not in errors]
+        return valid_rows, sorted(errors.items())
+
+    def _deflate_rows(self):
+        """
+            deflate() through the model's own deflate(), one row at a time.
+        """
+        valid_rows = []
+        errors = []
+        for an_index in range(self.size):
+            try:
+                valid_rows.append((an_index, self.model.deflate(self.row(an_index), skip_empty=True)))
+            except (neomodel.DeflateError, neomodel.RequiredProperty) as e:
+                errors.append((an_index, e))
+        return valid_rows, errors
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Incremental installation of the indexes and unique constraints of neomodel node classes.
+
+neomodel_install_labels re-issues every CREATE INDEX and CREATE CONSTRAINT of every class on every run and stops at
+the first one that fails. Instead, this script reads the schema of the database (CALL db.indexes() and
+CALL db.constraints()), compares it with the schema declared by the node classes of the given modules and only
+creates what is missing. A statement that fails (e.g. a unique constraint over existing duplicates) is reported and
+the remaining ones are still applied.
+
+After a successful run, a fingerprint of the declared schema is cached per database host. As long as the declared
+schema does not change, later runs against the same host only read the schema of the database to confirm that all of
+it is still there, and send nothing else. A database that has been wiped or recreated on the same host no longer
+holds it, so the schema is then checked and created again. --force checks the database regardless.
+
+Usage: python schema_sync.py [--host host:port] [--dry-run] [--force] module.py [module.py ...]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import importlib
+import collections
+import neo4j
+import neomodel
+from ingestion import connect_from_environment
+
+# File that holds the fingerprint of the last schema installed on every host.
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "neomodlon", "schema_sync.json")
+
+# A single index or unique constraint.
+# kind: "index" or "constraint"
+SchemaItem = collections.namedtuple("SchemaItem", ["kind", "label", "property_name"])
+
+# The outcome of comparing the declared schema with that of the database.
+# missing: SchemaItems that are declared but do not exist
+# extra: SchemaItems that exist but are not declared (they are reported, never dropped)
+# conflicts: (declared, existing) SchemaItem pairs of the same label and property but of different kind
+# failed: Index descriptions whose state is not ONLINE
+SchemaDiff = collections.namedtuple("SchemaDiff", ["missing", "extra", "conflicts", "failed"])
+
+_CONSTRAINT_DESCRIPTION = re.compile(r"CONSTRAINT ON \(\s*(\w+):`?(\w+)`?\s*\) ASSERT \1\.`?(\w+)`? IS UNIQUE",
+                                     re.IGNORECASE)
+_INDEX_DESCRIPTION = re.compile(r"INDEX ON :`?(\w+)`?\(`?(\w+)`?\)", re.IGNORECASE)
+
+
+def load_modules(names):
+    """
+        Imports modules given as file paths (module.py) or dotted module names, like neomodel_install_labels does.
+
+    :param names: A list of file paths or module names
+    :return: The list of the names of the imported modules
+    """
+    module_names = []
+    for a_name in names:
+        if a_name.lower().endswith(".py"):
+            sys.path.insert(0, os.path.dirname(os.path.abspath(a_name)))
+            module_name = os.path.splitext(os.path.basename(a_name))[0]
+        else:
+            sys.path.insert(0, os.path.abspath(os.curdir))
+            module_name = a_name
+        importlib.import_module(module_name)
+        module_names.append(module_name)
+    return module_names
+
+
+def node_classes(module_names=None):
+    """
+        Returns the concrete neomodel.StructuredNode classes that have been imported.
+
+    :param module_names: Only return the classes defined in these modules (default: all of them)
+    :return: A list of classes
+    """
+    found = []
+    pending = list(neomodel.StructuredNode.__subclasses__())
+    while pending:
+        a_class = pending.pop(0)
+        pending.extend(a_class.__subclasses__())
+        if a_class.__dict__.get("__abstract_node__") or not hasattr(a_class, "__label__"):
+            continue
+        if module_names is None or a_class.__module__ in module_names:
+            found.append(a_class)
+    return found
+
+
+def declared_schema(classes):
+    """
+        Returns the indexes and unique constraints that neomodel.install_labels would create for a list of classes.
+
+    :param classes: A list of neomodel.StructuredNode classes
+    :return: A set of SchemaItems
+    """
+    schema = set()
+    for a_class in classes:
+        for a_name, a_property in a_class.defined_properties(aliases=False, rels=False).items():
+            db_property = a_property.db_property or a_name
+            if a_property.index:
+                schema.add(SchemaItem("index", a_class.__label__, db_property))
+            elif a_property.unique_index:
+                schema.add(SchemaItem("constraint", a_class.__label__, db_property))
+    return schema
+
+
+def existing_schema():
+    """
+        Reads the indexes and unique constraints of the database.
+
+        NOTE: Every unique constraint is backed by an index, which is listed by db.indexes() as well. Those indexes
+              are part of their constraint and are not returned separately.
+
+    :return: A tuple of a set of SchemaItems and a list of the descriptions of indexes whose state is not ONLINE
+    """
+    schema = set()
+    results, _ = neomodel.db.cypher_query("CALL db.constraints()")
+    for a_row in results:
+        match = _CONSTRAINT_DESCRIPTION.search(a_row[0])
+        if match:
+            schema.add(SchemaItem("constraint", match.group(2), match.group(3)))
+
+    failed = []
+    results, columns = neomodel.db.cypher_query("CALL db.indexes()")
+    for a_row in results:
+        a_row = dict(zip(columns, a_row))
+        match = _INDEX_DESCRIPTION.search(a_row["description"])
+        if not match:
+            continue
+        if a_row.get("state", "ONLINE") != "ONLINE":
+            failed.append("{} ({})".format(a_row["description"], a_row["state"]))
+        item = SchemaItem("index", match.group(1), match.group(2))
+        if a_row.get("type") != "node_unique_property" and item._replace(kind="constraint") not in schema:
+            schema.add(item)
+    return schema, failed
+
+
+def diff_schema(declared, existing, failed=()):
+    """
+        Compares the declared schema with that of the database.
+
+    :param declared: A set of SchemaItems, as returned by declared_schema()
+    :param existing: A set of SchemaItems, as returned by existing_schema()
+    :param failed: The descriptions of indexes whose state is not ONLINE
+    :return: A SchemaDiff
+    """
+    existing_by_key = {(an_item.label, an_item.property_name): an_item for an_item in existing}
+    missing = []
+    conflicts = []
+    for an_item in sorted(declared - existing):
+        other = existing_by_key.get((an_item.label, an_item.property_name))
+        if other is None:
+            missing.append(an_item)
+        else:
+            conflicts.append((an_item, other))
+    conflicting = {an_existing for _, an_existing in conflicts}
+    extra = sorted(existing - declared - conflicting)
+    return SchemaDiff(missing, extra, conflicts, list(failed))
+
+
+def schema_statement(item):
+    """
+        Returns the statement that creates an index or unique constraint, as issued by neomodel.install_labels.
+    """
+    if item.kind == "index":
+        return "CREATE INDEX on :{}({}); ".format(item.label, item.property_name)
+    return "CREATE CONSTRAINT on (n:{}) ASSERT n.{} IS UNIQUE; ".format(item.label, item.property_name)
+
+
+def apply_schema(items, stdout=sys.stdout):
+    """
+        Creates indexes and unique constraints, one statement at a time.
+
+    :param items: A list of SchemaItems
+    :param stdout: A text stream for progress messages
+    :return: A list of (SchemaItem, exception) tuples for the statements that failed
+    """
+    failures = []
+    for an_item in items:
+        try:
+            neomodel.db.cypher_query(schema_statement(an_item))
+            stdout.write(" + Created {} on :{}({})\n".format(an_item.kind, an_item.label, an_item.property_name))
+        except neo4j.exceptions.CypherError as e:
+            stdout.write(" ! Failed to create {} on :{}({}): {}: {}\n".format(
+                an_item.kind, an_item.label, an_item.property_name, type(e).__name__, e))
+            failures.append((an_item, e))
+    return failures
+
+
+def schema_fingerprint(declared):
+    """
+        Returns a digest of a declared schema that does not depend on the order of its items.
+
+    :param declared: A set of SchemaItems
+    :return: A hexadecimal string
+    """
+    return hashlib.sha256(json.dumps(sorted(declared)).encode("utf-8")).hexdigest()
+
+
+def read_cache(path):
+    try:
+        with open(path, "rt") as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "wt") as fd:
+        json.dump(cache, fd, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def sync_schema(declared, dry_run=False, stdout=sys.stdout):
+    """
+        Creates the missing part of a declared schema and reports everything else that differs.
+
+    :param declared: A set of SchemaItems, as returned by declared_schema()
+    :param dry_run: Whether to only report what would be created
+    :param stdout: A text stream for progress messages
+    :return: A tuple of the SchemaDiff and the list of (SchemaItem, exception) tuples of the statements that failed
+    """
+    existing, failed = existing_schema()
+    diff = diff_schema(declared, existing, failed)
+    for a_declared, an_existing in diff.conflicts:
+        stdout.write(" ! :{}({}) is declared as {} but exists as {}\n".format(
+            a_declared.label, a_declared.property_name, a_declared.kind, an_existing.kind))
+    for a_description in diff.failed:
+        stdout.write(" ! Index {} is not online\n".format(a_description))
+    for an_item in diff.extra:
+        stdout.write(" ? {} on :{}({}) is not declared by any class\n".format(
+            an_item.kind.capitalize(), an_item.label, an_item.property_name))
+    if dry_run:
+        for an_item in diff.missing:
+            stdout.write(" + Would create {} on :{}({})\n".format(an_item.kind, an_item.label, an_item.property_name))
+        return diff, []
+    return diff, apply_schema(diff.missing, stdout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates the missing indexes and constraints of neomodel classes.")
+    parser.add_argument("modules", nargs="+", help="Python files or modules that define the node classes")
+    parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="File of the cached schema fingerprints")
+    parser.add_argument("--force", action="store_true", help="Check the database even if the schema is unchanged")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be created")
+    args = parser.parse_args()
+
+    declared = declared_schema(node_classes(load_modules(args.modules)))
+    fingerprint = schema_fingerprint(declared)
+    cache = read_cache(args.cache)
+
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+
+    if not args.force and not args.dry_run and cache.get(args.host) == fingerprint:
+        # The host may now serve a different (e.g. wiped) database, which the fingerprint alone cannot tell.
+        if declared <= existing_schema()[0]:
+            sys.stdout.write("The {} declared indexes and constraints are unchanged since the last run on {}.\n"
+                             .format(len(declared), args.host))
+            sys.exit(0)
+        sys.stdout.write("The database on {} no longer holds the schema of the last run, checking it again.\n".format(
+            args.host))
+
+    diff, failures = sync_schema(declared, args.dry_run)
+    sys.stdout.write("{} declared, {} missing, {} failed, {} conflicting, {} not declared.\n".format(
+        len(declared), len(diff.missing), len(failures), len(diff.conflicts), len(diff.extra)))
+    if failures or diff.conflicts or diff.failed:
+        sys.exit(1)
+    if not args.dry_run:
+        cache[args.host] = fingerprint
+        write_cache(args.cache, cache)
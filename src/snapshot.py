@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+Columnar snapshots of the nodes of a neomodel class, for rebuilding a database without re-running the pipeline that
+loaded it.
+
+Export reads the nodes of a label by ranges of --page-size node ids, up to the highest id of the label, each range in
+its own short transaction. The nodes of a range are fetched by id (a NodeByIdSeek), so no page scans the label,
+whose cost would grow with its size, and neither does SKIP, whose cost grows with the offset. Every --page-size nodes
+become one row group of the snapshot file, in which every property is stored as a column:
+
+    int, float, bool: A validity byte per row and a NumPy array of int64, float64 or uint8 values
+    string, bytes, json: A validity byte per row, int64 offsets of n+1 elements and the concatenated UTF-8 (or raw,
+                         or JSON encoded) values, row i occupying data[offsets[i]:offsets[i+1]] as in batch_trimming
+
+The file is a sequence of blocks, each a little-endian uint32 length followed by that many bytes: the MAGIC bytes,
+a JSON header, then per row group a JSON description of its columns followed by their buffers (zlib compressed with
+--compress), and finally an empty block. It can therefore be written and read as a stream.
+
+Restore reads the row groups back and creates the nodes through bulk_create, batch_size nodes per transaction,
+sending the stored database values as they are. Node ids are not preserved. With --merge-on a uniquely indexed
+property, restoring is idempotent.
+
+NOTE: Every range is read in its own transaction, so a snapshot of a database that is being written to is not
+      consistent across ranges, and nodes created after the export has started are not included.
+
+Usage: python snapshot.py export --model module.Class --output nodes.snapshot [--page-size N] [--compress]
+       python snapshot.py restore --model module.Class --input nodes.snapshot [--batch-size N] [--merge-on property]
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import sys
+import json
+import zlib
+import struct
+import argparse
+import numpy
+import neomodel
+from batch_trimming import pack_strings
+from bulk_writer import DEFAULT_BATCH_SIZE, bulk_create
+from ingestion import load_model, connect_from_environment
+from index_consistency import highest_id
+
+MAGIC = b"NEOMODLON-SNAPSHOT-1"
+
+# Nodes read per page, and stored per row group.
+DEFAULT_PAGE_SIZE = 10000
+
+_LENGTH = struct.Struct("<I")
+
+_INT64_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+_NUMERIC_DTYPES = {"int": numpy.int64, "float": numpy.float64, "bool": numpy.uint8}
+
+
+class SnapshotError(Exception):
+    """
+        Raised when a file is not a valid snapshot or does not match the model it is restored to.
+    """
+    pass
+
+
+def column_type(values):
+    """
+        Returns the column type that stores a list of property values without loss.
+
+    :param values: A list of property values, None where a node does not have the property
+    :return: "null", "bool", "int", "float", "string", "bytes" or "json"
+    """
+    types = {type(a_value) for a_value in values if a_value is not None}
+    if not types:
+        return "null"
+    if types == {bool}:
+        return "bool"
+    if types == {int}:
+        if all(_INT64_RANGE[0] <= a_value <= _INT64_RANGE[1] for a_value in values if a_value is not None):
+            return "int"
+        return "json"
+    if types == {float}:
+        return "float"
+    if types == {str}:
+        return "string"
+    if types <= {bytes, bytearray}:
+        return "bytes"
+    return "json"
+
+
+def encode_column(values, kind):
+    """
+        Encodes a list of property values as the buffers of a column.
+
+    :param values: A list of property values, None where a node does not have the property
+    :param kind: The column type, as returned by column_type()
+    :return: A list of bytes objects
+    """
+    if kind == "null":
+        return []
+    validity = numpy.array([a_value is not None for a_value in values], dtype=numpy.uint8).tobytes()
+    if kind in _NUMERIC_DTYPES:
+        return [validity, numpy.array([a_value if a_value is not None else 0 for a_value in values],
+                                      dtype=_NUMERIC_DTYPES[kind]).tobytes()]
+    if kind == "string":
+        data, offsets = pack_strings(a_value if a_value is not None else "" for a_value in values)
+    else:
+        if kind == "json":
+            encoded_values = [json.dumps(a_value).encode("utf-8") if a_value is not None else b""
+                              for a_value in values]
+        else:
+            encoded_values = [bytes(a_value) if a_value is not None else b"" for a_value in values]
+        offsets = numpy.zeros(len(encoded_values) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(an_encoded_value) for an_encoded_value in encoded_values], out=offsets[1:])
+        data = b"".join(encoded_values)
+    return [validity, offsets.tobytes(), data]
+
+
+def decode_column(buffers, kind, rows):
+    """
+        Decodes the buffers of a column back to a list of property values.
+
+    :param buffers: A list of bytes objects, as returned by encode_column()
+    :param kind: The column type
+    :param rows: The number of rows of the column
+    :return: A list of property values, None where a node does not have the property
+    """
+    if kind == "null":
+        return [None] * rows
+    present = numpy.frombuffer(buffers[0], dtype=numpy.uint8).astype(bool).tolist()
+    if kind in _NUMERIC_DTYPES:
+        values = numpy.frombuffer(buffers[1], dtype=_NUMERIC_DTYPES[kind])
+        values = values.astype(bool).tolist() if kind == "bool" else values.tolist()
+        return [a_value if is_present else None for a_value, is_present in zip(values, present)]
+    offsets = numpy.frombuffer(buffers[1], dtype=numpy.int64).tolist()
+    data = memoryview(buffers[2])
+    values = []
+    for start, end, is_present in zip(offsets[:-1], offsets[1:], present):
+        if not is_present:
+            values.append(None)
+        elif kind == "string":
+            values.append(str(data[start:end], "utf-8"))
+        elif kind == "json":
+            values.append(json.loads(str(data[start:end], "utf-8")))
+        else:
+            values.append(bytes(data[start:end]))
+    return values
+
+
+class SnapshotWriter(object):
+    """
+        Writes the blocks of a snapshot to a binary stream.
+    """
+    def __init__(self, stream, header, compress=False):
+        """
+            Writes the magic bytes and the header.
+
+        :param stream: A binary stream
+        :param header: A JSON serialisable dict that describes the snapshot
+        :param compress: Whether column buffers are zlib compressed
+        """
+        self.stream = stream
+        self.compress = compress
+        self.rows = 0
+        self._write_block(MAGIC)
+        self._write_block(json.dumps(dict(header, compression="zlib" if compress else None)).encode("utf-8"))
+
+    def _write_block(self, data):
+        self.stream.write(_LENGTH.pack(len(data)))
+        self.stream.write(data)
+
+    def write_rows(self, rows):
+        """
+            Writes a list of property dicts as one row group.
+
+        :param rows: A list of dicts of database property values
+        """
+        names = sorted({a_name for a_row in rows for a_name in a_row})
+        columns = []
+        buffers = []
+        for a_name in names:
+            values = [a_row.get(a_name) for a_row in rows]
+            kind = column_type(values)
+            column_buffers = encode_column(values, kind)
+            if self.compress:
+                column_buffers = [zlib.compress(a_buffer, 1) for a_buffer in column_buffers]
+            columns.append({"name": a_name, "type": kind, "sizes": [len(a_buffer) for a_buffer in column_buffers]})
+            buffers.extend(column_buffers)
+        self._write_block(json.dumps({"rows": len(rows), "columns": columns}).encode("utf-8"))
+        for a_buffer in buffers:
+            self.stream.write(a_buffer)
+        self.rows += len(rows)
+
+    def close(self):
+        """
+            Writes the end of the snapshot. The stream is left open.
+        """
+        self._write_block(b"")
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SnapshotError("Snapshot ends unexpectedly")
+    return data
+
+
+def _read_block(stream):
+    return _read_exactly(stream, _LENGTH.unpack(_read_exactly(stream, _LENGTH.size))[0])
+
+
+def read_header(stream):
+    """
+        Reads the magic bytes and the header of a snapshot.
+
+    :param stream: A binary stream positioned at the start of a snapshot
+    :return: The header dict
+    """
+    if _read_block(stream) != MAGIC:
+        raise SnapshotError("Not a snapshot file")
+    return json.loads(_read_block(stream).decode("utf-8"))
+
+
+def iter_row_groups(stream, header):
+    """
+        Reads the row groups of a snapshot whose header has been read.
+
+    :param stream: A binary stream, positioned after the header
+    :param header: The header dict returned by read_header()
+    :return: A generator of lists of dicts of database property values (without the properties a node does not have)
+    """
+    while True:
+        description = _read_block(stream)
+        if not description:
+            return
+        description = json.loads(description.decode("utf-8"))
+        rows = description["rows"]
+        values_by_name = {}
+        for a_column in description["columns"]:
+            buffers = [_read_exactly(stream, a_size) for a_size in a_column["sizes"]]
+            if header.get("compression") == "zlib":
+                buffers = [zlib.decompress(a_buffer) for a_buffer in buffers]
+            values_by_name[a_column["name"]] = decode_column(buffers, a_column["type"], rows)
+        yield [{a_name: values[a_row] for a_name, values in values_by_name.items() if values[a_row] is not None}
+               for a_row in range(rows)]
+
+
+def export_snapshot(model, stream, page_size=DEFAULT_PAGE_SIZE, compress=False, progress=None):
+    """
+        Writes all nodes of a model's label to a snapshot.
+
+    :param model: A neomodel.StructuredNode class
+    :param stream: A binary stream
+    :param page_size: Node ids read per query, and nodes stored per row group
+    :param compress: Whether column buffers are zlib compressed
+    :param progress: An optional callable that receives the number of nodes exported after every page
+    :return: The number of nodes exported
+    """
+    header = {"model": "{}.{}".format(model.__module__, model.__name__),
+              "label": model.__label__,
+              "labels": list(model.inherited_labels())}
+    writer = SnapshotWriter(stream, header, compress)
+    query = "UNWIND {{ids}} AS node_id MATCH (n:{}) WHERE id(n) = node_id RETURN properties(n)".format(
+        model.__label__)
+    last_id = highest_id(model.__label__)
+    rows = []
+    for start in range(0, last_id + 1 if last_id is not None else 0, page_size):
+        results, _ = neomodel.db.cypher_query(query, {"ids": list(range(start, min(start + page_size, last_id + 1)))})
+        rows.extend(properties for properties, in results)
+        while len(rows) >= page_size:
+            writer.write_rows(rows[:page_size])
+            del rows[:page_size]
+            if progress is not None:
+                progress(writer.rows)
+    if rows:
+        writer.write_rows(rows)
+        if progress is not None:
+            progress(writer.rows)
+    writer.close()
+    return writer.rows
+
+
+def restore_snapshot(model, stream, batch_size=DEFAULT_BATCH_SIZE, merge_on=None, progress=None):
+    """
+        Creates the nodes of a snapshot.
+
+    :param model: The neomodel.StructuredNode class whose label the snapshot was exported from
+    :param stream: A binary stream positioned at the start of a snapshot
+    :param batch_size: Nodes created per transaction
+    :param merge_on: The name of a uniquely indexed property to MERGE on instead of always creating new nodes
+    :param progress: An optional callable that receives the number of nodes restored after every row group
+    :return: A tuple of the number of nodes read and the list of BulkFailures
+    """
+    header = read_header(stream)
+    if header["label"] != model.__label__:
+        raise SnapshotError("The snapshot holds nodes of label {}, not {}".format(header["label"], model.__label__))
+    read = 0
+    failures = []
+    for a_row_group in iter_row_groups(stream, header):
+        result = bulk_create(model, a_row_group, batch_size, merge_on, deflate=False)
+        failures.extend(result.failures)
+        read += len(a_row_group)
+        if progress is not None:
+            progress(read)
+    return read, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports and restores the nodes of a neomodel class.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    export_parser = subparsers.add_parser("export", help="Write all nodes of a model to a snapshot file")
+    export_parser.add_argument("--output", required=True, help="The snapshot file to write")
+    export_parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                               help="Node ids read per query, and nodes per row group")
+    export_parser.add_argument("--compress", action="store_true", help="Compress the columns with zlib")
+    restore_parser = subparsers.add_parser("restore", help="Create the nodes of a snapshot file")
+    restore_parser.add_argument("--input", required=True, help="The snapshot file to read")
+    restore_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Nodes per transaction")
+    restore_parser.add_argument("--merge-on", default=None,
+                                help="A uniquely indexed property to MERGE on, which makes restoring idempotent")
+    for a_parser in (export_parser, restore_parser):
+        a_parser.add_argument("--model", default="main_fix.SomeEntity", help="The node class (module.Class)")
+        a_parser.add_argument("--host", default="localhost:7687", help="The host:port of the Neo4j server")
+    args = parser.parse_args()
+
+    if not connect_from_environment(args.host):
+        sys.exit(1)
+    model = load_model(args.model)
+
+    def write_progress(nodes):
+        sys.stderr.write("\r{} nodes.".format(nodes))
+
+    if args.command == "export":
+        with open(args.output, "wb") as fd:
+            exported = export_snapshot(model, fd, args.page_size, args.compress, write_progress)
+        sys.stderr.write("\rExported {} nodes to {}.\n".format(exported, args.output))
+    else:
+        with open(args.input, "rb") as fd:
+            read, failures = restore_snapshot(model, fd, args.batch_size, args.merge_on, write_progress)
+        sys.stderr.write("\rRestored {} of {} nodes from {}.\n".format(read - len(failures), read, args.input))
+        for a_failure in failures[:10]:
+            sys.stderr.write("    {}: {}\n".format(type(a_failure.error).__name__, a_failure.error))
+        if failures:
+            sys.exit(1)
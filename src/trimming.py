@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Trimming of unicode payloads to a byte length limit at valid UTF-8 character boundaries.
+
+The work performed by these functions depends on the byte limit and NOT on the length of the payload. A string of N
+characters is at most 4N bytes long once encoded to UTF-8 and at least N bytes long, therefore only a prefix of at
+most `byte_limit` characters ever has to be encoded to decide where to trim.
+"""
+
+__author__ = "Athanasios Anastasiou"
+
+import os
+import json
+
+# Maximum number of bytes a single character can occupy when encoded to UTF-8.
+UTF8_MAX_BYTES_PER_CHAR = 4
+
+# The byte limit used throughout these scripts. It is lower than the 4095 bytes reported by the server's exceptions
+# because the server appears to add something to the key (see README.md).
+DEFAULT_BYTE_LIMIT = 4000
+
+# File that holds the byte limits measured by index_calibration.py, per server version.
+CALIBRATION_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "neomodlon", "index_limits.json")
+
+# str.isascii() is O(1) on CPython (it only checks the string's internal representation) but it only exists from
+# Python 3.7 onwards.
+_str_isascii = getattr(str, "isascii", None)
+
+
+def calibrated_byte_limit(server_version, kind="constraint", cache_path=CALIBRATION_CACHE_PATH):
+    """
+        Returns the largest safe byte limit that index_calibration.py has measured for a server version.
+
+    :param server_version: The version of the server, as returned by ingestion.server_version()
+    :param kind: "index" or "constraint", the kind of index the payload property is covered by
+    :param cache_path: The file of calibrated limits
+    :return: An integer, or None if the server version has not been calibrated for that kind of index
+    """
+    try:
+        with open(cache_path, "rt") as fd:
+            cache = json.load(fd)
+    except (IOError, ValueError):
+        return None
+    entry = cache.get(server_version, {}).get(kind)
+    return entry["byte_limit"] if entry is not None else None
+
+
+def utf8_boundary(encoded_string, byte_limit):
+    """
+        Returns the largest index i <= byte_limit such that encoded_string[:i] does not split a UTF-8 character.
+
+        NOTE: The byte at position byte_limit is the first byte that would be cut off. If it is a continuation byte
+              (10xxxxxx) the character it belongs to straddles the limit and the cut moves back to its first byte.
+
+    :param encoded_string: A bytes-like object holding valid UTF-8 that is longer than byte_limit
+    :param byte_limit: An integer representing the byte length limit
+    :return: An integer index into encoded_string
+    """
+    i = byte_limit
+    while i > 0 and (encoded_string[i] & 0xC0) == 0x80:
+        i = i - 1
+    return i
+
+
+def trim_string_at_unicode_boundaries(in_string, byte_limit):
+    """
+        Trims a unicode string to a specific limit of bytes and returns the unicode representation.
+        NOTE: The function assumes that the default encoding is utf-8
+        NOTE: In writing this function I have consulted
+              https://stackoverflow.com/questions/13727977/truncating-string-to-byte-length-in-python/13738452#13738452
+        NOTE: Only a prefix of at most byte_limit characters is ever encoded, so trimming a payload of several
+              megabytes costs the same as trimming one that is just over the limit.
+
+    :param in_string: Unicode input string
+    :param byte_limit: An integer representing the byte length limit to trim the string to
+    :return: A unicode in_string trimmed to the right length (always a str)
+    """
+    if byte_limit <= 0:
+        return u""
+
+    # Even if every character took the maximum number of bytes, the string would still fit.
+    if len(in_string) * UTF8_MAX_BYTES_PER_CHAR <= byte_limit:
+        return in_string
+
+    # Pure ASCII strings are one byte per character, no encoding is required at all.
+    if _str_isascii is not None and _str_isascii(in_string):
+        return in_string[:byte_limit]
+
+    # Every character takes at least one byte, so nothing beyond the first byte_limit characters can survive trimming.
+    # If the string is longer than that, it is certainly over the limit.
+    prefix = in_string[:byte_limit]
+    encoded_prefix = prefix.encode("utf-8")
+    if len(encoded_prefix) <= byte_limit:
+        return prefix
+
+    return encoded_prefix[:utf8_boundary(encoded_prefix, byte_limit)].decode("utf-8")
+
+
+def trim_bytes_at_unicode_boundaries(in_buffer, byte_limit):
+    """
+        Trims a buffer that already holds UTF-8 to a specific limit of bytes without copying or decoding it.
+        NOTE: The returned memoryview shares memory with in_buffer. Decode it with str(view, "utf-8") only at the
+              point where a unicode string is actually required, and keep in_buffer alive (e.g. an mmap open) until
+              then.
+
+    :param in_buffer: A bytes-like object holding valid UTF-8 (bytes, bytearray, memoryview, mmap)
+    :param byte_limit: An integer representing the byte length limit to trim the buffer to
+    :return: A memoryview over the trimmed part of in_buffer
+    """
+    view = memoryview(in_buffer)
+    if view.format != "B" or view.ndim != 1:
+        view = view.cast("B")
+    if byte_limit <= 0:
+        return view[:0]
+    if len(view) <= byte_limit:
+        return view
+    return view[:utf8_boundary(view, byte_limit)]